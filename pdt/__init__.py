@@ -95,6 +95,25 @@ Here's what the template will look like after being recompiled::
         # template.
         return _buffer.getvalue()
 
+Expressions which only call a function or method returning ``None``
+are compiled as plain statements when its name is in *none_calls* or
+the function is decorated with ``side_effect()``. Names are matched on
+any function or method so *none_calls* is empty by default.
+``NONE_CALLS`` contains common names (``append()``, ``update()``,
+``debug()``, etc.) for templates which do not call other functions or
+methods with these names::
+
+    import pdt
+    
+    @pdt.side_effect
+    def track(...):
+        ...
+    
+    @pdt.template(none_calls=pdt.NONE_CALLS | {'register'})
+    def spam(items, ...):
+        items.append(...) # Not written.
+        track(...) # Not written.
+
 Templates cannot define a doc string after their function signature
 because it will be interpreted as an expression and prepended to the
 result of each call. However, a doc string can be provided through the
@@ -197,6 +216,495 @@ output "None" for each call.
 The *getvalue()* function returns the concatenated ``str`` or
 ``unicode`` result of every expression sent to *write()*.
 
+The built-in buffers accept bytes-like objects (``bytearray``,
+``buffer`` and ``memoryview``) such as a cached fragment or a slice of
+a memory-mapped file. They are kept by reference instead of being
+copied when they are written, and are copied at most once when the
+output is assembled. Avoid modifying a ``bytearray`` after writing it.
+
+
+*io_param* optionally names a template argument whose value is passed
+as the first positional argument to *io_factory* on each call. This
+allows a buffer to write to a stream provided by the caller.
+
+Expressions formatting a literal string with ``str.format()`` or ``%``
+(e.g., ``"<a href='{}'>{}</a>".format(url, title)``) are precompiled
+into writes of the literal pieces and the converted values so that the
+format string is not parsed on each call. If the buffer implements the
+pdt specific *write_pieces()* method, the pieces (which are not
+converted to strings) are written with a single call to it. Like
+formatting, *write_pieces()* should output ``None`` as "None". The
+pieces of a ``unicode`` format string always include a ``unicode``
+literal (which can be empty) so that the output is ``unicode`` like the
+formatted string.
+
+
+Compression
+-----------
+
+The ``GzipIO`` buffer compresses the output incrementally as it is
+written. The template returns the compressed bytes::
+
+    import pdt
+    
+    @pdt.template(io_factory=pdt.GzipIO, io_kw={'level': 6})
+    def spam(...):
+        ...
+
+To stream the compressed chunks as they are produced instead, pass a
+*sink* callable (e.g., the WSGI ``write()`` callable) through
+*io_param*. *flush_size* sets the number of uncompressed bytes after
+which a compressed chunk is flushed to the sink::
+
+    @pdt.template(io_factory=pdt.GzipIO, io_param='write', io_kw={'flush_size': 16384})
+    def spam(write, ...):
+        ...
+
+
+Chunked Output
+--------------
+
+The ``ChunksIO`` buffer returns the output as ``Chunks`` instead of
+joining it. ``Chunks`` supports ``len()`` and iteration over the chunks,
+and joins them with *getvalue()* or *to_bytes()*. A server can write the
+chunks with a scatter/gather write, and when ``Chunks`` are written by
+another template they are spliced into its buffer without being
+joined::
+
+    import pdt
+    
+    @pdt.template(io_factory=pdt.ChunksIO)
+    def spam(...):
+        ...
+    
+    stream.writelines(spam(...))
+
+
+Large Outputs
+-------------
+
+The ``SpooledListIO`` buffer keeps the output in memory until it exceeds
+*max_size* characters, and then spills it to a temporary file. If the
+output was spilled, the template returns the temporary file positioned
+at its start (or a read-only ``mmap`` of it when *mmap* is ``True``)
+instead of a string so the output never has to be loaded back into
+memory::
+
+    import pdt
+    
+    @pdt.template(io_factory=pdt.SpooledListIO, io_kw={'max_size': 64 * 1024 * 1024})
+    def export(...):
+        ...
+    
+    result = export(...)
+    if isinstance(result, basestring):
+        response.write(result)
+    else:
+        shutil.copyfileobj(result, response)
+
+
+Compaction
+----------
+
+Indented triple-quoted literals are easy to read but fill the output
+with tabs and newlines. With the *compact* argument, the whitespace in
+literal string expressions (including the literal format strings of
+``str.format()`` and ``%``) is collapsed once when the template is
+compiled::
+
+    import pdt
+    
+    @pdt.template(compact='html')
+    def spam(...):
+        '''
+        <ul>
+            <li>Spam</li>
+        </ul>
+        '''
+
+Each run of whitespace is collapsed into a newline if it contains one,
+and into a space otherwise. Comments, quoted attribute values and the
+contents of ``<pre>``, ``<textarea>``, ``<script>`` and ``<style>``
+elements are left as is, even when they span several literals. Whitespace in the values written is never
+changed.
+
+
+Encoded Output
+--------------
+
+Output sent over the wire has to be encoded eventually. With the
+*encoding* argument, literal ``unicode`` string expressions are encoded
+once when the template is compiled, and the template uses the
+``ByteArrayIO`` buffer which encodes the remaining data into a single
+``bytearray`` that is returned without a final join::
+
+    import pdt
+    
+    @pdt.template(encoding='utf-8')
+    def spam(...):
+        u"<p>Literal text is encoded at compile time.</p>"
+        ...
+
+``str`` data is assumed to already be encoded.
+
+
+Stream Output
+-------------
+
+The ``StreamIO`` buffer writes the output to a file descriptor (or any
+file, socket or pipe implementing *fileno()*) while the template runs
+instead of holding it in memory. Small chunks are batched and written
+together with ``os.writev()`` (when available) once *max_bytes* bytes
+or *max_chunks* chunks are pending. The stream is passed on each call
+through *io_param*::
+
+    import pdt
+    
+    @pdt.template(io_factory=pdt.StreamIO, io_param='out')
+    def page(out, ...):
+        ...
+    
+    with open(path, 'wb') as fh:
+        page(fh, ...)
+
+
+Budgets
+-------
+
+A template fed by a bad query can render far more output than intended.
+The *max_bytes* and *max_seconds* arguments limit the size of the output
+(in characters for ``unicode`` data) and the time spent rendering it::
+
+    import pdt
+    
+    @pdt.template(max_bytes=16 * 1024 * 1024, max_seconds=2.0)
+    def report(rows):
+        for row in rows:
+            ...
+
+The limits are checked when data is written and at the start of each
+loop iteration, and ``BudgetExceeded`` is raised as soon as one is
+exceeded. Its *limit* attribute names the limit that was exceeded.
+
+Strings and bytes-like objects are sized as they are written. Other data
+is passed to the buffer as is, and is only sized if the buffer reports
+the size of its conversion with the pdt specific *write_sized()* and
+*write_pieces_sized()* methods (like the buffers of pdt do).
+
+
+ETags
+-----
+
+A template can compute the ETag of its output while it is written
+instead of hashing the output afterward::
+
+    import pdt
+    
+    @pdt.template(etag=True)
+    def spam(...):
+        ...
+    
+    output, etag = spam(...)
+
+With *etag* set, the template uses the ``ETagIO`` buffer and returns
+the output along with its hex digest. *etag* can also name the
+``hashlib`` algorithm to use (the default is ``ETAG_ALGORITHM``). The
+static prefix of the template (see below) is hashed once when it is
+compiled.
+
+
+Slots
+-----
+
+A template can output a value which is only known after the rest of its
+output is written (e.g., a title or the assets required by the body) by
+reserving a slot for it and filling the slot later in the same call::
+
+    import pdt
+    
+    @pdt.template
+    def page(...):
+        "<html><head><title>"
+        pdt.slot('title')
+        "</title></head><body>"
+        for item in items:
+            ...
+        pdt.fill('title', "%d Items" % len(items))
+        "</body></html>"
+
+The slots are resolved when the output is returned. A slot which is not
+filled is left empty.
+
+Independent slow values (e.g., the responses of backend calls) can be
+computed concurrently by starting them as futures and writing them with
+``defer()``. Their positions are reserved while the rest of the output
+is written, and their results are waited for in order when the output
+is returned::
+
+    import pdt
+    from concurrent.futures import ThreadPoolExecutor
+    
+    executor = ThreadPoolExecutor(16)
+    
+    @pdt.template
+    def dashboard(widgets):
+        "<div class='dashboard'>"
+        for widget in widgets:
+            pdt.defer(executor.submit(render_widget, widget))
+        "</div>"
+
+Slots are supported by ``ListIO`` and ``ChunksIO`` but not by the
+buffers which process the data as it is written.
+
+
+Static Prefix
+-------------
+
+The literal strings which every call of a template starts its output
+with (e.g., the DOCTYPE, head and includes of a page) are rendered once
+when the template is compiled. Assignments, imports and definitions
+between them are skipped over, but any other expression or control flow
+statement ends the prefix. With the *split_prefix* argument, the prefix
+is left out of the output so that a server can send it to the client
+before fetching the data to render the rest::
+
+    import pdt
+    
+    @pdt.template(split_prefix=True)
+    def page(...):
+        ...
+    
+    response.write(pdt.static_prefix(page))
+    response.flush()
+    response.write(page(fetch_data()))
+
+With *etag* also set, the ETag still covers the static prefix.
+
+
+Specialization
+--------------
+
+Templates rendered with the same arguments for every request (e.g., a
+locale or site) can be specialized on those arguments::
+
+    import pdt
+    
+    @pdt.template
+    def spam(locale, eggs):
+        ...
+    
+    spam_fr = pdt.specialize(spam, locale='fr')
+    spam_fr(eggs)
+
+The specialized arguments are removed from the signature of the
+specialized template. Branches which only depend on them are resolved
+and expressions which only depend on them (including ``str.format()``
+and ``%`` formatting of literals) are folded into literals when the
+specialized template is compiled.
+
+
+Inlining
+--------
+
+Calls to small sub-templates can be inlined into the calling template
+when it is compiled. The sub-template writes directly to the buffer of
+the calling template instead of creating its own buffer and joining it.
+Inlining is enabled with the *inline* argument of both the calling
+template and the sub-template::
+
+    import pdt
+    
+    @pdt.template(inline=True)
+    def item(title):
+        "<li>"
+        escape(title)
+        "</li>"
+    
+    @pdt.template(inline=True)
+    def items(titles):
+        for title in titles:
+            item(title)
+
+A call is inlined when the sub-template is defined in the same module,
+its body has at most ``INLINE_MAX_NODES`` nodes and does not return or
+define functions, and the call only passes names and literals. A
+sub-template is not inlined when it has a budget, an encoding, a doc
+string or *split_prefix* set, or when a global it uses is shadowed by a
+local of the calling template. A call inside a ``try`` or ``with``
+statement is not inlined, so that the writes of a sub-template raising
+an exception are not kept in the output. The inlined body is guarded by
+a check that the global name is still bound to the sub-template, and the
+sub-template is called otherwise or while a tracer is set.
+
+
+Warm Up
+-------
+
+Templates are compiled when they are decorated. Compiling can be
+deferred until a template is first called with the *lazy* argument::
+
+    import pdt
+    
+    @pdt.template(lazy=True)
+    def spam(...):
+        ...
+
+A lazy template is compiled once even when it is first called from
+several threads at the same time. Once it is compiled (by its first
+call or by ``warmup()``), the name it is defined under in its module or
+class is rebound to the compiled template function so that later calls
+do not go through the lazy wrapper. Compiling itself never modifies the
+module globals.
+
+A pre-fork server should compile all of its templates in the master
+process before forking so the compiled templates are shared
+copy-on-write by the workers instead of being compiled in each of
+them::
+
+    import pdt
+    import myapp.templates
+    
+    pdt.warmup(myapp.templates, freeze=True)
+
+``warmup()`` compiles every registered template (or only those in the
+specified modules), drops the source lines loaded to compile them, and
+calls ``gc.freeze()`` when *freeze* is ``True`` and it is available.
+
+Source files loaded only to compile templates can also be released by
+calling ``release_sources()`` once all templates have been imported.
+The memory retained by each compiled template (code objects, constants,
+closure cells and the AST kept to inline it) is reported by
+``memory_report()``::
+
+    for usage in pdt.memory_report():
+        print usage.name, usage.total
+
+Small templates retain a copy of their AST to inline their calls into
+templates compiled later (see "Inlining"). This is dropped by
+``warmup()`` when *drop_inline* is ``True`` once every template has
+been compiled::
+
+    pdt.warmup(myapp.templates, drop_inline=True)
+
+
+Profiling
+---------
+
+The line numbers of compiled templates match their source files so
+tracebacks, ``cProfile`` and sampling profilers report the original
+lines. Each template also carries a line map of the code offsets of the
+compiled template function to its source lines (see
+``Template.line_map``). This is used to sample the stacks of running
+threads with the frames of templates resolved to their source lines::
+
+    import pdt
+    
+    for thread_id, stack in pdt.sample_stacks().iteritems():
+        for filename, lineno, name in stack:
+            ...
+
+The entries of templates in collected ``pstats`` statistics can be
+named by the keys of the templates with ``rewrite_stats()``::
+
+    import cProfile
+    import pstats
+    import pdt
+    
+    profiler = cProfile.Profile()
+    profiler.runcall(page, ...)
+    pdt.rewrite_stats(pstats.Stats(profiler)).sort_stats('cumulative').print_stats(20)
+
+
+Tracing
+-------
+
+A tracer opens a span around each template call with its name, a
+summary of its arguments, the size of its output and its duration. The
+spans of sub-templates are nested in the span of the calling template::
+
+    import pdt
+    
+    tracer = pdt.Tracer(sample_rate=0.01)
+    pdt.set_tracer(tracer)
+    ...
+    for span in tracer.exporter.spans:
+        print "  " * span.depth, span.name, span.duration, span.output_size
+
+Spans are kept in memory by ``MemoryExporter`` by default, or can be
+written as JSON lines to a file with ``JSONLinesExporter``::
+
+    pdt.set_tracer(pdt.Tracer(pdt.JSONLinesExporter(open('spans.jsonl', 'a'))))
+
+*sample_rate* is the fraction of top-level template calls traced along
+with their sub-templates. Sub-templates are called instead of inlined
+while a tracer is set so that their calls are traced. When no tracer is
+set, a template only checks for one on each call. ``set_tracer(None)``
+disables tracing.
+
+
+Allocations
+-----------
+
+The memory allocated by templates can be attributed to their source
+lines with ``alloc_profile()``. This traces the memory allocations with
+``tracemalloc`` and takes a snapshot around each top-level template
+render, so the output pieces, formatted strings and joined sub-template
+output still held by the render are counted at the line which allocated
+them::
+
+    import pdt
+    
+    with pdt.alloc_profile() as profile:
+        page(...)
+    for usage in profile.report(10):
+        print usage.name, usage.lineno, usage.size, usage.count, usage.line
+
+Only the blocks still allocated at the end of a render are counted, not
+the temporaries freed during it. Snapshots are taken of the whole
+process so templates should be profiled from a single thread. This
+requires the ``tracemalloc`` module which is available on Python 2 with
+the *pytracemalloc* patch.
+
+
+Explain
+-------
+
+What the compiler emits for a template can be inspected with
+``explain()``. This reports the optimizations applied, the number of
+write calls and global lookups in the bytecode, the transformed source
+code (when ``ast.unparse()`` or *astor* is available), the transformed
+AST and the disassembled bytecode::
+
+    import pdt
+    
+    print pdt.explain(page)
+
+
+Registry
+--------
+
+Every template is registered under its key: the module qualified name
+of the template function (e.g., "myapp.pages.home") followed by its
+constants if it is specialized. The name of a template function
+defined in a class or function includes it like the qualified names of
+Python 3 (e.g., "myapp.pages.Page.render" or
+"myapp.pages.build.<locals>.row"). The registry only holds weak references
+so it does not keep templates alive::
+
+    import pdt
+    
+    for temp in pdt.list_templates():
+        info = temp.info()
+        print info.key, info.compile_time, info.code_size, info.renders
+    
+    home = pdt.lookup('myapp.pages.home')
+
+``TemplateInfo`` holds the options, compile time, code size, source file
+and lines, and number of renders of a template. ``recompile()``
+recompiles templates from their source files (e.g., to reload them
+during development) and ``reset_counters()`` resets their render
+counters. Both accept the same targets as ``warmup()``.
+
 
 Implementation
 --------------
@@ -224,19 +732,87 @@ __license__ = "MIT"
 __version__ = "0.7.9.dev0"
 __status__ = "Development"
 
+import __builtin__
 import ast
 import _ast
+import codecs
 import collections
+import contextlib
+import copy
+import dis
 import functools
+import gc
+import hashlib
 import inspect
+import json
 import linecache
+import mmap
+import operator
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+import weakref
+import zlib
 
-__all__ = ['template']
+__all__ = ['AllocProfile', 'AllocUsage', 'Budget', 'BudgetExceeded', 'ByteArrayIO', 'Chunks', 'ChunksIO', 'ETagIO', 'Explanation', 'GzipIO', 'JSONLinesExporter', 'ListIO', 'MemoryExporter', 'RenderCounters', 'Span', 'SpooledListIO', 'StreamIO', 'TemplateInfo', 'Tracer', 'alloc_profile', 'defer', 'dump_ast', 'explain', 'fill', 'frame_location', 'list_templates', 'lookup', 'memory_report', 'recompile', 'release_sources', 'reset_counters', 'rewrite_stats', 'sample_stacks', 'set_tracer', 'side_effect', 'slot', 'specialize', 'static_prefix', 'template', 'warmup']
 
 _ast_store = _ast.Store()
 _ast_load = _ast.Load()
 _ast_param = _ast.Param()
 
+_templates = weakref.WeakValueDictionary()
+"""
+*_templates* (``weakref.WeakValueDictionary``) maps the key of every
+``Template`` instance which has wrapped a template function to it. See
+``Template.key``.
+"""
+
+NONE_CALLS = frozenset(['add', 'append', 'clear', 'critical', 'debug', 'discard', 'error', 'exception', 'extend', 'info', 'insert', 'remove', 'reverse', 'sort', 'update', 'warning'])
+"""
+*NONE_CALLS* (``frozenset``) contains the names of the common functions
+and methods whose calls return ``None`` (e.g., ``list.append()``,
+``dict.update()`` and ``logging.Logger.debug()``). This can be passed as
+*none_calls* to a template. It is not used by default because the names
+are matched on any function or method.
+"""
+
+_bytes_like = (bytearray, buffer, memoryview)
+"""
+*_bytes_like* (``tuple``) contains the bytes-like types which are not
+``str``.
+"""
+
+_template_codes = weakref.WeakKeyDictionary()
+"""
+*_template_codes* (``weakref.WeakKeyDictionary``) maps the code object
+of every compiled template function to a weak reference to its
+``Template``.
+"""
+
+_tracer = [None]
+"""
+*_tracer* (``list``) is the cell containing the ``Tracer`` set by
+``set_tracer()``, or ``None``. The cell is shared by every compiled
+template function.
+"""
+
+INLINE_MAX_NODES = 100
+"""
+*INLINE_MAX_NODES* (``int``) is the maximum number of AST nodes in the
+body of a template function for its calls to be inlined.
+"""
+
+_source_files = set()
+"""
+*_source_files* (``set``) contains the source files which were loaded
+into ``linecache`` only to compile templates.
+"""
+
 def template(*args, **kw):
 	"""
 	Wraps the specified template function which will be recompiled to
@@ -275,7 +851,7 @@ class Template(object):
 	result at the end of the function call.
 	"""
 	
-	__slots__ = ['doc', 'func', 'io_factory', 'io_args', 'io_kw']
+	__slots__ = ['__weakref__', 'compact', 'compile_time', 'compiled_func', 'constants', 'counters', 'doc', 'encoding', 'etag', 'func', 'inline', 'inline_def', 'io_factory', 'io_args', 'io_kw', 'io_param', 'lazy', 'line_map', 'lock', 'max_bytes', 'max_seconds', 'none_calls', 'optimizations', 'orig_func', 'qualname', 'source_file', 'source_lines', 'split_prefix', 'static_prefix']
 	
 	def __init__(self, *args, **kw):
 		"""
@@ -300,6 +876,87 @@ class Template(object):
 		
 		*io_kw* (``dict``) contains the keyword arguments to pass to
 		*io_factory* when it is called. Default is an empty ``dict``.
+		
+		*io_param* (``str``) is the name of a template function argument
+		whose value is passed as the first positional argument to
+		*io_factory* on each call (e.g., a stream to write to). Default is
+		``None``.
+		
+		*lazy* (``bool``) is whether the template function should not be
+		compiled until it is first called (or warmed up). Default is
+		``False``.
+		
+		*none_calls* (**iterable**) contains the names of the functions and
+		methods whose calls return ``None``. Expressions which only call
+		them are compiled as plain statements instead of being written to
+		the buffer. Default is an empty set. See ``NONE_CALLS``.
+		
+		*constants* (``dict``) maps the names of template function
+		arguments to constant values they are specialized on. See
+		``specialize()``. Default is an empty ``dict``.
+		
+		*encoding* (``str``) is the encoding of the output. If set, literal
+		``unicode`` string expressions are encoded when the template
+		function is compiled, and *io_factory* defaults to ``ByteArrayIO``.
+		It cannot be combined with *etag*. Default is ``None``.
+		
+		*etag* (``bool`` or ``str``) is whether the template function should
+		return its output along with its ETag. This can also be the name of
+		the ``hashlib`` algorithm to use. If set, *io_factory* defaults to
+		``ETagIO``. Default is ``False``.
+		
+		*compact* (``str``) is the markup whose insignificant whitespace is
+		collapsed in literal string expressions when the template function
+		is compiled. The only supported value is "html". Default is ``None``
+		to leave literals as is.
+		
+		*inline* (``bool``) is whether the calls to small sub-templates
+		should be inlined, and whether the calls to this template can be
+		inlined into other templates. Default is ``False``.
+		
+		*split_prefix* (``bool``) is whether the static prefix of the output
+		should be left out of the output so that it can be sent beforehand.
+		See *static_prefix*. Default is ``False``.
+		
+		*max_bytes* (``int``) is the maximum size of the output (in
+		characters for ``unicode`` data). ``BudgetExceeded`` is raised when
+		it is exceeded. Default is ``None`` for no limit.
+		
+		*max_seconds* (``float``) is the maximum number of seconds a call of
+		the template function can take. ``BudgetExceeded`` is raised when it
+		is exceeded. Default is ``None`` for no limit.
+		"""
+		
+		self.compact = None
+		"""
+		*compact* (``str``) is the markup whose whitespace is collapsed in
+		literal string expressions. Default is ``None``.
+		"""
+		
+		self.compile_time = None
+		"""
+		*compile_time* (``float``) is the number of seconds it took to
+		compile the template function. This is ``None`` until the template
+		function is compiled.
+		"""
+		
+		self.compiled_func = None
+		"""
+		*compiled_func* (``function``) is the compiled template function.
+		This is ``None`` until the template function is compiled.
+		"""
+		
+		self.constants = {}
+		"""
+		*constants* (**mapping**) maps the names of the template function
+		arguments which are fixed to their constant values. Default is an
+		empty ``dict``.
+		"""
+		
+		self.counters = RenderCounters()
+		"""
+		*counters* (``RenderCounters``) counts the calls of the compiled
+		template function.
 		"""
 		
 		self.doc = None
@@ -308,9 +965,38 @@ class Template(object):
 		``None``.
 		"""
 		
+		self.encoding = None
+		"""
+		*encoding* (``str``) is the encoding of the output. Default is
+		``None``.
+		"""
+		
+		self.etag = None
+		"""
+		*etag* (``str``) is the name of the hash algorithm used to compute
+		the ETag of the output. Default is ``None`` for no ETag.
+		"""
+		
 		self.func = None
 		"""
-		*func* (``function``) is the wrapped template function.
+		*func* (``function``) is the wrapped template function. This is the
+		compiled template function unless *lazy* is ``True``.
+		"""
+		
+		self.inline = False
+		"""
+		*inline* (``bool``) is whether the calls to small sub-templates are
+		inlined, and whether the calls to this template can be inlined.
+		Default is ``False``.
+		"""
+		
+		self.inline_def = None
+		"""
+		*inline_def* (``ast.FunctionDef``) is a copy of the parsed template
+		function used to inline its calls into other templates. This is only
+		set once compiled if the template function is small enough and can
+		be inlined. It is retained until dropped by ``warmup()`` with
+		*drop_inline*.
 		"""
 		
 		self.io_factory = ListIO
@@ -331,14 +1017,107 @@ class Template(object):
 		*io_factory* when it is called. Default is an empty ``dict``.
 		"""
 		
-		if kw:
-			doc = kw.get('doc', None)
-			if doc is not None:
-				if not isinstance(doc, basestring):
-					raise TypeError("doc:%r is not a string." % doc)
-				self.doc = doc
-		
-			io_factory = kw.get('io_factory', None)
+		self.io_param = None
+		"""
+		*io_param* (``str``) is the name of the template function argument
+		passed as the first positional argument to *io_factory*. Default is
+		``None``.
+		"""
+		
+		self.lazy = False
+		"""
+		*lazy* (``bool``) is whether compiling the template function is
+		deferred until it is first called. Default is ``False``.
+		"""
+		
+		self.line_map = None
+		"""
+		*line_map* (``tuple``) maps the code offsets of the compiled template
+		function to the lines of its source file. Each item is a ``tuple``
+		containing the code offset (``int``) where a line starts, and the
+		line number (``int``). This is ``None`` until the template function
+		is compiled.
+		"""
+		
+		self.lock = None
+		"""
+		*lock* (``threading.Lock``) serializes the first compile of a lazy
+		template function. This is ``None`` unless *lazy* is ``True``.
+		"""
+		
+		self.max_bytes = None
+		"""
+		*max_bytes* (``int``) is the maximum size of the output. Default is
+		``None``.
+		"""
+		
+		self.max_seconds = None
+		"""
+		*max_seconds* (``float``) is the maximum number of seconds a call of
+		the template function can take. Default is ``None``.
+		"""
+		
+		self.none_calls = frozenset()
+		"""
+		*none_calls* (``frozenset``) contains the names of the functions and
+		methods whose calls return ``None``. Default is an empty set.
+		"""
+		
+		self.optimizations = {}
+		"""
+		*optimizations* (``dict``) maps the name of each optimization
+		applied when compiling the template function to the number of times
+		it was applied.
+		"""
+		
+		self.orig_func = None
+		"""
+		*orig_func* (``function``) is the original template function. This
+		is only set until the template function is compiled.
+		"""
+		
+		self.qualname = None
+		"""
+		*qualname* (``str``) is the name of the template function qualified
+		by the classes and functions it is defined in.
+		"""
+		
+		self.source_file = None
+		"""
+		*source_file* (``str``) is the path of the source file of the
+		template function. This is ``None`` until the template function is
+		compiled.
+		"""
+		
+		self.source_lines = None
+		"""
+		*source_lines* (``tuple``) contains the first and last line numbers
+		(``int``) of the template function in its source file. This is
+		``None`` until the template function is compiled.
+		"""
+		
+		self.split_prefix = False
+		"""
+		*split_prefix* (``bool``) is whether the static prefix is left out of
+		the output. Default is ``False``.
+		"""
+		
+		self.static_prefix = None
+		"""
+		*static_prefix* (``str`` or ``unicode``) is the static output which
+		every call of the template function starts with. This is set when
+		the template function is compiled, and is ``None`` if the output
+		does not start with a literal string.
+		"""
+		
+		if kw:
+			doc = kw.get('doc', None)
+			if doc is not None:
+				if not isinstance(doc, basestring):
+					raise TypeError("doc:%r is not a string." % doc)
+				self.doc = doc
+		
+			io_factory = kw.get('io_factory', None)
 			if io_factory is not None:
 				if not callable(io_factory):
 					raise TypeError("io_factory:%r is not callable." % io_factory)
@@ -356,6 +1135,76 @@ class Template(object):
 					raise TypeError("io_kw:%r is not a mapping." % io_kw)
 				self.io_kw = io_kw
 			
+			io_param = kw.get('io_param', None)
+			if io_param is not None:
+				if not isinstance(io_param, basestring):
+					raise TypeError("io_param:%r is not a string." % io_param)
+				self.io_param = io_param
+			
+			self.lazy = bool(kw.get('lazy', False))
+			
+			self.inline = bool(kw.get('inline', False))
+			
+			self.split_prefix = bool(kw.get('split_prefix', False))
+			
+			max_bytes = kw.get('max_bytes', None)
+			if max_bytes is not None:
+				if not isinstance(max_bytes, (int, long)):
+					raise TypeError("max_bytes:%r is not an int." % max_bytes)
+				elif max_bytes < 0:
+					raise ValueError("max_bytes:%r cannot be negative." % max_bytes)
+				self.max_bytes = max_bytes
+			
+			max_seconds = kw.get('max_seconds', None)
+			if max_seconds is not None:
+				if not isinstance(max_seconds, (int, long, float)):
+					raise TypeError("max_seconds:%r is not a number." % max_seconds)
+				elif max_seconds <= 0:
+					raise ValueError("max_seconds:%r is not positive." % max_seconds)
+				self.max_seconds = max_seconds
+			
+			etag = kw.get('etag', None)
+			if etag:
+				if etag is True:
+					etag = ETAG_ALGORITHM
+				elif not isinstance(etag, basestring):
+					raise TypeError("etag:%r is not a bool or string." % etag)
+				hashlib.new(etag) # Raises ValueError if unsupported.
+				if io_factory is None:
+					self.io_factory = ETagIO
+				elif not (isinstance(io_factory, type) and issubclass(io_factory, ETagIO)):
+					raise TypeError("io_factory:%r is not an ETagIO subclass." % io_factory)
+				self.etag = etag
+			
+			encoding = kw.get('encoding', None)
+			if encoding is not None:
+				if not isinstance(encoding, basestring):
+					raise TypeError("encoding:%r is not a string." % encoding)
+				elif etag:
+					# ETagIO buffers unicode data as is and is not encoded.
+					raise TypeError("encoding:%r cannot be used with etag:%r." % (encoding, etag))
+				self.encoding = codecs.lookup(encoding).name
+				if io_factory is None:
+					self.io_factory = ByteArrayIO
+			
+			none_calls = kw.get('none_calls', None)
+			if none_calls is not None:
+				if isinstance(none_calls, basestring) or not isinstance(none_calls, collections.Iterable):
+					raise TypeError("none_calls:%r is not an iterable." % none_calls)
+				self.none_calls = frozenset(none_calls)
+			
+			constants = kw.get('constants', None)
+			if constants is not None:
+				if not isinstance(constants, collections.Mapping):
+					raise TypeError("constants:%r is not a mapping." % constants)
+				self.constants = dict(constants)
+			
+			compact = kw.get('compact', None)
+			if compact is not None:
+				if compact not in COMPACT_MODES:
+					raise ValueError("compact:%r is not one of %s." % (compact, ", ".join(map(repr, sorted(COMPACT_MODES)))))
+				self.compact = compact
+			
 		if args:
 			# Wrap function.
 			self.wrap_func(args[0])
@@ -365,14 +1214,189 @@ class Template(object):
 		self.wrap_func(func)
 		return self
 	
+	@property
+	def name(self):
+		"""
+		*name* (``str``) is the module qualified name of the template
+		function. See *qualname*.
+		"""
+		func = self.func or self.orig_func
+		return "%s.%s" % (func.__module__, self.qualname) if func else None
+	
+	@property
+	def key(self):
+		"""
+		*key* (``str``) is the key the template is registered under. This is
+		its name followed by its constants if it is specialized.
+		"""
+		name = self.name
+		if name and self.constants:
+			name += "(%s)" % ", ".join(["%s=%r" % item for item in sorted(self.constants.iteritems())])
+		return name
+
 	def __repr__(self):
-		return "%s.%s(%s)" % (self.__class__.__module__, self.__class__.__name__, ", ".join([("%s=%s" % (k, repr(getattr(self, k)))) for k in self.__slots__ if getattr(self, k)]))
+		return "%s.%s(%s)" % (self.__class__.__module__, self.__class__.__name__, ", ".join([("%s=%s" % (k, repr(getattr(self, k)))) for k in self.__slots__ if not k.startswith('_') and getattr(self, k)]))
 
 	def wrap_func(self, func):
 		if self.func:
 			raise RuntimeError("func is already set.")
 		if not inspect.isfunction(func):
 			raise TypeError("func:%r is not a function or method." % func)
+		
+		self.orig_func = func
+		self.qualname = qualify_name(func)
+		
+		if self.lazy:
+			# Defer compilation until the template function is first called.
+			def lazy_func(*args, **kw):
+				return (self.compiled_func or self.ensure_compiled())(*args, **kw)
+			self.lock = threading.Lock()
+			functools.update_wrapper(lazy_func, func)
+			lazy_func.__doc__ = self.doc
+			lazy_func.__pdt_template__ = self
+			self.func = lazy_func
+		else:
+			self.func = self.compile()
+		
+		_templates[self.key] = self
+	
+	def ensure_compiled(self):
+		"""
+		Compiles the template function unless it is already compiled. The
+		first compile of a lazy template function is serialized so that
+		concurrent first calls compile it once. Its name in its module or
+		class is then rebound to the compiled template function so that
+		later calls no longer go through the lazy wrapper.
+		
+		Returns the compiled template function (``function``).
+		"""
+		if self.lock is None:
+			return self.compile()
+		with self.lock:
+			compiled_func = self.compiled_func
+			if compiled_func is None:
+				compiled_func = self.compile()
+				if self.func is not compiled_func:
+					rebind_name(compiled_func.__globals__, self.qualname, self.func, compiled_func)
+		return compiled_func
+	
+	def info(self):
+		"""
+		Gets the information about the template.
+		
+		Returns the information (``TemplateInfo``).
+		"""
+		code_size = sum(_code_size(self.compiled_func.__code__)) if self.compiled_func else None
+		return TemplateInfo(self.key, self.options(), self.compile_time, code_size, self.source_file, self.source_lines, self.counters.renders)
+			
+	def options(self):
+		"""
+		Gets the options of the template.
+		
+		Returns the keyword arguments to pass to the ``Template``
+		constructor to create a template with the same options (``dict``).
+		"""
+		return {
+			'compact': self.compact,
+			'constants': self.constants,
+			'doc': self.doc,
+			'encoding': self.encoding,
+			'etag': self.etag,
+			'inline': self.inline,
+			'io_factory': self.io_factory,
+			'io_args': self.io_args,
+			'io_kw': self.io_kw,
+			'io_param': self.io_param,
+			'max_bytes': self.max_bytes,
+			'max_seconds': self.max_seconds,
+			'none_calls': self.none_calls,
+			'split_prefix': self.split_prefix
+		}
+		
+	def recompile(self):
+		"""
+		Recompiles the template function from its source file (e.g., after
+		the source file has changed). The code of the compiled template
+		function is replaced in place when its closure is unchanged so that
+		existing references to it use the new code. Otherwise, the name of
+		the template function in its module or class is rebound to the new
+		compiled template function.
+		
+		Returns the compiled template function (``function``).
+		"""
+		old_func = self.compiled_func
+		if old_func is None:
+			return self.compile()
+		
+		self.orig_func = old_func
+		try:
+			new_func = self.compile()
+		except Exception:
+			self.orig_func = None
+			self.compiled_func = old_func
+			raise
+		
+		old_cells = old_func.__closure__ or ()
+		new_cells = new_func.__closure__ or ()
+		# .. NOTE: The cell of the function referring to itself differs.
+		if old_func.__code__.co_freevars == new_func.__code__.co_freevars and all(old.cell_contents is new.cell_contents or (old.cell_contents is old_func and new.cell_contents is new_func) for old, new in zip(old_cells, new_cells)):
+			# Swap the code of the existing function.
+			old_func.__code__ = new_func.__code__
+			old_func.__defaults__ = new_func.__defaults__
+			old_func.__pdt_template__ = self
+			self.compiled_func = old_func
+			
+			# Register the code again because an equal old code object could
+			# have been registered instead of it, and was just released.
+			_template_codes[old_func.__code__] = weakref.ref(self)
+			return old_func
+		
+		# Rebind the existing function.
+		rebind_name(old_func.__globals__, self.qualname, old_func, new_func)
+		if self.func is old_func:
+			self.func = new_func
+		return new_func
+	
+	def specialize(self, **constants):
+		"""
+		Specializes the template function on constant arguments.
+		
+		*constants* (``dict``) maps the names of the template function
+		arguments to fix to their constant values.
+		
+		Returns the specialized template (``Template``).
+		"""
+		if not self.func:
+			raise RuntimeError("func is not set.")
+		
+		merged = dict(self.constants)
+		merged.update(constants)
+		options = self.options()
+		options['constants'] = merged
+		spec = Template(**options)
+		
+		# The source of the compiled template function is the source of the
+		# original template function.
+		spec.wrap_func(self.orig_func or self.compiled_func)
+		return spec
+
+	def compile(self, artifacts=None):
+		"""
+		Compiles the template function.
+		
+		*artifacts* (``dict``) optionally collects the transformed module
+		AST (``ast.Module``) as *ast* and the code of the compiled template
+		function (``code``) as *code*. When set, the compiled template
+		function is only returned and not stored. See ``explain()``.
+		
+		Returns the compiled template function (``function``).
+		"""
+		func = self.orig_func
+		if func is None:
+			if self.compiled_func:
+				return self.compiled_func
+			raise RuntimeError("func is not set.")
+		start_time = time.time()
 			
 		# Get function source code.
 		#
@@ -386,7 +1410,11 @@ class Template(object):
 		# .. 1218234: http://bugs.python.org/issue1218234
 		func_file = inspect.getsourcefile(func)
 		linecache.checkcache(func_file) # HACK: issue 1218234
+		if func_file not in linecache.cache:
+			_source_files.add(func_file)
 		func_src, lineno = inspect.getsourcelines(func)
+		self.source_file = func_file
+		self.source_lines = (lineno, lineno + len(func_src) - 1)
 		
 		# Dedent decorators and function def.
 		dedent_func_lines(func_src)
@@ -407,18 +1435,6 @@ class Template(object):
 			'__pdt_io_args': self.io_args,
 			'__pdt_io_kw': self.io_kw
 		}
-		# def __pdt_enc_func(...):
-		mod_ast.body[0] = _ast.FunctionDef(enc_name, _ast.arguments([
-			_ast.Name('__pdt_io_factory', _ast_param),
-			_ast.Name('__pdt_io_args', _ast_param),
-			_ast.Name('__pdt_io_kw', _ast_param)
-		], None, None, []), [
-			# def func(...):
-			#   ...
-			func_ast,
-			# return func
-			_ast.Return(_ast.Name(func.__name__, _ast_load))
-		], [])
 		
 		# Get template global namespace.
 		# .. NOTE: This has to be the actual function globals (module dict)
@@ -432,6 +1448,77 @@ class Template(object):
 		# source.
 		func_ast.decorator_list = []
 		
+		self.optimizations = {}
+		
+		# Keep a copy of the template function so that its calls can be
+		# inlined into other templates.
+		self.inline_def = copy.deepcopy(func_ast) if is_inlinable(func_ast, self) else None
+		
+		# Specialize constant arguments.
+		if self.constants:
+			specialize_func_ast(func_ast, self.constants, func_globals, enc_vars, self.optimizations)
+		
+		# Inline calls to small sub-templates.
+		if self.inline:
+			inline_calls(func_ast, self, func_globals, enc_vars, self.optimizations)
+		
+		# Rewrite slots to reserve their positions in the buffer.
+		if rewrite_slots(func_ast.body, func_globals, self.optimizations):
+			if getattr(self.io_factory, 'slot', None) is None:
+				raise TypeError("io_factory:%r does not support slots." % self.io_factory)
+			# Filling the slots of the calling template would differ from
+			# filling the slots of this template.
+			self.inline_def = None
+		
+		# Compile calls returning None as plain statements.
+		mark_none_calls(func_ast.body, self.none_calls, func_globals, self.optimizations)
+		
+		# Collapse insignificant whitespace in literals.
+		if self.compact:
+			compact_literals(func_ast.body, self.compact, self.optimizations)
+		
+		# Precompile literal format strings.
+		use_write_pieces = hasattr(self.io_factory, 'write_pieces')
+		use_write_pieces = precompile_formats(func_ast.body, use_write_pieces, enc_vars, self.optimizations) and use_write_pieces
+		
+		io_kw = dict(self.io_kw)
+		
+		# Encode literals at compile time.
+		if self.encoding:
+			encode_literals(func_ast.body, self.encoding, self.optimizations)
+			if isinstance(self.io_factory, type) and issubclass(self.io_factory, ByteArrayIO):
+				io_kw.setdefault('encoding', self.encoding)
+		
+		# Pre-render the static prefix of the output.
+		if self.etag or self.split_prefix:
+			prefix = self.static_prefix = pop_static_prefix(func_ast.body)
+		else:
+			prefix = self.static_prefix = find_static_prefix(func_ast.body)[0]
+		
+		# Hash leading literals at compile time.
+		if self.etag:
+			state = hashlib.new(self.etag)
+			if prefix is not None:
+				state.update(prefix.encode('utf8') if isinstance(prefix, unicode) else prefix)
+				self.optimizations['etag_prefix'] = len(prefix)
+			io_kw.update(prefix=None if self.split_prefix else prefix, state=state)
+		
+		if io_kw != self.io_kw:
+			enc_vars['__pdt_io_kw'] = io_kw
+		
+		# Check the budget at loop back-edges.
+		use_budget = self.max_bytes is not None or self.max_seconds is not None
+		if use_budget:
+			enc_vars['__pdt_budget_factory'] = functools.partial(Budget, max_bytes=self.max_bytes, max_seconds=self.max_seconds, name=self.name)
+			insert_loop_checks(func_ast.body)
+		
+		# Pass template function argument to IO factory.
+		io_param_args = []
+		if self.io_param:
+			if self.io_param not in [getattr(arg, 'id', None) for arg in func_ast.args.args]:
+				raise TypeError("io_param:%r is not an argument of %s()." % (self.io_param, func_ast.name))
+			io_param_args.append(_ast.Name(self.io_param, _ast_load))
+		
 		# Add doc string and create template buffer at beginning of
 		# function.
 		func_body = []
@@ -440,14 +1527,43 @@ class Template(object):
 				# """..."""
 				_ast.Expr(_ast.Str(self.doc))
 			)
+		
+		# Let the tracer call the template function when a tracer is set.
+		enc_vars['__pdt_tracer'] = _tracer
+		func_body += trace_prologue(func_ast, self.key)
+		
+		enc_vars['__pdt_counters'] = self.counters
+		func_body.append(
+			# __pdt_counters.count()
+			_ast.Expr(_ast.Call(_ast.Attribute(_ast.Name('__pdt_counters', _ast_load), 'count', _ast_load), [], [], None, None))
+		)
+		func_body.append(
+			# __pdt_buff = __pdt_io_factory([io_param,] *__pdt_io_args, **__pdt_io_kw)
+			_ast.Assign([_ast.Name('__pdt_buff', _ast_store)], _ast.Call(_ast.Name('__pdt_io_factory', _ast_load), io_param_args, [], _ast.Name('__pdt_io_args', _ast_load), _ast.Name('__pdt_io_kw', _ast_load)))
+		)
+		writer = '__pdt_buff'
+		if use_budget:
+			func_body.append(
+				# __pdt_budget = __pdt_budget_factory(__pdt_buff)
+				_ast.Assign([_ast.Name('__pdt_budget', _ast_store)], _ast.Call(_ast.Name('__pdt_budget_factory', _ast_load), [_ast.Name('__pdt_buff', _ast_load)], [], None, None))
+			)
+			writer = '__pdt_budget'
 		func_body += [
-			# __pdt_buff = __pdt_io_factory(*__pdt_io_args, **__pdt_io_kw)
-			_ast.Assign([_ast.Name('__pdt_buff', _ast_store)], _ast.Call(_ast.Name('__pdt_io_factory', _ast_load), [], [], _ast.Name('__pdt_io_args', _ast_load), _ast.Name('__pdt_io_kw', _ast_load))),
 			# __pdt_write = __pdt_buff.write
-			_ast.Assign([_ast.Name('__pdt_write', _ast_store)], _ast.Attribute(_ast.Name('__pdt_buff', _ast_load), 'write', _ast_load)),
+			_ast.Assign([_ast.Name('__pdt_write', _ast_store)], _ast.Attribute(_ast.Name(writer, _ast_load), 'write', _ast_load)),
 			# __pdt_getvalue = __pdt_buff.getvalue
 			_ast.Assign([_ast.Name('__pdt_getvalue', _ast_store)], _ast.Attribute(_ast.Name('__pdt_buff', _ast_load), 'getvalue', _ast_load))
 		]
+		if use_write_pieces:
+			func_body.append(
+				# __pdt_write_pieces = __pdt_buff.write_pieces
+				_ast.Assign([_ast.Name('__pdt_write_pieces', _ast_store)], _ast.Attribute(_ast.Name(writer, _ast_load), 'write_pieces', _ast_load))
+			)
+		if use_budget:
+			func_body.append(
+				# __pdt_check = __pdt_budget.check
+				_ast.Assign([_ast.Name('__pdt_check', _ast_store)], _ast.Attribute(_ast.Name('__pdt_budget', _ast_load), 'check', _ast_load))
+			)
 
 		# Wrap expressions to write to buffer.
 		node_lists = [func_ast.body]
@@ -455,8 +1571,16 @@ class Template(object):
 			nodes = node_lists.pop()
 			for i, node in enumerate(nodes):
 				if isinstance(node, _ast.Expr):
+					if getattr(node, 'pdt_silent', False):
+						# Calls returning None are not written.
+						continue
 					# expr -> __pdt_write(expr)
-					nodes[i] = _ast.Expr(_ast.Call(_ast.Name('__pdt_write', _ast_load), [node.value], [], None, None))
+					# .. NOTE: The new nodes need the location of the expression.
+					#    Otherwise, they get the location of the function def and
+					#    the line numbers of the code jump backward which the line
+					#    number table cannot represent.
+					write = _ast.Call(ast.copy_location(_ast.Name('__pdt_write', _ast_load), node.value), [node.value], [], None, None)
+					nodes[i] = ast.copy_location(_ast.Expr(ast.copy_location(write, node.value)), node)
 				elif isinstance(node, _ast.Return):
 					if not node.value:
 						# return -> return __pdt_getvalue()
@@ -472,23 +1596,33 @@ class Template(object):
 				elif isinstance(node, _ast.Yield):
 					raise TypeError("Generator functions are not supported.")
 		
-		func_body += func_ast.body
-		
-		# Return buffer at end of function.
-		func_body.append(
+		# Return buffer at end of function. This is located on the last line
+		# of the function so that the line numbers do not jump backward.
+		last_line = max(getattr(node, 'lineno', 0) for node in ast.walk(func_ast))
+		func_ast.body.append(
 			# return __pdt_getvalue()
-			_ast.Return(_ast.Call(_ast.Name('__pdt_getvalue', _ast_load), [], [], None, None))
+			_ast.Return(_ast.Call(_ast.Name('__pdt_getvalue', _ast_load), [], [], None, None), lineno=last_line, col_offset=0)
 		)
 		
-		func_ast.body = func_body
+		func_ast.body = func_body + func_ast.body
+		
+		# Keep the closure of the compiled template function being
+		# recompiled where it is unchanged so that its code can be swapped.
+		if func is self.compiled_func:
+			reuse_closure(func, enc_vars)
 		
-		# XXX
-		'''
-		import sys
-		sys.path.append("../dev")
-		from astpp import dump
-		print "LINENO", lineno
-		'''
+		# def __pdt_enc_func(...):
+		mod_ast.body[0] = _ast.FunctionDef(enc_name, _ast.arguments([
+			_ast.Name(enc_var, _ast_param) for enc_var in sorted(enc_vars)
+		], None, None, []), [
+			# def func(...):
+			#   ...
+			func_ast,
+			# __pdt_func = func
+			_ast.Assign([_ast.Name('__pdt_func', _ast_store)], _ast.Name(func.__name__, _ast_load)),
+			# return func
+			_ast.Return(_ast.Name(func.__name__, _ast_load))
+		], [])
 		
 		# Generate line and column information for modified AST.
 		ast.fix_missing_locations(mod_ast)
@@ -496,18 +1630,34 @@ class Template(object):
 		# Fix line numbers.
 		ast.increment_lineno(mod_ast, lineno - 1)
 		
-		# XXX
-		'''
-		print "%s()" % func.__name__
-		print dump(mod_ast, True, True, ' ')
-		'''
-		
 		# Compile template function.
-		exec compile(mod_ast, func_file, 'exec') in func_globals
+		mod_code = compile(mod_ast, func_file, 'exec')
+		
+		# Create the enclosing function directly from its code object
+		# instead of executing the module code. This way the template
+		# function globals are never modified so templates can be compiled
+		# concurrently from several threads.
+		enc_code = find_code(mod_code, enc_name)
+		enc_func = types.FunctionType(enc_code, func_globals, enc_name)
 		
 		# Store compiled template function.
-		self.func = func_globals[enc_name](**enc_vars)
-		del func_globals[enc_name]
+		compiled_func = enc_func(**enc_vars)
+		if artifacts is not None:
+			artifacts['ast'] = mod_ast
+			artifacts['code'] = compiled_func.__code__
+			return compiled_func
+		compiled_func.__pdt_template__ = self
+		self.compiled_func = compiled_func
+		self.compile_time = time.time() - start_time
+		self.line_map = tuple(dis.findlinestarts(compiled_func.__code__))
+		_template_codes[compiled_func.__code__] = weakref.ref(self)
+		
+		# Release the original template function so that neither it nor its
+		# code object are retained.
+		self.orig_func = None
+		if self.lazy:
+			self.func.__dict__.pop('__wrapped__', None)
+		return compiled_func
 		
 
 class ListIO(object):
@@ -516,7 +1666,7 @@ class ListIO(object):
 	class to create ``file``-like buffer objects. 
 	"""
 	
-	__slots__ = ['buff', 'is_unicode']
+	__slots__ = ['buff', 'is_unicode', 'slots']
 	
 	def __init__(self):
 		"""
@@ -534,6 +1684,14 @@ class ListIO(object):
 		(``True``), or ``str`` (``False``) data.
 		"""
 		
+		self.slots = None
+		"""
+		*slots* (``dict``) maps the name of each slot to a ``list``
+		containing its value followed by the indices of its positions in
+		*buff*. Deferred results are keyed by the index of their position
+		(``int``) instead of a name. This is ``None`` until a slot is used.
+		"""
+		
 	def write(self, data):
 		"""
 		Writes the data to the buffer.
@@ -543,10 +1701,17 @@ class ListIO(object):
 		if data is None:
 			return
 		
-		# Convert data to string.
+		# Convert data to string. Bytes-like objects are buffered by
+		# reference and only copied when the buffer is joined.
 		if self.is_unicode is None:
 			if isinstance(data, basestring):
 				self.is_unicode = isinstance(data, unicode)
+			elif isinstance(data, Chunks):
+				self.is_unicode = data.is_unicode
+				self.buff.extend(data.chunks)
+				return
+			elif isinstance(data, _bytes_like):
+				self.is_unicode = False
 			elif hasattr(data, '__unicode__'):
 				self.is_unicode = True
 				data = unicode(data)
@@ -554,20 +1719,3809 @@ class ListIO(object):
 				self.is_unicode = False
 				data = str(data)
 		elif self.is_unicode:
-			data = unicode(data)
-		else:
-			data = str(data)
+			if not isinstance(data, unicode):
+				if isinstance(data, Chunks):
+					self.buff.extend(data.chunks if data.is_unicode else [unicode(as_buffer(chunk)) for chunk in data.chunks])
+					return
+				data = unicode(as_buffer(data)) if isinstance(data, _bytes_like) else unicode(data)
+		elif not isinstance(data, str):
+			if isinstance(data, Chunks):
+				self.buff.extend(map(str, data.chunks) if data.is_unicode else data.chunks)
+				return
+			elif not isinstance(data, _bytes_like):
+				data = str(data)
 			
 		# Buffer string.
 		self.buff.append(data)
+	
+	def write_pieces(self, pieces):
+		"""
+		Writes the sequence of data to the buffer. This is used to write the
+		pieces of precompiled format strings. Unlike *write()*, ``None`` is
+		written as "None" the way it would be formatted.
+		
+		*pieces* (``sequence``) contains the data to write.
+		"""
+		if self.is_unicode is None:
+			self.is_unicode = any(isinstance(data, unicode) for data in pieces)
+		self.buff.extend(map(unicode if self.is_unicode else str, pieces))
+	
+	def write_sized(self, data):
+		"""
+		Writes the data to the buffer. This is used by ``Budget`` to size
+		the data which is not a string when it is converted.
+		
+		*data* (**mixed**) is the data to write.
+		
+		Returns the size of the data written (``int``).
+		"""
+		start = len(self.buff)
+		self.write(data)
+		return sum(map(len, self.buff[start:]))
+	
+	def write_pieces_sized(self, pieces):
+		"""
+		Writes the sequence of data to the buffer. This is used by
+		``Budget`` to size the pieces when they are converted.
+		
+		*pieces* (``sequence``) contains the data to write.
+		
+		Returns the size of the data written (``int``).
+		"""
+		start = len(self.buff)
+		self.write_pieces(pieces)
+		return sum(map(len, self.buff[start:]))
+	
+	def slot(self, name):
+		"""
+		Reserves a position in the buffer for the value of a slot. The
+		position is resolved when the contents of the buffer are gotten.
+		
+		*name* (``str``) is the name of the slot.
+		"""
+		if self.slots is None:
+			self.slots = {}
+		self.slots.setdefault(name, [None]).append(len(self.buff))
+		self.buff.append('')
+	
+	def fill(self, name, value):
+		"""
+		Sets the value of a slot. This can be called before or after the
+		positions of the slot are reserved.
+		
+		*name* (``str``) is the name of the slot.
+		
+		*value* (**mixed**) is the value of the slot.
+		"""
+		if self.slots is None:
+			self.slots = {}
+		self.slots.setdefault(name, [None])[0] = value
+	
+	def defer(self, future):
+		"""
+		Reserves a position in the buffer for the result of a future. The
+		result is waited for when the contents of the buffer are gotten so
+		that several futures can run concurrently while the rest of the
+		output is written.
+		
+		*future* (**future**) is the future whose result to write (e.g., a
+		``concurrent.futures.Future``). It must implement *result()*.
+		"""
+		if self.slots is None:
+			self.slots = {}
+		self.slots[len(self.buff)] = [future, len(self.buff)]
+		self.buff.append('')
+	
+	def resolve_slots(self):
+		"""
+		Replaces the reserved positions of the slots with their values.
+		Slots which were not filled are left empty. The results of deferred
+		futures are waited for in the order they were written.
+		"""
+		for key in sorted(self.slots):
+			entry = self.slots[key]
+			if isinstance(key, int):
+				entry[0] = entry[0].result()
+			if isinstance(entry[0], Chunks):
+				entry[0] = entry[0].getvalue()
+		if self.is_unicode is None:
+			self.is_unicode = any(isinstance(entry[0], unicode) or hasattr(entry[0], '__unicode__') for entry in self.slots.itervalues())
+		for entry in self.slots.itervalues():
+			value = entry[0]
+			if value is None:
+				continue
+			elif self.is_unicode:
+				value = unicode(as_buffer(value)) if isinstance(value, _bytes_like) else unicode(value)
+			elif not isinstance(value, (str, _bytes_like)):
+				value = str(value)
+			for i in entry[1:]:
+				self.buff[i] = value
+		self.slots = None
 			
 	def getvalue(self):
 		"""
 		Gets the entire contents of the buffer.
 		
-		Returns the buffer's contents (``str`` or ``unicode``).
+		Returns the buffer's contents (``str`` or ``unicode``, or
+		``bytearray`` if it contains bytes-like objects).
+		"""
+		if self.slots:
+			self.resolve_slots()
+		try:
+			return ''.join(self.buff)
+		except TypeError:
+			# The buffer contains bytes-like objects.
+			return join_bytes(self.buff)
+
+
+class ByteArrayIO(object):
+	"""
+	The ``ByteArrayIO`` class is a buffer which encodes the data into a
+	single growing ``bytearray`` which is returned without being joined.
+	"""
+	
+	__slots__ = ['buff', 'encoding']
+	
+	def __init__(self, encoding='utf8'):
+		"""
+		Initializes a ``ByteArrayIO`` instance.
+		
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		Default is "utf8".
+		"""
+		
+		self.buff = bytearray()
+		"""
+		*buff* (``bytearray``) is the internal buffer.
+		"""
+		
+		self.encoding = encoding
+		"""
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		"""
+	
+	def write(self, data):
+		"""
+		Writes the data to the buffer.
+		
+		*data* (**mixed**) is the data to write. ``str`` data is assumed to
+		already be encoded.
+		"""
+		if data is None:
+			return
+		elif isinstance(data, str):
+			self.buff += data
+		elif isinstance(data, Chunks):
+			for data in data.chunks:
+				self.buff += data if isinstance(data, str) else encode_data(data, self.encoding)
+		else:
+			self.buff += encode_data(data, self.encoding)
+	
+	def write_pieces(self, pieces):
+		"""
+		Writes the sequence of data to the buffer.
+		
+		*pieces* (``sequence``) contains the data to write.
+		"""
+		for data in pieces:
+			self.buff += data if isinstance(data, str) else encode_data(data, self.encoding)
+	
+	def write_sized(self, data):
+		"""
+		Writes the data to the buffer. See ``ListIO.write_sized()``.
+		
+		*data* (**mixed**) is the data to write.
+		
+		Returns the size of the encoded data (``int``).
+		"""
+		start = len(self.buff)
+		self.write(data)
+		return len(self.buff) - start
+	
+	def write_pieces_sized(self, pieces):
+		"""
+		Writes the sequence of data to the buffer. See
+		``ListIO.write_pieces_sized()``.
+		
+		*pieces* (``sequence``) contains the data to write.
+		
+		Returns the size of the encoded data (``int``).
+		"""
+		start = len(self.buff)
+		self.write_pieces(pieces)
+		return len(self.buff) - start
+	
+	def getvalue(self):
+		"""
+		Gets the entire contents of the buffer.
+		
+		Returns the buffer's contents (``bytearray``).
+		"""
+		return self.buff
+
+
+class Chunks(object):
+	"""
+	The ``Chunks`` class is the unjoined output of a template. It can be
+	written chunk by chunk (e.g., with ``file.writelines()`` or a
+	scatter/gather write) or spliced into the buffer of another template
+	without being joined.
+	"""
+	
+	__slots__ = ['chunks', 'is_unicode', 'size']
+	
+	def __init__(self, chunks, is_unicode=False):
+		"""
+		Initializes a ``Chunks`` instance.
+		
+		*chunks* (``list``) contains the chunks (``str`` or ``unicode``).
+		
+		*is_unicode* (``bool``) is whether the chunks are ``unicode``
+		(``True``), or ``str`` (``False``). Default is ``False``.
 		"""
-		return ''.join(self.buff)
+		
+		self.chunks = chunks
+		"""
+		*chunks* (``list``) contains the chunks.
+		"""
+		
+		self.is_unicode = bool(is_unicode)
+		"""
+		*is_unicode* (``bool``) is whether the chunks are ``unicode``.
+		"""
+		
+		self.size = None
+		"""
+		*size* (``int``) caches the total length of the chunks.
+		"""
+	
+	def __iter__(self):
+		return iter(self.chunks)
+	
+	def __len__(self):
+		if self.size is None:
+			self.size = sum(map(len, self.chunks))
+		return self.size
+	
+	def __repr__(self):
+		return "%s.%s(<%d chunks>)" % (self.__class__.__module__, self.__class__.__name__, len(self.chunks))
+	
+	def __str__(self):
+		return str(self.getvalue())
+	
+	def __unicode__(self):
+		return unicode(self.getvalue())
+	
+	def getvalue(self):
+		"""
+		Joins the chunks.
+		
+		Returns the joined chunks (``str`` or ``unicode``, or ``bytearray``
+		if they contain bytes-like objects).
+		"""
+		if self.is_unicode:
+			return u''.join(self.chunks)
+		try:
+			return ''.join(self.chunks)
+		except TypeError:
+			# The chunks contain bytes-like objects.
+			return join_bytes(self.chunks)
+	
+	def to_bytes(self, encoding='utf8'):
+		"""
+		Joins the chunks into bytes.
+		
+		*encoding* (``str``) is the encoding used for ``unicode`` chunks.
+		Default is "utf8".
+		
+		Returns the joined chunks (``str``, or ``bytearray`` if they contain
+		bytes-like objects).
+		"""
+		if self.is_unicode:
+			return self.getvalue().encode(encoding)
+		return self.getvalue()
+
+
+class ChunksIO(ListIO):
+	"""
+	The ``ChunksIO`` class is a ``ListIO`` buffer whose contents are
+	returned as ``Chunks`` instead of being joined.
+	"""
+	
+	__slots__ = []
+	
+	def getvalue(self):
+		"""
+		Gets the entire contents of the buffer.
+		
+		Returns the buffer's contents (``Chunks``).
+		"""
+		if self.slots:
+			self.resolve_slots()
+		return Chunks(self.buff, self.is_unicode)
+
+
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+"""
+*SPOOL_MAX_SIZE* (``int``) is the default size of the data after which
+``SpooledListIO`` spills it to a temporary file.
+"""
+
+ETAG_ALGORITHM = 'blake2b' if 'blake2b' in getattr(hashlib, 'algorithms_available', ()) else 'sha1'
+"""
+*ETAG_ALGORITHM* (``str``) is the name of the default hash algorithm
+used to compute ETags.
+"""
+
+
+class ETagIO(ListIO):
+	"""
+	The ``ETagIO`` class is a ``ListIO`` buffer which hashes the data as it
+	is written so that the ETag of the output is available without hashing
+	the output afterward.
+	"""
+	
+	__slots__ = ['hash']
+	
+	# The data is hashed as it is written so the positions of slots cannot
+	# be resolved afterward.
+	slot = fill = defer = None
+	
+	def __init__(self, algorithm=None, prefix=None, state=None):
+		"""
+		Initializes an ``ETagIO`` instance.
+		
+		*algorithm* (``str``) is the name of the ``hashlib`` algorithm to
+		use. Default is ``None`` for ``ETAG_ALGORITHM``.
+		
+		*prefix* (``str`` or ``unicode``) is the static prefix of the output
+		which has already been hashed into *state*. Default is ``None``.
+		
+		*state* (**hash**) is the hash object to copy the initial hash state
+		from. Default is ``None`` to start a new hash.
+		"""
+		super(ETagIO, self).__init__()
+		
+		self.hash = state.copy() if state is not None else hashlib.new(algorithm or ETAG_ALGORITHM)
+		"""
+		*hash* (**hash**) is the hash of the data written.
+		"""
+		
+		if prefix is not None:
+			self.buff.append(prefix)
+			self.is_unicode = isinstance(prefix, unicode)
+	
+	@property
+	def etag(self):
+		"""
+		*etag* (``str``) is the ETag (hex digest) of the data written.
+		"""
+		return self.hash.hexdigest()
+	
+	def write(self, data):
+		"""
+		Writes the data to the buffer.
+		
+		*data* (**mixed**) is the data to write.
+		"""
+		if data is None:
+			return
+		
+		start = len(self.buff)
+		ListIO.write(self, data)
+		for data in self.buff[start:]:
+			self.hash.update(data.encode('utf8') if self.is_unicode else data)
+	
+	def write_pieces(self, pieces):
+		"""
+		Writes the sequence of data to the buffer.
+		
+		*pieces* (``sequence``) contains the data to write.
+		"""
+		start = len(self.buff)
+		ListIO.write_pieces(self, pieces)
+		for data in self.buff[start:]:
+			self.hash.update(data.encode('utf8') if self.is_unicode else data)
+	
+	def getvalue(self):
+		"""
+		Gets the entire contents of the buffer and its ETag.
+		
+		Returns the buffer's contents (``str`` or ``unicode``, or
+		``bytearray`` if it contains bytes-like objects), and its ETag
+		(``str``).
+		"""
+		try:
+			return ''.join(self.buff), self.hash.hexdigest()
+		except TypeError:
+			# The buffer contains bytes-like objects.
+			return join_bytes(self.buff), self.hash.hexdigest()
+
+
+class SpooledListIO(ListIO):
+	"""
+	The ``SpooledListIO`` class is a ``ListIO`` buffer which keeps the data
+	in memory until it exceeds a size threshold, and then spills it to a
+	temporary file so that very large outputs never have to be held (or
+	joined) in memory.
+	"""
+	
+	__slots__ = ['encoding', 'file', 'max_size', 'mmap', 'size', 'tempdir']
+	
+	# The data can be spilled to the temporary file so the positions of
+	# slots cannot be resolved afterward.
+	slot = fill = defer = None
+	
+	def __init__(self, max_size=SPOOL_MAX_SIZE, encoding='utf8', mmap=False, tempdir=None):
+		"""
+		Initializes a ``SpooledListIO`` instance.
+		
+		*max_size* (``int``) is the size of the data (in characters) after
+		which it is spilled to a temporary file. Default is
+		``SPOOL_MAX_SIZE``.
+		
+		*encoding* (``str``) is the encoding used to write ``unicode`` data
+		to the temporary file. Default is "utf8".
+		
+		*mmap* (``bool``) is whether the temporary file should be returned
+		memory-mapped. Default is ``False``.
+		
+		*tempdir* (``str``) is the directory to create the temporary file
+		in. Default is ``None`` for the system default.
+		"""
+		super(SpooledListIO, self).__init__()
+		
+		self.encoding = encoding
+		"""
+		*encoding* (``str``) is the encoding used to write ``unicode`` data
+		to the temporary file.
+		"""
+		
+		self.file = None
+		"""
+		*file* (``file``) is the temporary file once the data has been
+		spilled.
+		"""
+		
+		self.max_size = max_size
+		"""
+		*max_size* (``int``) is the size of the data after which it is
+		spilled.
+		"""
+		
+		self.mmap = mmap
+		"""
+		*mmap* (``bool``) is whether the temporary file is returned
+		memory-mapped.
+		"""
+		
+		self.size = 0
+		"""
+		*size* (``int``) is the size of the data held in memory.
+		"""
+		
+		self.tempdir = tempdir
+		"""
+		*tempdir* (``str``) is the directory to create the temporary file
+		in.
+		"""
+	
+	def spill(self):
+		"""
+		Spills the data held in memory to a temporary file.
+		"""
+		self.file = tempfile.TemporaryFile(dir=self.tempdir)
+		self.file.writelines(self.encode(data) for data in self.buff)
+		del self.buff[:]
+		self.size = 0
+	
+	def encode(self, data):
+		"""
+		Encodes the data for the temporary file.
+		
+		*data* (``str``, ``unicode`` or **bytes-like**) is the data.
+		
+		Returns the encoded data (``str`` or ``buffer``).
+		"""
+		if isinstance(data, unicode):
+			return data.encode(self.encoding)
+		return as_buffer(data)
+	
+	def write(self, data):
+		"""
+		Writes the data to the buffer.
+		
+		*data* (**mixed**) is the data to write.
+		"""
+		if data is None:
+			return
+		
+		start = len(self.buff)
+		ListIO.write(self, data)
+		self.flush_from(start)
+	
+	def write_pieces(self, pieces):
+		"""
+		Writes the sequence of data to the buffer.
+		
+		*pieces* (``sequence``) contains the data to write.
+		"""
+		start = len(self.buff)
+		ListIO.write_pieces(self, pieces)
+		self.flush_from(start)
+	
+	def write_sized(self, data):
+		"""
+		Writes the data to the buffer. See ``ListIO.write_sized()``.
+		
+		*data* (**mixed**) is the data to write.
+		
+		Returns the size of the data written (``int``).
+		"""
+		start = len(self.buff)
+		ListIO.write(self, data)
+		size = sum(map(len, self.buff[start:]))
+		self.flush_from(start)
+		return size
+	
+	def write_pieces_sized(self, pieces):
+		"""
+		Writes the sequence of data to the buffer. See
+		``ListIO.write_pieces_sized()``.
+		
+		*pieces* (``sequence``) contains the data to write.
+		
+		Returns the size of the data written (``int``).
+		"""
+		start = len(self.buff)
+		ListIO.write_pieces(self, pieces)
+		size = sum(map(len, self.buff[start:]))
+		self.flush_from(start)
+		return size
+	
+	def flush_from(self, start):
+		"""
+		Writes the data buffered since *start* to the temporary file if the
+		data has been spilled, or spills it once it exceeds *max_size*.
+		
+		*start* (``int``) is the index of the first new item in the buffer.
+		"""
+		if self.file is not None:
+			self.file.writelines([self.encode(data) for data in self.buff])
+			del self.buff[:]
+		else:
+			self.size += sum(map(len, self.buff[start:]))
+			if self.size > self.max_size:
+				self.spill()
+		
+	def getvalue(self):
+		"""
+		Gets the entire contents of the buffer.
+		
+		Returns the buffer's contents (``str`` or ``unicode``, or
+		``bytearray`` if it contains bytes-like objects) if they were held in
+		memory. Otherwise, returns the temporary file (``file``)
+		positioned at its start, or a read-only memory-map of it
+		(``mmap.mmap``) if *mmap* is ``True``. The temporary file contains
+		the encoded contents.
+		"""
+		if self.file is None:
+			try:
+				return ''.join(self.buff)
+			except TypeError:
+				# The buffer contains bytes-like objects.
+				return join_bytes(self.buff)
+		
+		self.file.flush()
+		if self.mmap:
+			return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.file.seek(0)
+		return self.file
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+"""
+*GZIP_WBITS* (``int``) is the window bits for ``zlib`` to write the gzip
+format.
+"""
+
+
+class GzipIO(object):
+	"""
+	The ``GzipIO`` class is a buffer which compresses the data
+	incrementally as it is written so that the uncompressed output is
+	never held in memory.
+	"""
+	
+	__slots__ = ['chunks', 'compressor', 'encoding', 'flush_size', 'pending', 'sink']
+	
+	def __init__(self, sink=None, level=6, flush_size=None, encoding='utf8', wbits=GZIP_WBITS):
+		"""
+		Initializes a ``GzipIO`` instance.
+		
+		*sink* (**callable**) optionally receives each compressed chunk
+		(``str``) as soon as it is available (e.g., the ``write()`` callable
+		of a WSGI response). Default is ``None`` to buffer the compressed
+		chunks.
+		
+		*level* (``int``) is the compression level from 0 to 9. Default is
+		6.
+		
+		*flush_size* (``int``) is the number of uncompressed bytes after
+		which the compressor is flushed so that a compressed chunk is
+		produced. Default is ``None`` to let ``zlib`` decide when to produce
+		compressed chunks.
+		
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		Default is "utf8".
+		
+		*wbits* (``int``) is the window bits passed to ``zlib``. Default is
+		``GZIP_WBITS`` for the gzip format. Use ``zlib.MAX_WBITS`` for the
+		zlib format, or ``-zlib.MAX_WBITS`` for raw deflate.
+		"""
+		
+		self.chunks = []
+		"""
+		*chunks* (``list``) contains the compressed chunks when there is no
+		*sink*.
+		"""
+		
+		self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+		"""
+		*compressor* (**zlib.Compress**) is the compressor.
+		"""
+		
+		self.encoding = encoding
+		"""
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		"""
+		
+		self.flush_size = flush_size
+		"""
+		*flush_size* (``int``) is the number of uncompressed bytes after
+		which the compressor is flushed.
+		"""
+		
+		self.pending = 0
+		"""
+		*pending* (``int``) is the number of uncompressed bytes written since
+		the last flush.
+		"""
+		
+		self.sink = sink
+		"""
+		*sink* (**callable**) receives each compressed chunk.
+		"""
+		
+	def emit(self, chunk):
+		"""
+		Outputs a compressed chunk.
+		
+		*chunk* (``str``) is the compressed chunk.
+		"""
+		if chunk:
+			if self.sink is not None:
+				self.sink(chunk)
+			else:
+				self.chunks.append(chunk)
+		
+	def write(self, data):
+		"""
+		Writes the data to the buffer.
+		
+		*data* (**mixed**) is the data to write.
+		"""
+		if data is None:
+			return
+		
+		data = encode_data(data, self.encoding)
+		self.emit(self.compressor.compress(as_buffer(data)))
+		
+		if self.flush_size is not None:
+			self.pending += len(data)
+			if self.pending >= self.flush_size:
+				self.pending = 0
+				self.emit(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+		
+	def write_sized(self, data):
+		"""
+		Writes the data to the buffer. See ``ListIO.write_sized()``.
+		
+		*data* (**mixed**) is the data to write.
+		
+		Returns the size of the encoded data (``int``).
+		"""
+		data = encode_data(data, self.encoding)
+		self.write(data)
+		return len(data)
+	
+	def getvalue(self):
+		"""
+		Finishes compressing the buffer.
+		
+		Returns the compressed contents of the buffer (``str``), or ``None``
+		if the compressed chunks were output to *sink*.
+		"""
+		self.emit(self.compressor.flush())
+		if self.sink is not None:
+			return None
+		return ''.join(self.chunks)
+
+
+STREAM_MAX_BYTES = 64 * 1024
+"""
+*STREAM_MAX_BYTES* (``int``) is the default number of bytes after which
+``StreamIO`` flushes its batch.
+"""
+
+try:
+	STREAM_MAX_CHUNKS = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	STREAM_MAX_CHUNKS = 1024
+"""
+*STREAM_MAX_CHUNKS* (``int``) is the default number of chunks after
+which ``StreamIO`` flushes its batch. This is the system limit for
+``os.writev()``.
+"""
+
+
+class StreamIO(object):
+	"""
+	The ``StreamIO`` class is a buffer which writes the data to a file,
+	socket or pipe while the template runs. Small chunks are batched and
+	flushed together with ``os.writev()`` (when available) once the batch
+	reaches a size or count threshold.
+	"""
+	
+	__slots__ = ['batch', 'batch_size', 'encoding', 'fd', 'max_bytes', 'max_chunks', 'written']
+	
+	def __init__(self, target, max_bytes=STREAM_MAX_BYTES, max_chunks=STREAM_MAX_CHUNKS, encoding='utf8'):
+		"""
+		Initializes a ``StreamIO`` instance.
+		
+		*target* (``int`` or ``file``) is the file descriptor, or the file,
+		socket or pipe (any object implementing *fileno()*) to write to. If
+		*target* implements *flush()*, it is flushed first so previously
+		buffered data is not reordered.
+		
+		*max_bytes* (``int``) is the number of bytes after which the batch
+		is flushed. Default is ``STREAM_MAX_BYTES``.
+		
+		*max_chunks* (``int``) is the number of chunks after which the batch
+		is flushed. Default is ``STREAM_MAX_CHUNKS``.
+		
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		Default is "utf8".
+		"""
+		if not isinstance(target, (int, long)):
+			if hasattr(target, 'flush'):
+				target.flush()
+			target = target.fileno()
+		
+		self.batch = []
+		"""
+		*batch* (``list``) contains the chunks which have not been flushed.
+		"""
+		
+		self.batch_size = 0
+		"""
+		*batch_size* (``int``) is the number of bytes in *batch*.
+		"""
+		
+		self.encoding = encoding
+		"""
+		*encoding* (``str``) is the encoding used for ``unicode`` data.
+		"""
+		
+		self.fd = target
+		"""
+		*fd* (``int``) is the file descriptor written to.
+		"""
+		
+		self.max_bytes = max_bytes
+		"""
+		*max_bytes* (``int``) is the number of bytes after which the batch is
+		flushed.
+		"""
+		
+		self.max_chunks = max_chunks
+		"""
+		*max_chunks* (``int``) is the number of chunks after which the batch
+		is flushed.
+		"""
+		
+		self.written = 0
+		"""
+		*written* (``int``) is the number of bytes written to *fd*.
+		"""
+	
+	def flush(self):
+		"""
+		Writes the batch to the file descriptor.
+		"""
+		batch = self.batch
+		if not batch:
+			return
+		
+		size = self.batch_size
+		self.batch = []
+		self.batch_size = 0
+		
+		if len(batch) > 1 and hasattr(os, 'writev'):
+			written = os.writev(self.fd, batch)
+			if written == size:
+				self.written += size
+				return
+			data = memoryview(join_bytes(batch))[written:]
+			self.written += written
+		elif len(batch) == 1 and not isinstance(batch[0], buffer):
+			# Write a single chunk without copying it.
+			data = memoryview(batch[0])
+		else:
+			data = memoryview(join_bytes(batch))
+		
+		# Write remaining data.
+		while data:
+			written = os.write(self.fd, data)
+			data = data[written:]
+			self.written += written
+	
+	def write(self, data):
+		"""
+		Writes the data to the buffer.
+		
+		*data* (**mixed**) is the data to write.
+		"""
+		if data is None:
+			return
+		
+		data = encode_data(data, self.encoding)
+		self.batch.append(data)
+		self.batch_size += len(data)
+		if self.batch_size >= self.max_bytes or len(self.batch) >= self.max_chunks:
+			self.flush()
+		
+	def write_sized(self, data):
+		"""
+		Writes the data to the buffer. See ``ListIO.write_sized()``.
+		
+		*data* (**mixed**) is the data to write.
+		
+		Returns the size of the encoded data (``int``).
+		"""
+		data = encode_data(data, self.encoding)
+		self.write(data)
+		return len(data)
+	
+	def getvalue(self):
+		"""
+		Flushes the remaining batch.
+		
+		Returns ``None`` because the contents were written to the file
+		descriptor.
+		"""
+		self.flush()
+		return None
+
+
+class BudgetExceeded(Exception):
+	"""
+	The ``BudgetExceeded`` exception is raised when the output of a
+	template or the time spent rendering it exceeds its budget.
+	"""
+	
+	def __init__(self, limit, value, maximum, name=None):
+		"""
+		Initializes a ``BudgetExceeded`` instance.
+		
+		*limit* (``str``) is the name of the limit exceeded: "max_bytes" or
+		"max_seconds".
+		
+		*value* (``int`` or ``float``) is the value which exceeded the
+		limit.
+		
+		*maximum* (``int`` or ``float``) is the limit.
+		
+		*name* (``str``) is the name of the template. Default is ``None``.
+		"""
+		super(BudgetExceeded, self).__init__("%s exceeded %s:%r with %r." % (name or "Template", limit, maximum, value))
+		
+		self.limit = limit
+		"""
+		*limit* (``str``) is the name of the limit exceeded.
+		"""
+		
+		self.value = value
+		"""
+		*value* (``int`` or ``float``) is the value which exceeded the
+		limit.
+		"""
+		
+		self.maximum = maximum
+		"""
+		*maximum* (``int`` or ``float``) is the limit.
+		"""
+		
+		self.name = name
+		"""
+		*name* (``str``) is the name of the template.
+		"""
+
+
+class Budget(object):
+	"""
+	The ``Budget`` class wraps the buffer of a template call to limit the
+	size of the output and the time spent rendering it. The limits are
+	checked when data is written and at the loop back-edges of the
+	template.
+	"""
+	
+	__slots__ = ['buff', 'deadline', 'max_bytes', 'max_seconds', 'name', 'size']
+	
+	def __init__(self, buff, max_bytes=None, max_seconds=None, name=None):
+		"""
+		Initializes a ``Budget`` instance.
+		
+		*buff* (**file**) is the buffer to write to.
+		
+		*max_bytes* (``int``) is the maximum size of the output (in
+		characters for ``unicode`` data). Default is ``None`` for no limit.
+		
+		*max_seconds* (``float``) is the maximum number of seconds to
+		render. Default is ``None`` for no limit.
+		
+		*name* (``str``) is the name of the template. Default is ``None``.
+		"""
+		
+		self.buff = buff
+		"""
+		*buff* (**file**) is the buffer to write to.
+		"""
+		
+		self.deadline = time.time() + max_seconds if max_seconds is not None else None
+		"""
+		*deadline* (``float``) is the time after which rendering has to
+		stop.
+		"""
+		
+		self.max_bytes = max_bytes
+		"""
+		*max_bytes* (``int``) is the maximum size of the output.
+		"""
+		
+		self.max_seconds = max_seconds
+		"""
+		*max_seconds* (``float``) is the maximum number of seconds to
+		render.
+		"""
+		
+		self.name = name
+		"""
+		*name* (``str``) is the name of the template.
+		"""
+		
+		self.size = 0
+		"""
+		*size* (``int``) is the size of the data written.
+		"""
+	
+	def check(self):
+		"""
+		Checks whether the budget has been exceeded.
+		
+		Raises ``BudgetExceeded`` if it has.
+		"""
+		if self.max_bytes is not None and self.size > self.max_bytes:
+			raise BudgetExceeded('max_bytes', self.size, self.max_bytes, self.name)
+		if self.deadline is not None:
+			now = time.time()
+			if now > self.deadline:
+				raise BudgetExceeded('max_seconds', now - self.deadline + self.max_seconds, self.max_seconds, self.name)
+	
+	def write(self, data):
+		"""
+		Writes the data to the buffer and checks the budget.
+		
+		*data* (**mixed**) is the data to write.
+		"""
+		if data is None:
+			return
+		elif isinstance(data, (basestring, Chunks) + _bytes_like):
+			self.buff.write(data)
+			self.size += len(data)
+		else:
+			# Only the buffer knows the size of the converted data.
+			write_sized = getattr(self.buff, 'write_sized', None)
+			if write_sized is not None:
+				self.size += write_sized(data)
+			else:
+				self.buff.write(data)
+		self.check()
+	
+	def write_pieces(self, pieces):
+		"""
+		Writes the sequence of data to the buffer and checks the budget.
+		
+		*pieces* (``sequence``) contains the data to write.
+		"""
+		write_sized = getattr(self.buff, 'write_pieces_sized', None)
+		if write_sized is not None:
+			self.size += write_sized(pieces)
+		else:
+			self.buff.write_pieces(pieces)
+			self.size += sum([len(data) for data in pieces if isinstance(data, (basestring, Chunks) + _bytes_like)])
+		self.check()
+
+
+def encode_data(data, encoding):
+	"""
+	Converts the data written to a buffer to bytes.
+	
+	*data* (**mixed**) is the data.
+	
+	*encoding* (``str``) is the encoding used for ``unicode`` data.
+	
+	Returns the bytes (``str`` or **bytes-like**). Bytes-like objects are
+	returned as is.
+	"""
+	if isinstance(data, (str, _bytes_like)):
+		return data
+	elif isinstance(data, Chunks):
+		return data.to_bytes(encoding)
+	elif not isinstance(data, unicode):
+		data = unicode(data) if hasattr(data, '__unicode__') else str(data)
+		if isinstance(data, str):
+			return data
+	return data.encode(encoding)
+
+
+def as_buffer(data):
+	"""
+	Gets a read-only buffer for bytes-like data without copying it if
+	possible.
+	
+	*data* (``str`` or **bytes-like**) is the data.
+	
+	Returns the data (``str`` or ``buffer``). A ``memoryview`` is copied
+	to a ``str``.
+	"""
+	if isinstance(data, bytearray):
+		return buffer(data)
+	elif isinstance(data, memoryview):
+		return data.tobytes()
+	return data
+
+
+def join_bytes(chunks):
+	"""
+	Joins bytes which can contain bytes-like objects. Each chunk is copied
+	once into the joined bytes.
+	
+	*chunks* (``sequence``) contains the bytes (``str`` or
+	**bytes-like**).
+	
+	Returns the joined bytes (``bytearray``).
+	"""
+	joined = bytearray(sum(len(chunk) for chunk in chunks))
+	start = 0
+	for chunk in chunks:
+		end = start + len(chunk)
+		joined[start:end] = chunk
+		start = end
+	return joined
+
+
+def warmup(targets=None, freeze=False, drop_inline=False):
+	"""
+	Compiles every registered template ahead of time. This is meant to
+	be called in a pre-fork master process so that the compiled
+	templates are shared copy-on-write with the forked worker processes
+	instead of being compiled again in each worker.
+	
+	*targets* (**module** or **iterable**) optionally limits the warmed
+	up templates. This can be a module or an iterable of modules,
+	``Template`` instances and template functions. Default is ``None``
+	for every registered template.
+	
+	*freeze* (``bool``) is whether ``gc.freeze()`` should be called
+	afterward so the compiled templates are not touched by the garbage
+	collector in the forked processes. This is ignored if ``gc.freeze()``
+	is not available. Default is ``False``.
+	
+	*drop_inline* (``bool``) is whether the ASTs retained to inline the
+	templates into templates compiled later should be dropped. Templates
+	compiled afterward will call them instead. Default is ``False``.
+	
+	Returns the warmed up templates (``list`` of ``Template``).
+	"""
+	templates = _find_templates(targets)
+	for temp in templates:
+		temp.ensure_compiled()
+	if drop_inline:
+		for temp in templates:
+			temp.inline_def = None
+	
+	# Drop transient compile artifacts.
+	release_sources()
+	gc.collect()
+	
+	if freeze and hasattr(gc, 'freeze'):
+		gc.freeze()
+		
+	return templates
+
+
+def _find_templates(targets):
+	"""
+	Finds the registered templates matching the targets.
+	
+	*targets* (**module** or **iterable**) is a module or an iterable of
+	modules, ``Template`` instances and template functions. If ``None``,
+	every registered template is matched.
+	
+	Returns the matched templates (``list`` of ``Template``).
+	"""
+	templates = _templates.values()
+	if targets is None:
+		return templates
+		
+	if inspect.ismodule(targets):
+		targets = [targets]
+	
+	modules = set()
+	found = []
+	for target in targets:
+		if inspect.ismodule(target):
+			modules.add(target.__name__)
+		elif isinstance(target, Template):
+			found.append(target)
+		elif hasattr(target, '__pdt_template__'):
+			found.append(target.__pdt_template__)
+		else:
+			raise TypeError("target:%r is not a module, template or template function." % target)
+	
+	if modules:
+		found += [temp for temp in templates if temp.func.__module__ in modules]
+	return found
+
+
+def list_templates():
+	"""
+	Lists the registered templates.
+	
+	Returns the templates (``list`` of ``Template``) sorted by key.
+	"""
+	return sorted(_templates.values(), key=lambda temp: temp.key)
+
+
+def lookup(key):
+	"""
+	Looks up a registered template.
+	
+	*key* (``str``) is the key of the template (e.g., "myapp.pages.home").
+	See ``Template.key``.
+	
+	Returns the template (``Template``).
+	
+	Raises ``KeyError`` if no template is registered under *key*.
+	"""
+	temp = _templates.get(key)
+	if temp is None:
+		raise KeyError("No template is registered as %r." % key)
+	return temp
+
+
+def recompile(targets=None):
+	"""
+	Recompiles registered templates from their source files. See
+	``Template.recompile()``.
+	
+	*targets* (**module** or **iterable**) optionally limits the
+	recompiled templates. See ``warmup()``. Default is ``None`` for every
+	registered template.
+	
+	Returns the recompiled templates (``list`` of ``Template``).
+	"""
+	templates = _find_templates(targets)
+	for temp in templates:
+		temp.recompile()
+	return templates
+
+
+def reset_counters(targets=None):
+	"""
+	Resets the render counters of registered templates.
+	
+	*targets* (**module** or **iterable**) optionally limits the reset
+	templates. See ``warmup()``. Default is ``None`` for every registered
+	template.
+	"""
+	for temp in _find_templates(targets):
+		temp.counters.reset()
+
+
+class RenderCounters(object):
+	"""
+	The ``RenderCounters`` class counts the calls of a compiled template
+	function. Each thread counts in its own cell so that rendering never
+	writes to state shared between threads, and the cells are only summed
+	when the counters are read. The cell of a thread which has exited is
+	merged into a shared count.
+	"""
+	
+	__slots__ = ['cells', 'exited', 'local', 'lock']
+	
+	def __init__(self):
+		"""
+		Initializes a ``RenderCounters`` instance.
+		"""
+		
+		self.cells = {}
+		"""
+		*cells* (``dict``) maps the weak reference (``weakref.ref``) to the
+		cell owner of each live thread which has counted to its counter
+		cell (``list`` containing the number of calls).
+		"""
+		
+		self.exited = 0
+		"""
+		*exited* (``int``) is the number of calls counted by the threads
+		which have exited.
+		"""
+		
+		self.local = threading.local()
+		"""
+		*local* (``threading.local``) holds the counter cell and cell owner
+		of the current thread.
+		"""
+		
+		self.lock = threading.RLock()
+		"""
+		*lock* (``threading.RLock``) serializes merging the cells of exited
+		threads with reading them.
+		"""
+	
+	@property
+	def renders(self):
+		"""
+		*renders* (``int``) is the number of calls.
+		"""
+		with self.lock:
+			return self.exited + sum([cell[0] for cell in self.cells.values()])
+	
+	def count(self):
+		"""
+		Counts a call in the cell of the current thread.
+		"""
+		try:
+			self.local.cell[0] += 1
+		except AttributeError:
+			self.add_cell()
+	
+	def add_cell(self):
+		"""
+		Adds the cell of the current thread with its first call counted.
+		The cell is merged when the thread exits and its thread-local
+		owner is released.
+		"""
+		cell = self.local.cell = [1]
+		owner = self.local.owner = _CellOwner()
+		self.cells[weakref.ref(owner, self.merge_cell)] = cell
+	
+	def merge_cell(self, ref):
+		"""
+		Merges the cell of a thread which has exited.
+		
+		*ref* (``weakref.ref``) is the released reference to the cell owner
+		of the thread.
+		"""
+		with self.lock:
+			cell = self.cells.pop(ref, None)
+			if cell is not None:
+				self.exited += cell[0]
+	
+	def reset(self):
+		"""
+		Resets the counters. Calls counted concurrently may not be reset.
+		"""
+		with self.lock:
+			self.exited = 0
+			for cell in self.cells.values():
+				cell[0] = 0
+
+
+class _CellOwner(object):
+	"""
+	The ``_CellOwner`` class is held by a thread-local to detect when the
+	thread exits and its counter cell can be merged.
+	"""
+	
+	__slots__ = ['__weakref__']
+
+
+TemplateInfo = collections.namedtuple('TemplateInfo', ['key', 'options', 'compile_time', 'code_size', 'source_file', 'source_lines', 'renders'])
+"""
+The ``TemplateInfo`` class stores the information about a registered
+template.
+
+*key* (``str``) is the key of the template.
+
+*options* (``dict``) contains the options of the template. See
+``Template.options()``.
+
+*compile_time* (``float``) is the number of seconds it took to compile
+the template, or ``None`` if it is not compiled.
+
+*code_size* (``int``) is the bytes retained by the code of the compiled
+template, or ``None`` if it is not compiled.
+
+*source_file* (``str``) is the path of the source file of the template.
+
+*source_lines* (``tuple``) contains the first and last line numbers of
+the template in its source file.
+
+*renders* (``int``) is the number of calls of the template.
+"""
+
+
+def release_sources():
+	"""
+	Evicts the source files which were loaded into ``linecache`` only to
+	compile templates. This should be called once all templates have
+	been compiled (e.g., after importing them). Source files evicted are
+	loaded again on demand (e.g., to format a traceback).
+	"""
+	while _source_files:
+		linecache.cache.pop(_source_files.pop(), None)
+	_qualnames.clear()
+
+
+def rebind_name(func_globals, qualname, old_func, new_func):
+	"""
+	Rebinds the name of a function defined in a module or class to another
+	function if it is still bound to the function.
+	
+	*func_globals* (``dict``) is the global namespace of the function.
+	
+	*qualname* (``str``) is the qualified name of the function. See
+	``qualify_name()``.
+	
+	*old_func* (``function``) is the function the name should be bound
+	to.
+	
+	*new_func* (``function``) is the function to bind the name to.
+	
+	Returns whether the name was rebound (``bool``).
+	"""
+	path = qualname.split('.')
+	if '<locals>' in path:
+		return False
+	namespace = func_globals
+	for name in path[:-1]:
+		owner = namespace.get(name)
+		if not inspect.isclass(owner):
+			return False
+		namespace = owner.__dict__
+	if namespace.get(path[-1]) is not old_func:
+		return False
+	if namespace is func_globals:
+		func_globals[path[-1]] = new_func
+	else:
+		setattr(owner, path[-1], new_func)
+	return True
+
+
+def reuse_closure(func, enc_vars):
+	"""
+	Reuses the closure values of a compiled template function for the
+	variables passed to the enclosing function which are equal to them.
+	
+	*func* (``function``) is the compiled template function.
+	
+	*enc_vars* (``dict``) contains the variables passed to the enclosing
+	function. Each variable equal to the closure value of the same name is
+	replaced by the closure value.
+	"""
+	for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+		if name in enc_vars and same_value(cell.cell_contents, enc_vars[name]):
+			enc_vars[name] = cell.cell_contents
+
+
+def same_value(a, b):
+	"""
+	Determines whether two closure values of compiled template functions
+	are equal. Values are equal when they are the same object, or plain
+	data, ``functools.partial`` objects or hash objects (e.g., the hash
+	state of an ETag prefix) which are equal.
+	
+	*a* (**mixed**) is a value.
+	
+	*b* (**mixed**) is the other value.
+	
+	Returns whether the values are equal (``bool``).
+	"""
+	if a is b:
+		return True
+	elif type(a) is not type(b):
+		return False
+	elif isinstance(a, (basestring, int, long, float)):
+		return a == b
+	elif isinstance(a, (tuple, list)):
+		return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+	elif isinstance(a, dict):
+		return set(a) == set(b) and all(same_value(a[key], b[key]) for key in a)
+	elif isinstance(a, functools.partial):
+		return a.func is b.func and same_value(a.args, b.args) and same_value(a.keywords or {}, b.keywords or {})
+	elif isinstance(a, _hash_type):
+		return a.name == b.name and a.digest() == b.digest()
+	return False
+
+
+_hash_type = type(hashlib.sha1())
+"""
+*_hash_type* (``type``) is the type of the hash objects of ``hashlib``.
+"""
+
+
+_qualnames = {}
+"""
+*_qualnames* (``dict``) maps the path of each source file whose template
+functions were named to its ``linecache`` state (``tuple``) and the
+qualified name (``str``) of each function by line number (``dict``).
+"""
+
+
+def qualify_name(func):
+	"""
+	Gets the name of a function qualified by the classes and functions it
+	is defined in (e.g., "Page.render" or "build.<locals>.row"). The
+	definitions are found in the parsed source file of the function.
+	
+	*func* (``function``) is the function.
+	
+	Returns the qualified name (``str``).
+	"""
+	temp = getattr(func, '__pdt_template__', None)
+	if temp is not None and temp.qualname:
+		# The function is a compiled template function.
+		return temp.qualname
+	try:
+		filename = inspect.getsourcefile(func)
+	except TypeError:
+		filename = None
+	if not filename:
+		return func.__name__
+	
+	if filename not in linecache.cache:
+		_source_files.add(filename)
+	lines = linecache.getlines(filename, func.__globals__)
+	state = linecache.cache[filename][:2] if filename in linecache.cache else None
+	cached = _qualnames.get(filename)
+	if cached is None or cached[0] != state:
+		names = {}
+		def visit(node, prefix):
+			for child in ast.iter_child_nodes(node):
+				if isinstance(child, _ast.FunctionDef):
+					names[child.lineno] = prefix + child.name
+					visit(child, prefix + child.name + '.<locals>.')
+				elif isinstance(child, _ast.ClassDef):
+					visit(child, prefix + child.name + '.')
+				else:
+					visit(child, prefix)
+		try:
+			visit(ast.parse(''.join(lines)), '')
+		except SyntaxError:
+			pass
+		cached = _qualnames[filename] = (state, names)
+	name = cached[1].get(func.__code__.co_firstlineno)
+	return name if name and name.rsplit('.', 1)[-1] == func.__name__ else func.__name__
+
+
+def set_tracer(tracer):
+	"""
+	Sets the tracer which traces the calls of every template.
+	
+	*tracer* (``Tracer``) is the tracer. This can be any object
+	implementing *enter()* and *call()* like ``Tracer``. ``None``
+	disables tracing.
+	
+	Returns the previous tracer (``Tracer``), or ``None``.
+	"""
+	prev, _tracer[0] = _tracer[0], tracer
+	return prev
+
+
+class Tracer(object):
+	"""
+	The ``Tracer`` class opens a span around each template call. The
+	spans of sub-templates are nested in the span of the calling template.
+	Sub-templates are called instead of inlined while a tracer is set.
+	"""
+	
+	def __init__(self, exporter=None, sample_rate=1.0):
+		"""
+		Initializes a ``Tracer`` instance.
+		
+		*exporter* (**exporter**) receives each finished span by calling its
+		*export()* method. Default is ``None`` for a new
+		``MemoryExporter``.
+		
+		*sample_rate* (``float``) is the fraction of top-level template calls
+		which are traced along with their sub-templates. Default is ``1.0``
+		to trace every call.
+		"""
+		
+		self.exporter = exporter if exporter is not None else MemoryExporter()
+		"""
+		*exporter* (**exporter**) receives each finished span.
+		"""
+		
+		self.local = threading.local()
+		"""
+		*local* (``threading.local``) holds the stack (``list``) of open spans
+		of the current thread, and whether the template function called by
+		*call()* is being entered.
+		"""
+		
+		self.sample_rate = sample_rate
+		"""
+		*sample_rate* (``float``) is the fraction of top-level template calls
+		which are traced.
+		"""
+	
+	def enter(self):
+		"""
+		Determines whether a template call should be traced. This is called
+		on entering a template function.
+		
+		Returns whether the template function should be called by *call()*
+		(``bool``), which is ``False`` when it is being called by *call()*.
+		"""
+		local = self.local
+		if getattr(local, 'entering', False):
+			local.entering = False
+			return False
+		return True
+	
+	def call(self, name, args, func, call_args, call_kw):
+		"""
+		Calls a template function within the span of the call.
+		
+		*name* (``str``) is the name of the template.
+		
+		*args* (``tuple``) contains the name (``str``) and value
+		(**mixed**) of each template function argument.
+		
+		*func* (``function``) is the compiled template function.
+		
+		*call_args* (``tuple``) contains the positional arguments.
+		
+		*call_kw* (``dict``) contains the keyword arguments.
+		
+		Returns the output of the template function (**mixed**).
+		"""
+		span = self.start(name, args)
+		self.local.entering = True
+		try:
+			output = func(*call_args, **call_kw)
+			span.end(output)
+			return output
+		except:
+			span.fail()
+			raise
+		finally:
+			self.local.entering = False
+			span.close()
+	
+	def start(self, name, args):
+		"""
+		Starts the span of a template call.
+		
+		*name* (``str``) is the name of the template.
+		
+		*args* (``tuple``) contains the name (``str``) and value
+		(**mixed**) of each template function argument.
+		
+		Returns the span (``Span``).
+		"""
+		try:
+			stack = self.local.stack
+		except AttributeError:
+			stack = self.local.stack = []
+		if stack:
+			parent = stack[-1]
+			sampled = parent.sampled
+		else:
+			parent = None
+			sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+		span = Span(self, name, args if sampled else None, parent, sampled)
+		stack.append(span)
+		return span
+	
+	def finish(self, span):
+		"""
+		Finishes the span of a template call.
+		
+		*span* (``Span``) is the span.
+		"""
+		stack = self.local.stack
+		while stack:
+			if stack.pop() is span:
+				break
+		if span.sampled:
+			self.exporter.export(span)
+
+
+class Span(object):
+	"""
+	The ``Span`` class records a template call.
+	"""
+	
+	__slots__ = ['args', 'depth', 'duration', 'error', 'name', 'output_size', 'parent_id', 'sampled', 'span_id', 'start_time', 'thread_id', 'trace_id', 'tracer']
+	
+	def __init__(self, tracer, name, args, parent, sampled):
+		"""
+		Initializes a ``Span`` instance.
+		
+		*tracer* (``Tracer``) is the tracer.
+		
+		*name* (``str``) is the name of the template.
+		
+		*args* (``tuple``) contains the names and values of the template
+		function arguments, or ``None`` if the span is not sampled.
+		
+		*parent* (``Span``) is the span of the calling template, or ``None``.
+		
+		*sampled* (``bool``) is whether the span is sampled.
+		"""
+		self.tracer = tracer
+		self.sampled = sampled
+		if not sampled:
+			return
+		
+		self.name = name
+		"""
+		*name* (``str``) is the name of the template.
+		"""
+		
+		self.args = dict((key, summarize(value)) for key, value in args)
+		"""
+		*args* (``dict``) maps the name of each argument to a summary of its
+		value (``str``).
+		"""
+		
+		self.span_id = '%016x' % random.getrandbits(64)
+		"""
+		*span_id* (``str``) identifies the span.
+		"""
+		
+		self.parent_id = parent.span_id if parent is not None else None
+		"""
+		*parent_id* (``str``) identifies the span of the calling template.
+		"""
+		
+		self.trace_id = parent.trace_id if parent is not None else self.span_id
+		"""
+		*trace_id* (``str``) identifies the top-level span.
+		"""
+		
+		self.depth = parent.depth + 1 if parent is not None else 0
+		"""
+		*depth* (``int``) is the nesting depth of the span.
+		"""
+		
+		self.thread_id = thread_ident()
+		"""
+		*thread_id* (``int``) identifies the thread of the call.
+		"""
+		
+		self.duration = None
+		"""
+		*duration* (``float``) is the number of seconds the call took.
+		"""
+		
+		self.error = None
+		"""
+		*error* (``str``) describes the exception raised by the call.
+		"""
+		
+		self.output_size = None
+		"""
+		*output_size* (``int``) is the size of the output.
+		"""
+		
+		self.start_time = time.time()
+		"""
+		*start_time* (``float``) is when the call started.
+		"""
+	
+	def end(self, output):
+		"""
+		Records the size of the output of the template call.
+		
+		*output* (**mixed**) is the output.
+		"""
+		if self.sampled:
+			value = output[0] if isinstance(output, tuple) else output
+			self.output_size = len(value) if isinstance(value, (basestring, Chunks) + _bytes_like) else None
+	
+	def fail(self):
+		"""
+		Records the exception raised by the template call.
+		"""
+		if self.sampled:
+			exc = sys.exc_info()[1]
+			try:
+				message = str(exc)
+			except UnicodeError:
+				message = repr(exc.args)
+			self.error = "%s: %s" % (exc.__class__.__name__, message)
+	
+	def close(self):
+		"""
+		Finishes the span when the template call returns or raises an
+		exception.
+		"""
+		if self.sampled:
+			self.duration = time.time() - self.start_time
+		self.tracer.finish(self)
+	
+	def to_dict(self):
+		"""
+		Converts the span to a ``dict``.
+		
+		Returns the span (``dict``).
+		"""
+		return dict((key, getattr(self, key)) for key in ['name', 'trace_id', 'span_id', 'parent_id', 'depth', 'thread_id', 'start_time', 'duration', 'output_size', 'error', 'args'])
+
+
+def thread_ident():
+	"""
+	Gets the identifier of the current thread.
+	
+	Returns the identifier (``int``).
+	"""
+	return threading.current_thread().ident
+
+
+def summarize(value):
+	"""
+	Summarizes a template function argument for a span.
+	
+	*value* (**mixed**) is the value.
+	
+	Returns the summary (``str``): the type name of the value followed by
+	its length if it has one.
+	"""
+	try:
+		return "%s[%d]" % (type(value).__name__, len(value))
+	except Exception:
+		return type(value).__name__
+
+
+class MemoryExporter(object):
+	"""
+	The ``MemoryExporter`` class keeps finished spans in memory.
+	"""
+	
+	def __init__(self, max_spans=None):
+		"""
+		Initializes a ``MemoryExporter`` instance.
+		
+		*max_spans* (``int``) is the maximum number of spans to keep. The
+		oldest spans are dropped first. Default is ``None`` for no limit.
+		"""
+		
+		self.spans = collections.deque(maxlen=max_spans)
+		"""
+		*spans* (``collections.deque``) contains the finished spans
+		(``Span``) in the order they finished.
+		"""
+	
+	def export(self, span):
+		"""
+		Keeps the finished span.
+		
+		*span* (``Span``) is the span.
+		"""
+		self.spans.append(span)
+	
+	def clear(self):
+		"""
+		Drops the kept spans.
+		"""
+		self.spans.clear()
+
+
+class JSONLinesExporter(object):
+	"""
+	The ``JSONLinesExporter`` class writes each finished span to a file as
+	a line of JSON.
+	"""
+	
+	def __init__(self, file):
+		"""
+		Initializes a ``JSONLinesExporter`` instance.
+		
+		*file* (``file``) is the file to write to.
+		"""
+		
+		self.file = file
+		"""
+		*file* (``file``) is the file to write to.
+		"""
+		
+		self.lock = threading.Lock()
+		"""
+		*lock* (``threading.Lock``) serializes the writes to the file.
+		"""
+	
+	def export(self, span):
+		"""
+		Writes the finished span.
+		
+		*span* (``Span``) is the span.
+		"""
+		line = json.dumps(span.to_dict(), sort_keys=True) + "\n"
+		with self.lock:
+			self.file.write(line)
+
+
+def frame_location(frame):
+	"""
+	Gets the source location of a frame. The line of a frame of a compiled
+	template function is resolved with the line map of its template, and
+	the template is named by its key.
+	
+	*frame* (``frame``) is the frame.
+	
+	Returns the source file name (``str``), line number (``int``) and
+	function name (``str``).
+	"""
+	code = frame.f_code
+	ref = _template_codes.get(code)
+	temp = ref() if ref is not None else None
+	if temp is None or not temp.line_map:
+		return code.co_filename, frame.f_lineno, code.co_name
+	lineno = code.co_firstlineno
+	for offset, line in temp.line_map:
+		if offset > frame.f_lasti:
+			break
+		lineno = line
+	return code.co_filename, lineno, temp.key
+
+
+def sample_stacks():
+	"""
+	Samples the current stack of every thread. This can be called
+	periodically (e.g., from a timer thread) to profile templates in
+	production.
+	
+	Returns a ``dict`` mapping each thread identifier (``int``) to its
+	stack (``list``) from the outermost to the innermost frame. Each frame
+	is represented by its location (``tuple``). See ``frame_location()``.
+	"""
+	stacks = {}
+	for thread_id, frame in sys._current_frames().iteritems():
+		stack = []
+		while frame is not None:
+			stack.append(frame_location(frame))
+			frame = frame.f_back
+		stack.reverse()
+		stacks[thread_id] = stack
+	return stacks
+
+
+def rewrite_stats(stats):
+	"""
+	Rewrites the function entries of compiled template functions in
+	collected ``pstats`` statistics so that they are named by the key of
+	their template (e.g., "myapp.pages.home") at their source location.
+	
+	*stats* (``pstats.Stats``) is the statistics.
+	
+	Returns *stats* (``pstats.Stats``).
+	"""
+	names = {}
+	for code, ref in _template_codes.items():
+		temp = ref()
+		if temp is not None:
+			names[(code.co_filename, code.co_firstlineno, code.co_name)] = temp.key
+	
+	def rewrite(func):
+		name = names.get(func)
+		return func if name is None else (func[0], func[1], name)
+	
+	entries = {}
+	for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+		entries[rewrite(func)] = (cc, nc, tt, ct, dict((rewrite(caller), value) for caller, value in callers.iteritems()))
+	stats.stats = entries
+	stats.fcn_list = 0
+	return stats
+
+
+class Explanation(collections.namedtuple('Explanation', ['key', 'source', 'ast', 'bytecode', 'writes', 'constant_writes', 'global_loads', 'optimizations'])):
+	"""
+	The ``Explanation`` class stores what the compiler emitted for a
+	template. Converting it to a ``str`` formats a report of it.
+	
+	*key* (``str``) is the key of the template.
+	
+	*source* (``str``) is the transformed source code of the compiled
+	template function, or ``None`` if no unparser is available.
+	
+	*ast* (``str``) is the dump of the transformed AST.
+	
+	*bytecode* (``str``) is the disassembled bytecode of the compiled
+	template function.
+	
+	*writes* (``int``) is the number of write calls in the bytecode.
+	
+	*constant_writes* (``int``) is the number of write calls of constants
+	in the bytecode.
+	
+	*global_loads* (``dict``) maps the name (``str``) of each global loaded
+	in the bytecode to its number of loads (``int``).
+	
+	*optimizations* (``dict``) maps the name of each optimization applied
+	(``str``) to the number of times it was applied (``int``).
+	"""
+	
+	__slots__ = ()
+	
+	def __str__(self):
+		lines = [
+			"Template: %s" % self.key,
+			"Optimizations: %s" % (", ".join(["%s=%s" % item for item in sorted(self.optimizations.iteritems())]) or "none"),
+			"Writes: %d (%d constant)" % (self.writes, self.constant_writes),
+			"Global loads: %s" % (", ".join(["%s=%d" % item for item in sorted(self.global_loads.iteritems())]) or "none"),
+		]
+		for title, text in [("Source", self.source or "Unavailable: requires ast.unparse() or astor."), ("AST", self.ast), ("Bytecode", self.bytecode)]:
+			lines += ["", title, "-" * len(title), text.rstrip()]
+		return "\n".join(lines)
+
+
+def explain(template):
+	"""
+	Explains what the compiler emits for a template. The template is
+	compiled again with the same options to capture the transformed AST
+	and the bytecode without modifying the template.
+	
+	*template* (``Template``, ``function`` or ``str``) is the template,
+	template function or key of the template.
+	
+	Returns the explanation (``Explanation``).
+	"""
+	if isinstance(template, basestring):
+		temp = lookup(template)
+	else:
+		temp = _find_templates([template])[0]
+	func = temp.orig_func or temp.compiled_func
+	if func is None:
+		raise RuntimeError("func is not set.")
+	
+	# Compile a copy of the template.
+	copy_temp = Template(**temp.options())
+	copy_temp.orig_func = func
+	copy_temp.qualname = temp.qualname
+	artifacts = {}
+	copy_temp.compile(artifacts)
+	
+	# Count the writes and global loads in the bytecode.
+	writes = 0
+	constant_writes = 0
+	global_loads = collections.defaultdict(int)
+	bytecode = []
+	codes = [artifacts['code']]
+	while codes:
+		code = codes.pop(0)
+		if bytecode:
+			bytecode.append("\nDisassembly of %s:" % code.co_name)
+		instrs = list(iter_instructions(code))
+		for i, (offset, line, opname, arg, argval) in enumerate(instrs):
+			if opname in ('LOAD_FAST', 'LOAD_DEREF') and argval in ('__pdt_write', '__pdt_write_pieces'):
+				writes += 1
+				if argval == '__pdt_write' and [instr[2] for instr in instrs[i + 1:i + 3]] == ['LOAD_CONST', 'CALL_FUNCTION']:
+					constant_writes += 1
+			elif opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+				global_loads[argval] += 1
+			if isinstance(argval, types.CodeType):
+				codes.append(argval)
+				argval = "<code %s>" % argval.co_name
+			bytecode.append(("%4s %5d %-20s %s" % (line or "", offset, opname, "" if arg is None else "%d (%r)" % (arg, argval))).rstrip())
+	
+	return Explanation(temp.key, unparse_ast(artifacts['ast']), dump_ast(artifacts['ast'], include_attributes=True), "\n".join(bytecode), writes, constant_writes, dict(global_loads), dict(copy_temp.optimizations))
+
+
+def iter_instructions(code):
+	"""
+	Iterates over the instructions of a code object.
+	
+	*code* (``code``) is the code object.
+	
+	Returns an iterator (**iterator**) which yields each instruction as a
+	``tuple`` of its offset (``int``), the line number (``int``) starting at
+	it or ``None``, its operation name (``str``), its argument (``int``) or
+	``None``, and its resolved argument (**mixed**).
+	"""
+	co_code = code.co_code
+	line_starts = dict(dis.findlinestarts(code))
+	free_names = code.co_cellvars + code.co_freevars
+	extended = 0
+	i = 0
+	while i < len(co_code):
+		offset = i
+		op = ord(co_code[i])
+		i += 1
+		arg = argval = None
+		if op >= dis.HAVE_ARGUMENT:
+			arg = ord(co_code[i]) + ord(co_code[i + 1]) * 256 + extended
+			extended = arg << 16 if op == dis.EXTENDED_ARG else 0
+			i += 2
+			if op in dis.hasconst:
+				argval = code.co_consts[arg]
+			elif op in dis.hasname:
+				argval = code.co_names[arg]
+			elif op in dis.haslocal:
+				argval = code.co_varnames[arg]
+			elif op in dis.hasfree:
+				argval = free_names[arg]
+			elif op in dis.hasjrel:
+				argval = i + arg
+			elif op in dis.hascompare:
+				argval = dis.cmp_op[arg]
+			else:
+				argval = arg
+		yield offset, line_starts.get(offset), dis.opname[op], arg, argval
+
+
+def unparse_ast(node):
+	"""
+	Converts an AST back to source code. This uses ``ast.unparse()`` when
+	available, and otherwise the *astor* package.
+	
+	*node* (``ast.AST``) is the AST.
+	
+	Returns the source code (``str``), or ``None`` if no unparser is
+	available.
+	"""
+	unparse = getattr(ast, 'unparse', None)
+	if unparse is None:
+		try:
+			import astor
+		except ImportError:
+			return None
+		unparse = astor.to_source
+	return unparse(node)
+
+
+def dump_ast(node, annotate_fields=True, include_attributes=False, indent='  '):
+	"""
+	Formats an indented dump of an AST. This is ``ast.dump()`` modified to
+	pretty-print (based on *astpp* by Alex Leone).
+	
+	*node* (``ast.AST``) is the AST.
+	
+	*annotate_fields* (``bool``) is whether the names of the fields are
+	shown. Default is ``True``.
+	
+	*include_attributes* (``bool``) is whether the attributes such as line
+	numbers and column offsets are shown. Default is ``False``.
+	
+	*indent* (``str``) is the indentation of each level. Default is two
+	spaces.
+	
+	Returns the dump (``str``).
+	"""
+	if not isinstance(node, ast.AST):
+		raise TypeError("node:%r is not an AST." % node)
+	
+	def format_node(node, level=0):
+		if isinstance(node, ast.AST):
+			fields = [(name, format_node(value, level)) for name, value in ast.iter_fields(node)]
+			if include_attributes and node._attributes:
+				fields += [(name, format_node(getattr(node, name), level)) for name in node._attributes if hasattr(node, name)]
+			return "%s(%s)" % (node.__class__.__name__, ", ".join(["%s=%s" % field for field in fields] if annotate_fields else [value for _, value in fields]))
+		elif isinstance(node, list):
+			if not node:
+				return "[]"
+			lines = ["["]
+			lines += [indent * (level + 2) + format_node(item, level + 2) + "," for item in node]
+			lines.append(indent * (level + 1) + "]")
+			return "\n".join(lines)
+		return repr(node)
+	
+	return format_node(node)
+
+
+MemoryUsage = collections.namedtuple('MemoryUsage', ['name', 'code', 'consts', 'closure', 'inline_ast', 'total'])
+"""
+The ``MemoryUsage`` class stores the bytes retained by a compiled
+template function.
+
+*name* (``str``) is the name of the template.
+
+*code* (``int``) is the bytes retained by its code objects.
+
+*consts* (``int``) is the bytes retained by the constants of its code
+objects.
+
+*closure* (``int``) is the bytes retained by its closure cells.
+
+*inline_ast* (``int``) is the bytes retained by the AST kept to inline
+the template into other templates (see ``Template.inline_def``).
+
+*total* (``int``) is the total bytes retained.
+"""
+
+
+def memory_report(targets=None):
+	"""
+	Reports the memory retained by each compiled template.
+	
+	*targets* (**module** or **iterable**) optionally limits the reported
+	templates. See ``warmup()``. Default is ``None`` for every registered
+	template.
+	
+	Returns the memory usage of each compiled template (``list`` of
+	``MemoryUsage``) sorted from largest to smallest.
+	"""
+	report = []
+	for temp in _find_templates(targets):
+		func = temp.compiled_func
+		if func is None:
+			continue
+		code, consts = _code_size(func.__code__)
+		closure = _closure_size(func.__closure__)
+		inline_ast = _ast_size(temp.inline_def) if temp.inline_def is not None else 0
+		report.append(MemoryUsage(temp.name, code, consts, closure, inline_ast, code + consts + closure + inline_ast))
+	report.sort(key=lambda usage: usage.total, reverse=True)
+	return report
+
+
+def _code_size(code):
+	"""
+	Calculates the memory retained by a code object.
+	
+	*code* (``code``) is the code object.
+	
+	Returns the bytes retained by the code object and any nested code
+	objects (``int``), and the bytes retained by their constants
+	(``int``).
+	"""
+	code_size = sys.getsizeof(code) + sys.getsizeof(code.co_code) + sys.getsizeof(code.co_lnotab) + sys.getsizeof(code.co_consts) + sys.getsizeof(code.co_names) + sys.getsizeof(code.co_varnames)
+	consts_size = 0
+	consts = list(code.co_consts)
+	while consts:
+		const = consts.pop()
+		if isinstance(const, types.CodeType):
+			sizes = _code_size(const)
+			code_size += sizes[0]
+			consts_size += sizes[1]
+		else:
+			consts_size += sys.getsizeof(const)
+			if isinstance(const, (tuple, frozenset)):
+				consts.extend(const)
+	return code_size, consts_size
+
+
+def _closure_size(closure):
+	"""
+	Calculates the memory retained by closure cells.
+	
+	*closure* (``tuple``) contains the closure cells.
+	
+	Returns the bytes retained by the closure cells and their contents
+	(``int``). Shared contents (classes, functions and modules) are not
+	counted.
+	"""
+	size = 0
+	for cell in closure or ():
+		size += sys.getsizeof(cell)
+		contents = cell.cell_contents
+		if not isinstance(contents, (type, types.ClassType, types.FunctionType, types.BuiltinFunctionType, types.ModuleType)):
+			size += sys.getsizeof(contents)
+	return size
+
+
+def _ast_size(node):
+	"""
+	Calculates the memory retained by an AST.
+	
+	*node* (``ast.AST``) is the AST.
+	
+	Returns the bytes retained by the nodes, their attributes and their
+	field values (``int``).
+	"""
+	size = 0
+	for sub in ast.walk(node):
+		size += sys.getsizeof(sub) + sys.getsizeof(sub.__dict__)
+		for value in sub.__dict__.itervalues():
+			if not isinstance(value, ast.AST):
+				size += sys.getsizeof(value)
+	return size
+
+
+AllocUsage = collections.namedtuple('AllocUsage', ['name', 'source_file', 'lineno', 'size', 'count', 'line'])
+"""
+The ``AllocUsage`` class stores the memory allocated by a source line of
+a template.
+
+*name* (``str``) is the key of the template.
+
+*source_file* (``str``) is the path of the source file of the template.
+
+*lineno* (``int``) is the line number.
+
+*size* (``int``) is the bytes allocated by the line.
+
+*count* (``int``) is the number of memory blocks allocated by the line.
+
+*line* (``str``) is the source code of the line.
+"""
+
+
+@contextlib.contextmanager
+def alloc_profile():
+	"""
+	Profiles the memory allocated by templates rendered in the context.
+	See "Allocations".
+	
+	Returns the context manager (**context manager**) which provides the
+	profile (``AllocProfile``).
+	"""
+	try:
+		import tracemalloc
+	except ImportError:
+		raise RuntimeError("alloc_profile() requires the tracemalloc module.")
+	
+	profile = AllocProfile(tracemalloc)
+	started = not tracemalloc.is_tracing()
+	if started:
+		tracemalloc.start()
+	prev = set_tracer(AllocTracer(profile))
+	try:
+		yield profile
+	finally:
+		set_tracer(prev)
+		if started:
+			tracemalloc.stop()
+
+
+class AllocTracer(Tracer):
+	"""
+	The ``AllocTracer`` class takes a ``tracemalloc`` snapshot around each
+	top-level template render for ``alloc_profile()``.
+	"""
+	
+	def __init__(self, profile):
+		"""
+		Initializes an ``AllocTracer`` instance.
+		
+		*profile* (``AllocProfile``) collects the allocations.
+		"""
+		Tracer.__init__(self, profile)
+	
+	def start(self, name, args):
+		"""
+		Starts the span of a template call. A snapshot is taken before a
+		top-level render.
+		
+		See ``Tracer.start()``.
+		"""
+		if not getattr(self.local, 'stack', None):
+			self.local.snapshot = self.exporter.tracemalloc.take_snapshot()
+		return Tracer.start(self, name, args)
+	
+	def finish(self, span):
+		"""
+		Finishes the span of a template call. A snapshot is taken after a
+		top-level render and compared to the one taken before it.
+		
+		See ``Tracer.finish()``.
+		"""
+		Tracer.finish(self, span)
+		if not self.local.stack:
+			self.exporter.add(self.local.snapshot, self.exporter.tracemalloc.take_snapshot())
+			self.local.snapshot = None
+
+
+class AllocProfile(object):
+	"""
+	The ``AllocProfile`` class collects the memory allocated by the source
+	lines of templates.
+	"""
+	
+	def __init__(self, tracemalloc):
+		"""
+		Initializes an ``AllocProfile`` instance.
+		
+		*tracemalloc* (**module**) is the ``tracemalloc`` module.
+		"""
+		
+		self.lines = collections.defaultdict(lambda: [0, 0])
+		"""
+		*lines* (``collections.defaultdict``) maps each source location
+		(``tuple``) of file name (``str``) and line number (``int``) to its
+		allocated bytes (``int``) and memory blocks (``int``).
+		"""
+		
+		self.lock = threading.Lock()
+		"""
+		*lock* (``threading.Lock``) serializes the updates to the profile.
+		"""
+		
+		self.renders = collections.defaultdict(int)
+		"""
+		*renders* (``collections.defaultdict``) maps the key (``str``) of
+		each template to its number of renders (``int``).
+		"""
+		
+		self.tracemalloc = tracemalloc
+		"""
+		*tracemalloc* (**module**) is the ``tracemalloc`` module.
+		"""
+	
+	def export(self, span):
+		"""
+		Counts the render of a template.
+		
+		*span* (``Span``) is the span of the render.
+		"""
+		with self.lock:
+			self.renders[span.name] += 1
+	
+	def add(self, before, after):
+		"""
+		Adds the memory allocated by the source lines of templates between
+		two snapshots.
+		
+		*before* (``tracemalloc.Snapshot``) is the snapshot taken before the
+		render.
+		
+		*after* (``tracemalloc.Snapshot``) is the snapshot taken after the
+		render.
+		"""
+		files = set(temp.source_file for temp in _templates.values() if temp.source_file)
+		filters = [self.tracemalloc.Filter(True, filename) for filename in files]
+		if not filters:
+			return
+		diffs = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+		with self.lock:
+			for diff in diffs:
+				if diff.size_diff > 0:
+					frame = diff.traceback[0]
+					usage = self.lines[(frame.filename, frame.lineno)]
+					usage[0] += diff.size_diff
+					usage[1] += max(diff.count_diff, 0)
+	
+	def report(self, limit=None):
+		"""
+		Reports the memory allocated by the source lines of templates.
+		
+		*limit* (``int``) is the maximum number of lines to report. Default
+		is ``None`` for every line.
+		
+		Returns the memory allocated by each source line (``list`` of
+		``AllocUsage``) sorted from largest to smallest.
+		"""
+		# Map source files to the line ranges of their templates.
+		ranges = collections.defaultdict(list)
+		for temp in _templates.values():
+			if temp.source_file and temp.source_lines:
+				ranges[temp.source_file].append((temp.source_lines, temp.key))
+		
+		report = []
+		with self.lock:
+			lines = self.lines.items()
+		for (filename, lineno), (size, count) in lines:
+			# Use the innermost template containing the line.
+			found = [(last - first, key) for (first, last), key in ranges[filename] if first <= lineno <= last]
+			if found:
+				report.append(AllocUsage(min(found)[1], filename, lineno, size, count, linecache.getline(filename, lineno).strip()))
+		report.sort(key=lambda usage: usage.size, reverse=True)
+		return report[:limit] if limit is not None else report
+
+
+def side_effect(func):
+	"""
+	Declares that a function is only called for its side effects so that
+	expressions calling it in a template are not written to the buffer.
+	This must be applied before templates calling the function are
+	compiled.
+	
+	*func* (``function``) is the function.
+	
+	Returns the function (``function``).
+	"""
+	func.__pdt_side_effect__ = True
+	return func
+
+
+def specialize(func, **constants):
+	"""
+	Specializes a template on constant arguments. The arguments are
+	removed from the signature of the specialized template function,
+	branches which only depend on them are resolved and expressions which
+	only depend on them are folded into literals when it is compiled.
+	
+	*func* (``function``) is the template function.
+	
+	*constants* (``dict``) maps the names of the template function
+	arguments to fix to their constant values.
+	
+	Returns the specialized template function (``function``).
+	"""
+	temp = getattr(func, '__pdt_template__', None)
+	if not isinstance(temp, Template):
+		raise TypeError("func:%r is not a template function." % func)
+	return temp.specialize(**constants).func
+
+
+def slot(name):
+	"""
+	Reserves a position in the output of a template for the value of a
+	slot. This must be called as an expression in a template function
+	where it is compiled into a call to the buffer.
+	
+	*name* (``str``) is the name of the slot.
+	"""
+	raise RuntimeError("slot() can only be called as an expression in a template function.")
+
+
+def fill(name, value):
+	"""
+	Sets the value of a slot in the output of a template. This must be
+	called as an expression in the same template function as the slot
+	where it is compiled into a call to the buffer.
+	
+	*name* (``str``) is the name of the slot.
+	
+	*value* (**mixed**) is the value of the slot.
+	"""
+	raise RuntimeError("fill() can only be called as an expression in a template function.")
+
+
+def defer(future):
+	"""
+	Reserves a position in the output of a template for the result of a
+	future which is waited for when the output is returned. This must be
+	called as an expression in a template function where it is compiled
+	into a call to the buffer.
+	
+	*future* (**future**) is the future whose result to output (e.g., a
+	``concurrent.futures.Future``). It must implement *result()*.
+	"""
+	raise RuntimeError("defer() can only be called as an expression in a template function.")
+
+
+def static_prefix(func):
+	"""
+	Gets the static output which every call of a template starts with.
+	This can be sent before the template is rendered (e.g., while its data
+	is being fetched) when the template is created with *split_prefix*.
+	
+	*func* (``function``) is the template function. It is compiled if it
+	is lazy.
+	
+	Returns the static prefix (``str`` or ``unicode``), or ``None`` if the
+	output does not start with a literal string.
+	"""
+	temp = getattr(func, '__pdt_template__', None)
+	if not isinstance(temp, Template):
+		raise TypeError("func:%r is not a template function." % func)
+	temp.ensure_compiled()
+	return temp.static_prefix
+
+
+_name_consts = {'None': None, 'True': True, 'False': False}
+"""
+*_name_consts* (``dict``) maps the names of built-in constants to their
+values.
+"""
+
+_fold_types = (basestring, bool, int, long, float, complex, type(None))
+"""
+*_fold_types* (``tuple``) contains the types of values which can be
+folded into literals.
+"""
+
+_fold_binops = {
+	_ast.Add: operator.add,
+	_ast.Sub: operator.sub,
+	_ast.Mult: operator.mul,
+	_ast.Div: operator.div,
+	_ast.FloorDiv: operator.floordiv,
+	_ast.Mod: operator.mod,
+	_ast.Pow: operator.pow,
+	_ast.LShift: operator.lshift,
+	_ast.RShift: operator.rshift,
+	_ast.BitOr: operator.or_,
+	_ast.BitXor: operator.xor,
+	_ast.BitAnd: operator.and_
+}
+"""
+*_fold_binops* (``dict``) maps binary operator node types to their
+functions.
+"""
+
+_fold_unaryops = {
+	_ast.Not: operator.not_,
+	_ast.UAdd: operator.pos,
+	_ast.USub: operator.neg,
+	_ast.Invert: operator.invert
+}
+"""
+*_fold_unaryops* (``dict``) maps unary operator node types to their
+functions.
+"""
+
+_fold_cmpops = {
+	_ast.Eq: operator.eq,
+	_ast.NotEq: operator.ne,
+	_ast.Lt: operator.lt,
+	_ast.LtE: operator.le,
+	_ast.Gt: operator.gt,
+	_ast.GtE: operator.ge,
+	_ast.Is: operator.is_,
+	_ast.IsNot: operator.is_not,
+	_ast.In: lambda a, b: a in b,
+	_ast.NotIn: lambda a, b: a not in b
+}
+"""
+*_fold_cmpops* (``dict``) maps comparison operator node types to their
+functions.
+"""
+
+_fold_builtins = frozenset(['abs', 'bool', 'float', 'int', 'len', 'max', 'min', 'repr', 'round', 'str', 'unicode'])
+"""
+*_fold_builtins* (``frozenset``) contains the names of the pure built-in
+functions which can be folded.
+"""
+
+_fold_methods = frozenset(['capitalize', 'center', 'decode', 'encode', 'endswith', 'format', 'join', 'ljust', 'lower', 'lstrip', 'replace', 'rjust', 'rstrip', 'split', 'startswith', 'strip', 'title', 'upper', 'zfill'])
+"""
+*_fold_methods* (``frozenset``) contains the names of the pure string
+methods which can be folded.
+"""
+
+
+def specialize_func_ast(func_ast, constants, func_globals, enc_vars, optimizations):
+	"""
+	Specializes the template function AST on constant arguments.
+	
+	*func_ast* (``ast.FunctionDef``) is the template function AST.
+	
+	*constants* (**mapping**) maps argument name to constant value.
+	
+	*func_globals* (``dict``) is the template function global namespace.
+	
+	*enc_vars* (``dict``) contains the variables passed to the enclosing
+	function. Constants which cannot be represented by literals are added
+	to it.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	"""
+	# Remove constant arguments from function signature.
+	args = func_ast.args
+	first_default = len(args.args) - len(args.defaults)
+	arg_names = [getattr(arg, 'id', None) for arg in args.args]
+	for name in constants:
+		if name not in arg_names:
+			raise TypeError("constant:%r is not an argument of %s()." % (name, func_ast.name))
+	for i in reversed(xrange(len(arg_names))):
+		if arg_names[i] in constants:
+			del args.args[i]
+			if i >= first_default:
+				del args.defaults[i - first_default]
+	
+	# Find names which are rebound in the function. These cannot be
+	# substituted so they are bound to their constants instead.
+	rebound = set()
+	local_names = set()
+	for node in ast.walk(func_ast):
+		if isinstance(node, _ast.Name) and not isinstance(node.ctx, _ast.Load):
+			local_names.add(node.id)
+		elif isinstance(node, _ast.Global):
+			rebound.update(node.names)
+		elif isinstance(node, _ast.arguments):
+			if node is not args:
+				local_names.update(n for n in (node.vararg, node.kwarg) if n)
+	rebound.update(local_names & set(constants))
+	
+	consts = {}
+	bindings = []
+	for name, value in constants.iteritems():
+		const_var = '__pdt_const_' + name
+		if literal_node(value) is None:
+			enc_vars[const_var] = value
+		if name in rebound:
+			# name = __pdt_const_name
+			bindings.append(_ast.Assign([_ast.Name(name, _ast_store)], literal_node(value) or _ast.Name(const_var, _ast_load)))
+		else:
+			consts[name] = (value, const_var)
+	
+	folder = _ConstantFolder(consts, func_globals, local_names, optimizations)
+	func_ast.body = bindings + folder.visit_body(func_ast.body)
+
+
+def literal_node(value):
+	"""
+	Creates a literal node for the value.
+	
+	*value* (**mixed**) is the value.
+	
+	Returns the literal node (``ast.AST``), or ``None`` if *value* cannot
+	be represented by a literal.
+	"""
+	if isinstance(value, basestring):
+		return _ast.Str(value)
+	elif value is None or isinstance(value, bool):
+		return _ast.Name(repr(value), _ast_load)
+	elif isinstance(value, (int, long, float, complex)):
+		return _ast.Num(value)
+	elif type(value) is tuple:
+		elts = [literal_node(item) for item in value]
+		if None not in elts:
+			return _ast.Tuple(elts, _ast_load)
+	return None
+
+
+def is_plain_data(value):
+	"""
+	Determines whether the value is plain data whose operations are free of
+	side effects.
+	
+	*value* (**mixed**) is the value.
+	
+	Returns whether *value* is plain data (``bool``).
+	"""
+	values = [value]
+	while values:
+		value = values.pop()
+		if isinstance(value, _fold_types):
+			continue
+		elif type(value) in (tuple, list, set, frozenset):
+			values.extend(value)
+		elif type(value) is dict:
+			values.extend(value.iterkeys())
+			values.extend(value.itervalues())
+		else:
+			return False
+	return True
+
+
+class _ConstantFolder(ast.NodeTransformer):
+	"""
+	The ``_ConstantFolder`` class substitutes constant arguments in a
+	template function AST, folds expressions which only depend on
+	constants into literals, and resolves branches on constants.
+	"""
+	
+	def __init__(self, consts, func_globals, local_names, optimizations):
+		"""
+		Initializes a ``_ConstantFolder`` instance.
+		
+		*consts* (``dict``) maps argument name to constant value and closure
+		variable name.
+		
+		*func_globals* (``dict``) is the template function global namespace.
+		
+		*local_names* (``set``) contains the names bound in the function.
+		
+		*optimizations* (``dict``) counts the optimizations applied.
+		"""
+		self.consts = consts
+		self.func_globals = func_globals
+		self.local_names = local_names
+		self.optimizations = optimizations
+	
+	def count(self, name):
+		self.optimizations[name] = self.optimizations.get(name, 0) + 1
+	
+	def visit_body(self, body):
+		"""
+		Visits a list of statements.
+		
+		*body* (``list``) contains the statements.
+		
+		Returns the resulting statements (``list``).
+		"""
+		result = []
+		for node in body:
+			node = self.visit(node)
+			if node is None:
+				continue
+			elif isinstance(node, list):
+				result += node
+			else:
+				result.append(node)
+		return result
+	
+	def value(self, node):
+		"""
+		Gets the constant value of a node.
+		
+		*node* (``ast.AST``) is the node.
+		
+		Returns whether the value of *node* is constant (``bool``), and its
+		value (**mixed**).
+		"""
+		if isinstance(node, _ast.Str):
+			return True, node.s
+		elif isinstance(node, _ast.Num):
+			return True, node.n
+		elif isinstance(node, _ast.Name) and isinstance(node.ctx, _ast.Load) and node.id in _name_consts:
+			return True, _name_consts[node.id]
+		elif hasattr(node, 'pdt_value'):
+			return True, node.pdt_value
+		elif isinstance(node, _ast.Tuple) and isinstance(node.ctx, _ast.Load):
+			values = [self.value(elt) for elt in node.elts]
+			if all(known for known, _ in values):
+				return True, tuple(value for _, value in values)
+		return False, None
+	
+	def values(self, nodes):
+		"""
+		Gets the constant values of nodes which must be plain data.
+		
+		*nodes* (``list``) contains the nodes.
+		
+		Returns the values (``list``), or ``None`` if any node is not
+		constant.
+		"""
+		values = []
+		for node in nodes:
+			known, value = self.value(node)
+			if not known or not is_plain_data(value):
+				return None
+			values.append(value)
+		return values
+	
+	def fold(self, node, func, *args):
+		"""
+		Folds a node into its constant value.
+		
+		*node* (``ast.AST``) is the node to fold.
+		
+		*func* (**callable**) computes the constant value from *args*.
+		
+		Returns the folded node (``ast.AST``). If computing the value fails,
+		*node* is returned unmodified so the error is raised at runtime.
+		"""
+		try:
+			value = func(*args)
+		except Exception:
+			return node
+		self.count('fold')
+		literal = literal_node(value)
+		if literal is None:
+			node.pdt_value = value
+			return node
+		return ast.copy_location(literal, node)
+	
+	def visit_Name(self, node):
+		if isinstance(node.ctx, _ast.Load) and node.id in self.consts:
+			value, const_var = self.consts[node.id]
+			literal = literal_node(value)
+			if literal is None:
+				literal = _ast.Name(const_var, _ast_load)
+				literal.pdt_value = value
+			return ast.copy_location(literal, node)
+		return node
+	
+	def visit_BinOp(self, node):
+		self.generic_visit(node)
+		values = self.values([node.left, node.right])
+		if values is not None and type(node.op) in _fold_binops:
+			return self.fold(node, _fold_binops[type(node.op)], *values)
+		return node
+	
+	def visit_UnaryOp(self, node):
+		self.generic_visit(node)
+		values = self.values([node.operand])
+		if values is not None:
+			return self.fold(node, _fold_unaryops[type(node.op)], *values)
+		return node
+	
+	def visit_BoolOp(self, node):
+		self.generic_visit(node)
+		values = self.values(node.values)
+		if values is not None:
+			is_and = isinstance(node.op, _ast.And)
+			return self.fold(node, lambda: reduce(lambda a, b: (a and b) if is_and else (a or b), values))
+		return node
+	
+	def visit_Compare(self, node):
+		self.generic_visit(node)
+		values = self.values([node.left] + node.comparators)
+		if values is not None:
+			def compare():
+				for op, a, b in zip(node.ops, values, values[1:]):
+					if not _fold_cmpops[type(op)](a, b):
+						return False
+				return True
+			return self.fold(node, compare)
+		return node
+	
+	def visit_Subscript(self, node):
+		self.generic_visit(node)
+		if isinstance(node.ctx, _ast.Load):
+			if isinstance(node.slice, _ast.Index):
+				values = self.values([node.value, node.slice.value])
+				if values is not None:
+					return self.fold(node, operator.getitem, *values)
+			elif isinstance(node.slice, _ast.Slice) and not node.slice.step:
+				bounds = [bound or _ast.Name('None', _ast_load) for bound in (node.slice.lower, node.slice.upper)]
+				values = self.values([node.value] + bounds)
+				if values is not None:
+					return self.fold(node, lambda v, lower, upper: v[lower:upper], *values)
+		return node
+	
+	def visit_Dict(self, node):
+		self.generic_visit(node)
+		keys = self.values(node.keys)
+		values = self.values(node.values)
+		if keys is not None and values is not None:
+			node.pdt_value = dict(zip(keys, values))
+		return node
+	
+	def visit_List(self, node):
+		self.generic_visit(node)
+		values = self.values(node.elts)
+		if isinstance(node.ctx, _ast.Load) and values is not None:
+			node.pdt_value = values
+		return node
+	
+	def visit_Call(self, node):
+		self.generic_visit(node)
+		if node.starargs or node.kwargs:
+			return node
+		args = self.values(node.args)
+		kw_values = self.values([keyword.value for keyword in node.keywords])
+		if args is None or kw_values is None:
+			return node
+		kw = dict(zip([keyword.arg for keyword in node.keywords], kw_values))
+		
+		func = node.func
+		if isinstance(func, _ast.Attribute) and func.attr in _fold_methods:
+			values = self.values([func.value])
+			if values is not None and isinstance(values[0], basestring):
+				return self.fold(node, lambda: getattr(values[0], func.attr)(*args, **kw))
+		elif isinstance(func, _ast.Name) and func.id in _fold_builtins and func.id not in self.func_globals and func.id not in self.local_names:
+			builtin = getattr(__builtin__, func.id)
+			return self.fold(node, lambda: builtin(*args, **kw))
+		return node
+	
+	def visit_IfExp(self, node):
+		self.generic_visit(node)
+		known, value = self.value(node.test)
+		if known and is_plain_data(value):
+			self.count('branch')
+			return node.body if value else node.orelse
+		return node
+	
+	def visit_If(self, node):
+		node.test = self.visit(node.test)
+		known, value = self.value(node.test)
+		if known and is_plain_data(value):
+			self.count('branch')
+			return self.visit_body(node.body if value else node.orelse)
+		node.body = self.visit_body(node.body) or [ast.copy_location(_ast.Pass(), node)]
+		node.orelse = self.visit_body(node.orelse)
+		return node
+	
+	def visit_While(self, node):
+		node.test = self.visit(node.test)
+		known, value = self.value(node.test)
+		if known and is_plain_data(value) and not value:
+			self.count('branch')
+			return self.visit_body(node.orelse)
+		node.body = self.visit_body(node.body) or [ast.copy_location(_ast.Pass(), node)]
+		node.orelse = self.visit_body(node.orelse)
+		return node
+	
+	def generic_visit(self, node):
+		for field, old_value in ast.iter_fields(node):
+			if isinstance(old_value, list) and old_value and isinstance(old_value[0], _ast.stmt):
+				new_value = self.visit_body(old_value)
+				if not new_value and field in ('body', 'finalbody'):
+					new_value = [ast.copy_location(_ast.Pass(), node)]
+				setattr(node, field, new_value)
+			elif isinstance(old_value, list):
+				setattr(node, field, [self.visit(item) for item in old_value])
+			elif isinstance(old_value, _ast.AST):
+				setattr(node, field, self.visit(old_value))
+		return node
+
+
+def iter_bodies(body, guarded=True):
+	"""
+	Iterates over the statement lists of a template function body whose
+	expressions are output. The statement lists of nested functions and
+	classes are skipped. A yielded list can be modified in place before
+	the next list is requested.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*guarded* (``bool``) is whether the statement lists of ``try`` and
+	``with`` statements (and the lists nested in them) are included.
+	Default is ``True``.
+	
+	Returns an iterator (``generator``) yielding each statement list
+	(``list``).
+	"""
+	bodies = [body]
+	while bodies:
+		nodes = bodies.pop()
+		yield nodes
+		for node in nodes:
+			if isinstance(node, (_ast.If, _ast.While, _ast.For)):
+				bodies += [node.body, node.orelse]
+			elif not guarded:
+				continue
+			elif isinstance(node, _ast.TryExcept):
+				bodies += [node.body, node.orelse]
+				bodies += [handler.body for handler in node.handlers]
+			elif isinstance(node, _ast.TryFinally):
+				bodies += [node.body, node.finalbody]
+			elif isinstance(node, _ast.With):
+				bodies.append(node.body)
+
+
+def rewrite_slots(body, func_globals, optimizations):
+	"""
+	Rewrites the expressions of a template function body calling
+	``slot()``, ``fill()`` and ``defer()`` to call the methods of the
+	buffer instead.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*func_globals* (``dict``) is the template function global namespace.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	
+	Returns the number of calls rewritten (``int``).
+	"""
+	count = 0
+	for nodes in iter_bodies(body):
+		for node in nodes:
+			if not isinstance(node, _ast.Expr) or not isinstance(node.value, _ast.Call):
+				continue
+			call = node.value
+			target = resolve_global(call.func, func_globals)
+			if target is slot or target is fill or target is defer:
+				# pdt.slot(...) -> __pdt_buff.slot(...)
+				call.func = ast.copy_location(_ast.Attribute(_ast.Name('__pdt_buff', _ast_load), target.__name__, _ast_load), call.func)
+				node.pdt_silent = True
+				count += 1
+	if count:
+		optimizations['slots'] = count
+	return count
+
+
+def trace_prologue(func_ast, name):
+	"""
+	Creates the statements making the tracer call a template function
+	when a tracer is set. The tracer calls the template function again
+	within the span of the call.
+	
+	*func_ast* (``ast.FunctionDef``) is the template function.
+	
+	*name* (``str``) is the name of the span.
+	
+	Returns the statements (``list``).
+	"""
+	def load(arg):
+		if isinstance(arg, _ast.Tuple):
+			return _ast.Tuple([load(elt) for elt in arg.elts], _ast_load)
+		return _ast.Name(arg.id, _ast_load)
+	
+	# Summarize the arguments.
+	params = [arg.id for arg in func_ast.args.args if isinstance(arg, _ast.Name)]
+	params += filter(None, [func_ast.args.vararg, func_ast.args.kwarg])
+	args = _ast.Tuple([_ast.Tuple([_ast.Str(param), _ast.Name(param, _ast_load)], _ast_load) for param in params], _ast_load)
+	
+	# Pass the arguments again.
+	call_args = _ast.Tuple([load(arg) for arg in func_ast.args.args], _ast_load)
+	if func_ast.args.vararg:
+		call_args = _ast.BinOp(call_args, _ast.Add(), _ast.Name(func_ast.args.vararg, _ast_load))
+	call_kw = _ast.Name(func_ast.args.kwarg, _ast_load) if func_ast.args.kwarg else _ast.Dict([], [])
+	
+	# __pdt_tracing = __pdt_tracer[0]
+	# if __pdt_tracing is not None and __pdt_tracing.enter():
+	#   return __pdt_tracing.call(name, (('arg', arg), ...), __pdt_func, (arg, ...), kw)
+	tracing = lambda: _ast.Name('__pdt_tracing', _ast_load)
+	return [
+		_ast.Assign([_ast.Name('__pdt_tracing', _ast_store)], _ast.Subscript(_ast.Name('__pdt_tracer', _ast_load), _ast.Index(_ast.Num(0)), _ast_load)),
+		_ast.If(_ast.BoolOp(_ast.And(), [
+			_ast.Compare(tracing(), [_ast.IsNot()], [_ast.Name('None', _ast_load)]),
+			_ast.Call(_ast.Attribute(tracing(), 'enter', _ast_load), [], [], None, None)
+		]), [
+			_ast.Return(_ast.Call(_ast.Attribute(tracing(), 'call', _ast_load), [_ast.Str(name), args, _ast.Name('__pdt_func', _ast_load), call_args, call_kw], [], None, None))
+		], [])
+	]
+
+
+def insert_loop_checks(body):
+	"""
+	Inserts a call checking the budget at the start of each loop of a
+	template function body.
+	
+	*body* (``list``) contains the statements of the template function.
+	"""
+	for nodes in iter_bodies(body):
+		for node in nodes:
+			if isinstance(node, (_ast.For, _ast.While)):
+				# __pdt_check()
+				check = _ast.Expr(_ast.Call(_ast.Name('__pdt_check', _ast_load), [], [], None, None))
+				check.pdt_silent = True
+				for sub in ast.walk(check):
+					ast.copy_location(sub, node.body[0])
+				node.body.insert(0, check)
+
+
+def mark_none_calls(body, none_calls, func_globals, optimizations):
+	"""
+	Marks the expressions of a template function body which only call a
+	function or method returning ``None`` so they are not written to the
+	buffer.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*none_calls* (``frozenset``) contains the names of the functions and
+	methods whose calls return ``None``.
+	
+	*func_globals* (``dict``) is the template function global namespace
+	used to find functions decorated with ``side_effect()``.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	"""
+	count = 0
+	for nodes in iter_bodies(body):
+		for node in nodes:
+			if not isinstance(node, _ast.Expr) or not isinstance(node.value, _ast.Call):
+				continue
+			func = node.value.func
+			if isinstance(func, _ast.Attribute):
+				name = func.attr
+			elif isinstance(func, _ast.Name):
+				name = func.id
+			else:
+				continue
+			if name in none_calls or getattr(resolve_global(func, func_globals), '__pdt_side_effect__', False):
+				node.pdt_silent = True
+				count += 1
+	if count:
+		optimizations['none_calls'] = count
+
+
+def resolve_global(node, func_globals):
+	"""
+	Resolves a global name or attribute of a global name at compile time.
+	
+	*node* (``ast.AST``) is the ``ast.Name`` or ``ast.Attribute`` node.
+	
+	*func_globals* (``dict``) is the template function global namespace.
+	
+	Returns the resolved object (**mixed**), or ``None`` if it could not be
+	resolved.
+	"""
+	attrs = []
+	while isinstance(node, _ast.Attribute):
+		attrs.insert(0, node.attr)
+		node = node.value
+	if not isinstance(node, _ast.Name) or node.id not in func_globals:
+		return None
+	obj = func_globals[node.id]
+	for attr in attrs:
+		if not inspect.ismodule(obj) and not inspect.isclass(obj):
+			return None
+		obj = getattr(obj, attr, None)
+	return obj
+
+
+def is_inlinable(func_ast, template):
+	"""
+	Determines whether the calls to a template function can be inlined into
+	other templates.
+	
+	*func_ast* (``ast.FunctionDef``) is the parsed template function.
+	
+	*template* (``Template``) is the template.
+	
+	Returns whether the calls can be inlined (``bool``).
+	"""
+	if not template.inline or template.constants or template.etag or template.io_param or template.io_factory not in (ListIO, ChunksIO) or template.split_prefix or template.max_bytes is not None or template.max_seconds is not None or template.encoding or template.doc:
+		# The output of the template would differ from its inlined writes.
+		return False
+	args = func_ast.args
+	if args.vararg or args.kwarg or not all(isinstance(arg, _ast.Name) for arg in args.args):
+		return False
+	size = 0
+	for node in ast.walk(_ast.Module(func_ast.body)):
+		if isinstance(node, (_ast.Return, _ast.Yield, _ast.FunctionDef, _ast.ClassDef, _ast.Global, _ast.Exec, _ast.Import, _ast.ImportFrom)):
+			return False
+		size += 1
+		if size > INLINE_MAX_NODES:
+			return False
+	return True
+
+
+def inline_calls(func_ast, template, func_globals, enc_vars, optimizations):
+	"""
+	Inlines the calls to small sub-templates of a template function body.
+	Each expression calling a sub-template with simple arguments (names
+	and literals) is replaced by the body of the sub-template with its
+	locals renamed. This is guarded by a check that the global name is
+	still bound to the sub-template and that no tracer is set, and the call
+	is made otherwise.
+	
+	*func_ast* (``ast.FunctionDef``) is the template function.
+	
+	*template* (``Template``) is the template being compiled.
+	
+	*func_globals* (``dict``) is the template function global namespace.
+	
+	*enc_vars* (``dict``) contains the variables passed to the enclosing
+	function. The sub-templates and argument defaults are added to it.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	"""
+	# Find the names bound in the template function. The globals used by a
+	# sub-template cannot be inlined where these would shadow them.
+	local_names = set()
+	for node in ast.walk(func_ast):
+		if isinstance(node, _ast.Name) and not isinstance(node.ctx, _ast.Load):
+			local_names.add(node.id)
+		elif isinstance(node, _ast.arguments):
+			local_names.update(n for n in (node.vararg, node.kwarg) if n)
+	
+	# Find the calls first so that the inlined bodies are not inlined into
+	# recursively. The calls in try and with statements are not inlined
+	# because the writes of a sub-template raising an exception would be
+	# kept in the buffer of the calling template.
+	found = []
+	for nodes in iter_bodies(func_ast.body, guarded=False):
+		for i, node in enumerate(nodes):
+			if not isinstance(node, _ast.Expr) or getattr(node, 'pdt_silent', False):
+				continue
+			call = node.value
+			if not isinstance(call, _ast.Call) or not isinstance(call.func, _ast.Name) or call.starargs or call.kwargs:
+				continue
+			target = resolve_global(call.func, func_globals)
+			callee = getattr(target, '__pdt_template__', None)
+			if callee is None or callee.inline_def is None or callee is template:
+				continue
+			if callee.compiled_func.__globals__ is not func_globals or callee.compact != template.compact or callee.none_calls != template.none_calls:
+				continue
+			if not all(isinstance(arg, (_ast.Name, _ast.Str, _ast.Num)) for arg in call.args + [keyword.value for keyword in call.keywords]):
+				continue
+			found.append((nodes, i, target, callee))
+	
+	count = 0
+	for index, (nodes, i, target, callee) in enumerate(found):
+		stmt = inline_call(nodes[i], target, callee, index, local_names, enc_vars)
+		if stmt is not None:
+			nodes[i] = stmt
+			count += 1
+	if count:
+		optimizations['inline'] = count
+
+
+def inline_call(node, target, callee, index, local_names, enc_vars):
+	"""
+	Inlines the call to a sub-template.
+	
+	*node* (``ast.Expr``) is the expression calling the sub-template.
+	
+	*target* (``function``) is the sub-template function bound to the
+	called global name.
+	
+	*callee* (``Template``) is the sub-template.
+	
+	*index* (``int``) is the unique index of the inlined call.
+	
+	*local_names* (``set``) contains the names bound in the calling
+	template function.
+	
+	*enc_vars* (``dict``) contains the variables passed to the enclosing
+	function.
+	
+	Returns the statement replacing the expression (``ast.If``), or
+	``None`` if the arguments do not match the sub-template function or
+	a global it uses is shadowed by the calling template function.
+	"""
+	call = node.value
+	inline_def = callee.inline_def
+	params = [arg.id for arg in inline_def.args.args]
+	prefix = '__pdt_i%d_' % index
+	
+	# Bind arguments.
+	values = dict(zip(params, call.args))
+	if len(call.args) > len(params):
+		return None
+	for keyword in call.keywords:
+		if keyword.arg not in params or keyword.arg in values:
+			return None
+		values[keyword.arg] = keyword.value
+	defaults = callee.compiled_func.__defaults__ or ()
+	for param, default in zip(params[len(params) - len(defaults):], defaults):
+		if param not in values:
+			name = '__pdt_i%dd_%s' % (index, param)
+			enc_vars[name] = default
+			values[param] = _ast.Name(name, _ast_load)
+	if len(values) != len(params):
+		return None
+	
+	# Rename the locals of the sub-template.
+	inline_body = copy.deepcopy(inline_def.body)
+	names = set(params)
+	for sub in ast.walk(_ast.Module(inline_body)):
+		if isinstance(sub, _ast.Name) and isinstance(sub.ctx, (_ast.Store, _ast.Del)):
+			names.add(sub.id)
+	for sub in ast.walk(_ast.Module(inline_body)):
+		if isinstance(sub, _ast.Name):
+			if sub.id in names:
+				sub.id = prefix + sub.id
+			elif sub.id in local_names:
+				# The global would be shadowed by a local of the caller.
+				return None
+	
+	# Count the render of the sub-template.
+	counters = '__pdt_i%dc' % index
+	enc_vars[counters] = callee.counters
+	inline_body.insert(0, _ast.Expr(_ast.Call(_ast.Attribute(_ast.Name(counters, _ast_load), 'count', _ast_load), [], [], None, None)))
+	
+	# The sub-template is called while a tracer is set (see
+	# ``trace_prologue()``) so that its call is traced.
+	# if func is __pdt_inline<N> and __pdt_tracing is None:
+	#   <args>
+	#   <body>
+	# else:
+	#   func(...)
+	guard = '__pdt_inline%d' % index
+	enc_vars[guard] = target
+	assigns = [_ast.Assign([_ast.Name(prefix + param, _ast_store)], copy.deepcopy(values[param])) for param in params]
+	stmt = _ast.If(_ast.BoolOp(_ast.And(), [
+		_ast.Compare(_ast.Name(call.func.id, _ast_load), [_ast.Is()], [_ast.Name(guard, _ast_load)]),
+		_ast.Compare(_ast.Name('__pdt_tracing', _ast_load), [_ast.Is()], [_ast.Name('None', _ast_load)])
+	]), assigns + inline_body, [node])
+	for sub in ast.walk(_ast.Module(assigns + inline_body)):
+		if 'lineno' in sub._attributes:
+			ast.copy_location(sub, node)
+	ast.copy_location(stmt, node)
+	ast.copy_location(stmt.test, node)
+	for sub in ast.walk(stmt.test):
+		ast.copy_location(sub, node)
+	return stmt
+
+
+def compact_literals(body, mode, optimizations):
+	"""
+	Collapses the insignificant whitespace in the literal strings output by
+	a template function body. Literal string expressions and the literal
+	format strings of ``str.format()`` and ``%`` expressions are compacted
+	in source order so that preformatted blocks can span several literals.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*mode* (``str``) is the markup of the literals (i.e., "html").
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	"""
+	literals = []
+	for nodes in iter_bodies(body):
+		for node in nodes:
+			if not isinstance(node, _ast.Expr) or getattr(node, 'pdt_silent', False):
+				continue
+			value = node.value
+			if isinstance(value, _ast.Call) and isinstance(value.func, _ast.Attribute) and value.func.attr == 'format':
+				value = value.func.value
+			elif isinstance(value, _ast.BinOp) and isinstance(value.op, _ast.Mod):
+				value = value.left
+			if isinstance(value, _ast.Str):
+				literals.append(value)
+	literals.sort(key=lambda literal: (literal.lineno, literal.col_offset))
+	
+	compact = COMPACT_MODES[mode]
+	state = None
+	count = 0
+	for literal in literals:
+		text, state = compact(literal.s, state)
+		if text != literal.s:
+			literal.s = text
+			count += 1
+	if count:
+		optimizations['compact'] = count
+
+
+_html_markup_open = re.compile(r'<!--|<(pre|textarea|script|style)\b|<(?=[A-Za-z/!?])', re.I)
+"""
+*_html_markup_open* (``re.RegexObject``) matches the start of an HTML
+comment, of an element whose whitespace is significant (captured), or
+of any other tag.
+"""
+
+_html_tag_stop = re.compile(r'[\'">]')
+"""
+*_html_tag_stop* (``re.RegexObject``) matches the start of a quoted
+attribute value or the end of a tag.
+"""
+
+_html_space = re.compile(r'[ \t\r\n\f]+')
+"""
+*_html_space* (``re.RegexObject``) matches a run of HTML whitespace.
+"""
+
+
+def compact_html(text, state):
+	"""
+	Collapses the insignificant whitespace in HTML. Each run of whitespace
+	is collapsed into a newline if it contains one, and into a space
+	otherwise. Comments, quoted attribute values and the contents of
+	``pre``, ``textarea``, ``script`` and ``style`` elements are left as
+	is.
+	
+	*text* (``str`` or ``unicode``) is the HTML.
+	
+	*state* (``str``) is where *text* starts: ``None`` in text, "<" in a
+	tag, the quote character in a quoted attribute value, "!--" in a
+	comment, or the name of the element whose contents are being left as
+	is.
+	
+	Returns the compacted HTML (``str`` or ``unicode``), and the state at
+	the end of *text* (``str``).
+	"""
+	pieces = []
+	pos = 0
+	while pos < len(text):
+		if state is None:
+			# Collapse text up to the next tag or comment.
+			match = _html_markup_open.search(text, pos)
+			end = match.start() if match else len(text)
+			pieces.append(_html_space.sub(_compact_space, text[pos:end]))
+			if match is None:
+				break
+			pieces.append(match.group(0))
+			if match.group(0) == '<!--':
+				state = '!--'
+			elif match.group(1):
+				state = match.group(1).lower()
+			else:
+				state = '<'
+			pos = match.end()
+		elif state == '<':
+			# Collapse the tag up to the next quoted value or its end.
+			match = _html_tag_stop.search(text, pos)
+			end = match.start() if match else len(text)
+			pieces.append(_html_space.sub(_compact_space, text[pos:end]))
+			if match is None:
+				break
+			pieces.append(match.group(0))
+			state = None if match.group(0) == '>' else match.group(0)
+			pos = match.end()
+		else:
+			# Leave the quoted value, comment or element contents as is.
+			if state in ('"', "'"):
+				end = text.find(state, pos)
+				end, next_state = (end + 1, '<') if end != -1 else (len(text), state)
+			elif state == '!--':
+				end = text.find('-->', pos)
+				end, next_state = (end + 3, None) if end != -1 else (len(text), state)
+			else:
+				match = re.compile(r'</%s\b' % state, re.I).search(text, pos)
+				end, next_state = (match.end(), None) if match else (len(text), state)
+			pieces.append(text[pos:end])
+			state = next_state
+			pos = end
+	return text[:0].join(pieces), state
+
+
+def _compact_space(match):
+	"""
+	Collapses a run of whitespace.
+	
+	*match* (``re.MatchObject``) is the matched whitespace.
+	
+	Returns the collapsed whitespace (``str``).
+	"""
+	return '\n' if '\n' in match.group(0) else ' '
+
+
+COMPACT_MODES = {
+	'html': compact_html
+}
+"""
+*COMPACT_MODES* (``dict``) maps each supported *compact* value to the
+function compacting its literals.
+"""
+
+
+_percent_spec = re.compile(r"%(?:\((?P<key>[^)]*)\))?(?P<spec>[#0\- +]*(?:\d+)?(?:\.\d+)?[hlL]?(?P<conv>[diouxXeEfFgGcrs%]))")
+"""
+*_percent_spec* (``re.RegexObject``) matches a conversion specifier of a
+``%`` format string. Specifiers using ``*`` do not match.
+"""
+
+
+def precompile_formats(body, use_write_pieces, enc_vars, optimizations):
+	"""
+	Precompiles the literal format strings of the expressions of a
+	template function body. Expressions formatting a literal string with
+	``str.format()`` or ``%`` are replaced by writes of the literal pieces
+	and converted values so that no format string is parsed at runtime.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*use_write_pieces* (``bool``) is whether the pieces should be written
+	with a single call to the buffer's *write_pieces()*. Otherwise, each
+	piece is written separately.
+	
+	*enc_vars* (``dict``) contains the variables passed to the enclosing
+	function. The built-in conversion functions are added to it.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	
+	Returns the number of format strings precompiled (``int``).
+	"""
+	count = 0
+	temps = [0]
+	for nodes in iter_bodies(body):
+		i = 0
+		while i < len(nodes):
+			node = nodes[i]
+			result = None
+			if isinstance(node, _ast.Expr) and not getattr(node, 'pdt_silent', False):
+				result = parse_format_expr(node.value, temps)
+			if result is None:
+				i += 1
+				continue
+			
+			assigns, pieces = result
+			stmts = [ast.copy_location(assign, node) for assign in assigns]
+			if use_write_pieces:
+				# __pdt_write_pieces((piece, ...))
+				stmt = _ast.Expr(_ast.Call(_ast.Name('__pdt_write_pieces', _ast_load), [_ast.Tuple([piece for _, piece in pieces], _ast_load)], [], None, None))
+				stmt.pdt_silent = True
+				stmt.pdt_pieces = [piece for _, piece in pieces]
+				stmts.append(stmt)
+			else:
+				# A unicode format string outputs its values as unicode.
+				is_unicode = any(not is_value and isinstance(piece.s, unicode) for is_value, piece in pieces)
+				for is_value, piece in pieces:
+					if not is_value and not piece.s:
+						continue
+					elif is_value and (not isinstance(piece, _ast.Call) or (is_unicode and piece.func.id != '__pdt_format')):
+						# Make sure None is output like it would be by formatting.
+						# value -> __pdt_format(value, '')
+						piece = _ast.Call(_ast.Name('__pdt_format', _ast_load), [piece, _ast.Str(u'' if is_unicode else '')], [], None, None)
+					stmts.append(_ast.Expr(piece))
+			for stmt in stmts:
+				ast.copy_location(stmt, node)
+				for child in ast.walk(stmt):
+					ast.copy_location(child, node)
+			nodes[i:i + 1] = stmts
+			i += len(stmts)
+			count += 1
+	
+	if count:
+		enc_vars.update({
+			'__pdt_format': format,
+			'__pdt_repr': repr,
+			'__pdt_str': str
+		})
+		optimizations['formats'] = count
+	return count
+
+
+def parse_format_expr(expr, temps):
+	"""
+	Parses an expression formatting a literal string.
+	
+	*expr* (``ast.AST``) is the expression.
+	
+	*temps* (``list``) contains the counter used to name temporary
+	variables.
+	
+	Returns a ``tuple`` containing the statements assigning the arguments
+	to temporary variables (``list``), and the pieces to write (``list``
+	of ``tuple`` containing whether the piece is a value (``bool``), and
+	the piece (``ast.AST``)). Returns ``None`` if *expr* does not format a
+	literal string or it cannot be precompiled.
+	"""
+	if isinstance(expr, _ast.Call) and isinstance(expr.func, _ast.Attribute) and expr.func.attr == 'format' and isinstance(expr.func.value, _ast.Str):
+		if expr.starargs or expr.kwargs:
+			return None
+		fmt = expr.func.value.s
+		args = list(expr.args)
+		kw_names = [keyword.arg for keyword in expr.keywords]
+		kw_values = [keyword.value for keyword in expr.keywords]
+		parser = parse_brace_format
+	elif isinstance(expr, _ast.BinOp) and isinstance(expr.op, _ast.Mod) and isinstance(expr.left, _ast.Str):
+		fmt = expr.left.s
+		right = expr.right
+		if isinstance(right, _ast.Tuple):
+			args, kw_names, kw_values = list(right.elts), [], []
+		elif isinstance(right, _ast.Dict) and all(isinstance(key, _ast.Str) for key in right.keys):
+			args, kw_names, kw_values = [], [key.s for key in right.keys], list(right.values)
+		else:
+			# The mapping is only known to be one if the format string only
+			# uses keys.
+			args, kw_names, kw_values = None, None, [right]
+		parser = parse_percent_format
+	else:
+		return None
+	
+	# Assign the arguments which could have side effects to temporary
+	# variables to preserve their evaluation order.
+	assigns = []
+	values = []
+	for value in (args or []) + kw_values:
+		if not isinstance(value, (_ast.Name, _ast.Str, _ast.Num)):
+			temp = '__pdt_fmt%d' % temps[0]
+			temps[0] += 1
+			assigns.append(_ast.Assign([_ast.Name(temp, _ast_store)], value))
+			value = _ast.Name(temp, _ast_load)
+		values.append(value)
+	if args is not None:
+		args = values[:len(args)]
+		kw = dict(zip(kw_names, values[len(args):]))
+	else:
+		args = None
+		kw = values[0]
+	
+	try:
+		pieces = parser(fmt, args, kw)
+	except (ValueError, KeyError, IndexError):
+		# Leave invalid format strings to fail at runtime.
+		return None
+	if pieces is None:
+		return None
+	
+	# Merge adjacent literals.
+	merged = []
+	for is_value, piece in pieces:
+		if not is_value:
+			if not piece:
+				continue
+			elif merged and not merged[-1][0] and type(merged[-1][1].s) is type(piece):
+				merged[-1][1].s += piece
+				continue
+			piece = _ast.Str(piece)
+		merged.append((is_value, piece))
+	if isinstance(fmt, unicode) and all(is_value for is_value, _ in merged):
+		# Keep an empty literal so that the buffer outputs unicode like the
+		# formatted string would be.
+		merged.insert(0, (False, _ast.Str(fmt[:0])))
+	return assigns, merged
+
+
+def parse_brace_format(fmt, args, kw):
+	"""
+	Parses a ``str.format()`` format string.
+	
+	*fmt* (``str`` or ``unicode``) is the format string.
+	
+	*args* (``list``) contains the positional argument nodes.
+	
+	*kw* (``dict``) maps keyword argument name to node.
+	
+	Returns the pieces (``list``), or ``None`` if the format string cannot
+	be precompiled.
+	"""
+	pieces = []
+	auto_index = 0
+	has_auto = has_manual = False
+	empty = fmt[:0]
+	for literal, field_name, spec, conversion in fmt._formatter_parser():
+		pieces.append((False, literal))
+		if field_name is None:
+			continue
+		elif '{' in spec:
+			# Nested fields.
+			return None
+		
+		first, rest = field_name._formatter_field_name_split()
+		if first == '':
+			first = auto_index
+			auto_index += 1
+			has_auto = True
+		elif isinstance(first, (int, long)):
+			has_manual = True
+		if has_auto and has_manual:
+			return None
+		# .. NOTE: Arguments can be used by several fields and each use
+		#    needs its own node.
+		value = copy.deepcopy(args[first] if isinstance(first, (int, long)) else kw[first])
+		for is_attr, key in rest:
+			if is_attr:
+				value = _ast.Attribute(value, key, _ast_load)
+			else:
+				value = _ast.Subscript(value, _ast.Index(_ast.Num(key) if isinstance(key, (int, long)) else _ast.Str(key)), _ast_load)
+		
+		pieces.append((True, convert_format_value(value, conversion, spec or None, empty)))
+	return pieces
+
+
+def parse_percent_format(fmt, args, kw):
+	"""
+	Parses a ``%`` format string.
+	
+	*fmt* (``str`` or ``unicode``) is the format string.
+	
+	*args* (``list``) contains the positional argument nodes, or ``None``
+	if the right operand is a mapping.
+	
+	*kw* (``dict`` or ``ast.AST``) maps key to node, or is the mapping node
+	if *args* is ``None``.
+	
+	Returns the pieces (``list``), or ``None`` if the format string cannot
+	be precompiled.
+	"""
+	pieces = []
+	index = 0
+	pos = 0
+	for match in _percent_spec.finditer(fmt):
+		pieces.append((False, fmt[pos:match.start()]))
+		pos = match.end()
+		key, spec, conv = match.group('key', 'spec', 'conv')
+		if conv == '%':
+			if spec != '%':
+				return None
+			pieces.append((False, fmt[:0] + '%'))
+			continue
+		
+		if key is not None:
+			if args is not None:
+				if args:
+					return None
+				value = copy.deepcopy(kw[key])
+			else:
+				value = _ast.Subscript(copy.deepcopy(kw), _ast.Index(_ast.Str(key)), _ast_load)
+		else:
+			if args is None:
+				return None
+			value = args[index]
+			index += 1
+		
+		if spec == 's':
+			pieces.append((True, convert_format_value(value, None, None, fmt[:0])))
+		elif spec == 'r':
+			pieces.append((True, convert_format_value(value, 'r', None, fmt[:0])))
+		else:
+			# '%spec' % (value,)
+			pieces.append((True, _ast.BinOp(_ast.Str('%' + spec), _ast.Mod(), _ast.Tuple([value], _ast_load))))
+	
+	if '%' in fmt[pos:] or (args is not None and index != len(args)):
+		# Unsupported specifier or wrong number of arguments.
+		return None
+	pieces.append((False, fmt[pos:]))
+	return pieces
+
+
+def convert_format_value(value, conversion, spec, empty):
+	"""
+	Creates the node converting a format string field value.
+	
+	*value* (``ast.AST``) is the value node.
+	
+	*conversion* (``str``) is the conversion ("r" or "s"), or ``None``.
+	
+	*spec* (``str``) is the format spec, or ``None``.
+	
+	*empty* (``str`` or ``unicode``) is the empty string of the format
+	string type.
+	
+	Returns the converted value node (``ast.AST``).
+	"""
+	if conversion == 'r':
+		# __pdt_repr(value)
+		value = _ast.Call(_ast.Name('__pdt_repr', _ast_load), [value], [], None, None)
+	elif conversion == 's':
+		# __pdt_str(value)
+		value = _ast.Call(_ast.Name('__pdt_str', _ast_load), [value], [], None, None)
+	if spec is not None:
+		# __pdt_format(value, spec)
+		value = _ast.Call(_ast.Name('__pdt_format', _ast_load), [value, _ast.Str(empty + spec)], [], None, None)
+	return value
+
+
+def encode_literals(body, encoding, optimizations):
+	"""
+	Encodes the literal ``unicode`` string expressions of a template
+	function body.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	*encoding* (``str``) is the encoding.
+	
+	*optimizations* (``dict``) counts the optimizations applied.
+	"""
+	count = 0
+	for nodes in iter_bodies(body):
+		for node in nodes:
+			if not isinstance(node, _ast.Expr):
+				continue
+			elif getattr(node, 'pdt_pieces', None):
+				literals = node.pdt_pieces
+			elif not getattr(node, 'pdt_silent', False):
+				literals = [node.value]
+			else:
+				continue
+			for literal in literals:
+				if isinstance(literal, _ast.Str) and isinstance(literal.s, unicode):
+					literal.s = literal.s.encode(encoding)
+					count += 1
+	if count:
+		optimizations['encoded_literals'] = count
+
+
+_static_stmts = (_ast.Assign, _ast.AugAssign, _ast.Assert, _ast.ClassDef, _ast.Delete, _ast.FunctionDef, _ast.Global, _ast.Import, _ast.ImportFrom, _ast.Pass)
+"""
+*_static_stmts* (``tuple``) contains the types of the statements which
+never write to the buffer nor change the control flow (besides raising
+an exception).
+"""
+
+
+def find_static_prefix(body):
+	"""
+	Finds the literal string expressions which every call of a template
+	function starts its output with. The statements are analyzed from the
+	start of the body until the first statement which could write
+	something else or change the control flow.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	Returns the concatenated literal strings (``str`` or ``unicode``), or
+	``None`` if the output does not start with a literal string; and the
+	indices of the literal string expressions (``list``).
+	"""
+	pieces = []
+	indices = []
+	for i, node in enumerate(body):
+		if isinstance(node, _ast.Expr) and isinstance(node.value, _ast.Str) and not getattr(node, 'pdt_silent', False):
+			if pieces and type(node.value.s) is not type(pieces[0]):
+				break
+			pieces.append(node.value.s)
+			indices.append(i)
+		elif not isinstance(node, _static_stmts):
+			break
+	return (pieces[0][:0].join(pieces) if pieces else None), indices
+
+
+def pop_static_prefix(body):
+	"""
+	Removes the literal string expressions which every call of a template
+	function starts its output with. See ``find_static_prefix()``.
+	
+	*body* (``list``) contains the statements of the template function.
+	
+	Returns the concatenated literal strings (``str`` or ``unicode``), or
+	``None`` if the output does not start with a literal string.
+	"""
+	prefix, indices = find_static_prefix(body)
+	for i in reversed(indices):
+		del body[i]
+	return prefix
+
+
+def find_code(code, name):
+	"""
+	Finds a code object defined by a compiled module.
+	
+	*code* (``code``) is the module code object.
+	
+	*name* (``str``) is the name of the function whose code object to
+	find.
+	
+	Returns the function code object (``code``).
+	"""
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType) and const.co_name == name:
+			return const
+	raise LookupError("Code object %r not found in %r." % (name, code))
 
 
 def dedent_func_lines(func_lines):
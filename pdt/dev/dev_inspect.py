@@ -17,7 +17,6 @@ import textwrap
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../")))
 
-import astpp
 import dev_lib
 import pdt
 
@@ -51,7 +50,7 @@ def main(argv):
 	
 	print "AST"
 	print "---"
-	print astpp.dump(mod_ast, include_attributes=True, indent=" ")
+	print pdt.dump_ast(mod_ast, include_attributes=True, indent=" ")
 
 if __name__ == '__main__':
 	sys.exit(main(sys.argv))
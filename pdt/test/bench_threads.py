@@ -0,0 +1,101 @@
+# coding: utf-8
+"""
+This script benchmarks rendering the template from "test.py" from
+several threads at once, and reports the throughput for each thread
+count. Throughput only scales with the thread count on a Python build
+without a global interpreter lock.
+"""
+
+__author__ = "Caleb P. Burns"
+__version__ = "0.1"
+__status__ = "Prototype"
+
+import imp
+import optparse
+import os.path
+import sys
+import threading
+import time
+
+SETUP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, SETUP_DIR)
+
+import pdt
+
+# Load "test.py" under another name because it would be shadowed by the
+# standard "test" package.
+test = imp.load_source('pdt_test_render', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.py'))
+
+def get_data():
+	loc = '123456789'
+	data = {}
+	data['menu_url'] = ('/', [])
+	data['loc'] = loc
+	data['add_url'] = ('/audit', [('loc', loc), ('action', 'add')])
+	data['finish_url'] = ('/audit', [('loc', loc), ('action', 'finish')])
+	data['cancel_url'] = ('/audit', [('loc', loc), ('action', 'cancel')])
+	data['active_item'] = 'SS-333-006-03-16'
+	data['items'] = [{
+		'qty': i,
+		'sku': "SKU-%d" % i,
+		'brand': "Brand %d" % i,
+		'title': "Item <%d> & Co" % i,
+		'item_url': ('/item', [('sku', "SKU-%d" % i)]),
+		'inc_url': ('/audit', [('loc', loc), ('action', 'item_inc')]),
+		'dec_url': ('/audit', [('loc', loc), ('action', 'item_dec')])
+	} for i in xrange(20)]
+	return data
+
+def render(data):
+	# NOTE: The "render()" template deliberately raises an exception part
+	# way through (to test tracebacks) so the work up to it is measured.
+	try:
+		test.render(**data)
+	except Exception:
+		pass
+
+def run(thread_count, renders):
+	data = get_data()
+	per_thread = renders // thread_count
+	start = threading.Event()
+
+	def worker():
+		start.wait()
+		for _ in xrange(per_thread):
+			render(data)
+
+	threads = [threading.Thread(target=worker) for _ in xrange(thread_count)]
+	for thread in threads:
+		thread.start()
+	started = time.time()
+	start.set()
+	for thread in threads:
+		thread.join()
+	return per_thread * thread_count, time.time() - started
+
+def main(argv):
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option('-n', '--renders', type='int', default=20000, help="Total number of renders per run. Default is %default.")
+	parser.add_option('-t', '--threads', default='1,2,4,8', help="Comma separated thread counts. Default is %default.")
+	opts, _ = parser.parse_args(argv[1:])
+
+	counters = test.render.__pdt_template__.counters
+	base = None
+	print "%7s  %10s  %8s  %7s" % ("threads", "renders/s", "seconds", "scaling")
+	for thread_count in map(int, opts.threads.split(',')):
+		counters.reset()
+		renders, seconds = run(thread_count, opts.renders)
+
+		# The per-thread render counters must not lose counts.
+		if counters.renders != renders:
+			print >> sys.stderr, "Counted %d renders instead of %d." % (counters.renders, renders)
+			return 1
+
+		rate = renders / seconds
+		if base is None:
+			base = rate
+		print "%7d  %10.0f  %8.3f  %6.2fx" % (thread_count, rate, seconds, rate / base)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -4,10 +4,21 @@ This script tests the general implementation of the ``template``
 function and the ``Template`` class.
 """
 
+import cProfile
+import hashlib
 import inspect
+import io
+import json
 import os.path
+import pstats
+import StringIO
 import sys
+import tempfile
+import thread
+import threading
+import time
 import unittest
+import zlib
 from xml.sax.saxutils import escape, quoteattr
 
 SETUP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -100,6 +111,938 @@ class TemplateTest(unittest.TestCase):
 		TestClass.classfunc(TestClass)
 		TestClass.staticfunc()
 
+	def test_03_lazy_warmup(self):
+		# Create lazy template.
+		temp = pdt.template(lazy=True)(self.func)
+		wrapped = temp.__pdt_template__
+		
+		# Make sure template is not compiled until it is warmed up.
+		self.assertTrue(wrapped.compiled_func is None)
+		self.assertTrue(wrapped in pdt.warmup([temp]))
+		self.assertTrue(wrapped.compiled_func is not None)
+		self.assertTrue(wrapped.compiled_func.__pdt_template__ is wrapped)
+		
+		# Make sure template output is what is expected.
+		temp_str = temp(self.func_data)
+		self.assertTrue(temp_str == self.func_str)
+		
+		# Make sure the names of lazy templates are rebound once they are
+		# compiled.
+		wrapper = lazy_item
+		method_wrapper = LazyPage.__dict__['render']
+		self.assertTrue(wrapper.__pdt_template__.compiled_func is None)
+		self.assertTrue(lazy_item("spam") == "<i>spam</i>")
+		self.assertTrue(LazyPage().render() == "<p>")
+		self.assertTrue(lazy_item is wrapper.__pdt_template__.compiled_func)
+		self.assertTrue(LazyPage.__dict__['render'] is method_wrapper.__pdt_template__.compiled_func)
+		self.assertTrue(wrapper("eggs") == "<i>eggs</i>")
+		
+		# Make sure module templates are found.
+		self.assertTrue(wrapped in pdt.warmup(sys.modules[__name__]))
+		
+		# Make sure concurrent first calls compile a lazy template once.
+		temp = pdt.template(lazy=True)(self.func)
+		compile_func = pdt.Template.compile
+		compiles = []
+		def slow_compile(template, *args):
+			compiles.append(template)
+			time.sleep(0.05)
+			return compile_func(template, *args)
+		pdt.Template.compile = slow_compile
+		try:
+			threads = [threading.Thread(target=temp, args=(self.func_data,)) for _ in xrange(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		finally:
+			pdt.Template.compile = compile_func
+		self.assertTrue(compiles == [temp.__pdt_template__])
+
+	def test_04_memory_report(self):
+		# Compile template.
+		temp = pdt.template(self.func)
+		
+		# Make sure the template memory is reported.
+		report = pdt.memory_report([temp])
+		self.assertTrue(len(report) == 1)
+		usage = report[0]
+		self.assertTrue(usage.name == __name__ + '.html_func')
+		self.assertTrue(usage.code > 0 and usage.consts > 0 and usage.closure > 0)
+		self.assertTrue(usage.total == usage.code + usage.consts + usage.closure + usage.inline_ast)
+		
+		# Make sure the AST kept for inlining is reported and can be dropped.
+		item = inline_item.__pdt_template__
+		inline_def = item.inline_def
+		try:
+			self.assertTrue(pdt.memory_report([item])[0].inline_ast > 0)
+			pdt.warmup([item], drop_inline=True)
+			self.assertTrue(item.inline_def is None)
+			self.assertTrue(pdt.memory_report([item])[0].inline_ast == 0)
+		finally:
+			item.inline_def = inline_def
+		
+		# Make sure the original function is not retained.
+		self.assertTrue(temp.__pdt_template__.orig_func is None)
+
+	def test_05_specialize(self):
+		# Create template.
+		@pdt.template
+		def temp(locale, name, debug=False):
+			"<h1>{}</h1>".format({'en': "Hello", 'fr': "Bonjour"}[locale])
+			if locale == 'fr':
+				" Monsieur"
+			if debug:
+				" (debug)"
+			" " + name
+		
+		# Specialize template.
+		spec = pdt.specialize(temp, locale='fr', debug=False)
+		self.assertTrue(inspect.getargspec(spec).args == ['name'])
+		
+		# Make sure branches and expressions were folded.
+		optimizations = spec.__pdt_template__.optimizations
+		self.assertTrue(optimizations['branch'] == 2)
+		self.assertTrue(optimizations['fold'] >= 2)
+		
+		# Make sure specialized template output is what is expected.
+		self.assertTrue(spec("Burns") == temp('fr', "Burns"))
+		self.assertTrue(spec("Burns") == "<h1>Bonjour</h1> Monsieur Burns")
+
+	def test_06_etag(self):
+		# Compile template.
+		temp = pdt.template(etag='sha1')(self.func)
+		
+		# Make sure the leading literal was hashed at compile time.
+		self.assertTrue(temp.__pdt_template__.optimizations.get('etag_prefix') is None)
+		
+		# Make sure template output and ETag are what is expected.
+		temp_str, temp_etag = temp(self.func_data)
+		self.assertTrue(temp_str == self.func_str)
+		self.assertTrue(temp_etag == hashlib.sha1(self.func_str).hexdigest())
+		
+		# Create template starting with literals.
+		@pdt.template(etag=True)
+		def temp(name):
+			"<html>"
+			"<body>"
+			name
+			"</body></html>"
+		
+		self.assertTrue(temp.__pdt_template__.optimizations['etag_prefix'] == len("<html><body>"))
+		temp_str, temp_etag = temp("Eggs")
+		self.assertTrue(temp_str == "<html><body>Eggs</body></html>")
+		self.assertTrue(temp_etag == hashlib.new(pdt.ETAG_ALGORITHM, temp_str).hexdigest())
+		self.assertTrue(temp("Ham") == ("<html><body>Ham</body></html>", hashlib.new(pdt.ETAG_ALGORITHM, "<html><body>Ham</body></html>").hexdigest()))
+
+	def test_07_gzip(self):
+		# Compile template.
+		temp = pdt.template(io_factory=pdt.GzipIO, io_kw={'level': 9})(self.func)
+		
+		# Make sure template output is compressed.
+		temp_gz = temp(self.func_data)
+		self.assertTrue(zlib.decompress(temp_gz, pdt.GZIP_WBITS) == self.func_str)
+		
+		# Compile streaming template.
+		page = pdt.template(self.func)
+		
+		@pdt.template(io_factory=pdt.GzipIO, io_param='sink', io_kw={'flush_size': 1})
+		def temp(sink, page, data):
+			page(data)
+		
+		# Make sure compressed chunks are streamed.
+		chunks = []
+		self.assertTrue(temp(chunks.append, page, self.func_data) is None)
+		self.assertTrue(len(chunks) > 1)
+		self.assertTrue(zlib.decompress(''.join(chunks), pdt.GZIP_WBITS) == self.func_str)
+
+	def test_08_spooled(self):
+		# Make sure small output is held in memory.
+		temp = pdt.template(io_factory=pdt.SpooledListIO)(self.func)
+		self.assertTrue(temp(self.func_data) == self.func_str)
+		
+		# Make sure large output is spilled to a temporary file.
+		temp = pdt.template(io_factory=pdt.SpooledListIO, io_kw={'max_size': 1024})(self.func)
+		temp_file = temp(self.func_data)
+		self.assertTrue(hasattr(temp_file, 'read'))
+		self.assertTrue(temp_file.read() == self.func_str)
+		
+		# Make sure spilled output can be memory-mapped.
+		temp = pdt.template(io_factory=pdt.SpooledListIO, io_kw={'max_size': 1024, 'mmap': True})(self.func)
+		temp_map = temp(self.func_data)
+		self.assertTrue(temp_map[:] == self.func_str)
+
+	def test_09_chunks(self):
+		# Compile template.
+		temp = pdt.template(io_factory=pdt.ChunksIO)(self.func)
+		
+		# Make sure template output is chunked.
+		chunks = temp(self.func_data)
+		self.assertTrue(isinstance(chunks, pdt.Chunks))
+		self.assertTrue(len(chunks) == len(self.func_str))
+		self.assertTrue(''.join(chunks) == self.func_str)
+		self.assertTrue(chunks.to_bytes() == self.func_str)
+		
+		# Make sure chunks are spliced into another template.
+		@pdt.template
+		def temp(page, data):
+			"<!-- begin -->"
+			page(data)
+			u"<!-- end -->"
+		
+		temp_str = temp(pdt.template(io_factory=pdt.ChunksIO)(self.func), self.func_data)
+		self.assertTrue(temp_str == "<!-- begin -->" + self.func_str + "<!-- end -->")
+		
+		# Make sure spliced chunks are hashed.
+		temp = pdt.template(etag='sha1')(temp)
+		temp_str, temp_etag = temp(pdt.template(io_factory=pdt.ChunksIO)(self.func), self.func_data)
+		self.assertTrue(temp_etag == hashlib.sha1(temp_str).hexdigest())
+
+	def test_10_stream(self):
+		# Compile template.
+		page = pdt.template(self.func)
+		
+		@pdt.template(io_factory=pdt.StreamIO, io_param='out', io_kw={'max_bytes': 512})
+		def temp(out, page, data):
+			page(data)
+			u" \u2713"
+		
+		# Make sure template output is written to the stream.
+		fh = tempfile.TemporaryFile()
+		self.assertTrue(temp(fh, page, self.func_data) is None)
+		fh.seek(0)
+		self.assertTrue(fh.read() == self.func_str + " \xe2\x9c\x93")
+		
+		# Make sure a single chunk is written without joining the batch.
+		@pdt.template(io_factory=pdt.StreamIO, io_param='out', io_kw={'max_chunks': 1})
+		def temp(out, data):
+			data
+		
+		join_bytes = pdt.join_bytes
+		pdt.join_bytes = None
+		try:
+			fh = tempfile.TemporaryFile()
+			temp(fh, bytearray("<p>Spam</p>"))
+		finally:
+			pdt.join_bytes = join_bytes
+		fh.seek(0)
+		self.assertTrue(fh.read() == "<p>Spam</p>")
+
+	def test_11_encoding(self):
+		# Compile template.
+		@pdt.template(encoding='utf-8')
+		def temp(name):
+			u"<p>\u2713 "
+			name
+			u"</p>"
+			5
+		
+		# Make sure literals were encoded at compile time.
+		self.assertTrue(temp.__pdt_template__.optimizations['encoded_literals'] == 2)
+		self.assertTrue(u"<p>\u2713 ".encode('utf8') in temp.__code__.co_consts)
+		
+		# Make sure template output is encoded.
+		temp_bytes = temp(u"\xe9")
+		self.assertTrue(isinstance(temp_bytes, bytearray))
+		self.assertTrue(temp_bytes == u"<p>\u2713 \xe9</p>5".encode('utf8'))
+		
+		# Make sure ETags cannot be combined with an encoding.
+		self.assertRaises(TypeError, pdt.template, encoding='utf-8', etag=True)
+
+	def test_12_bytes_like(self):
+		# Create template.
+		@pdt.template(io_factory=pdt.ChunksIO)
+		def temp(fragment, view):
+			"<div>"
+			fragment
+			view
+			"</div>"
+		
+		# Make sure bytes-like objects are kept by reference.
+		fragment = bytearray("<p>Eggs</p>")
+		view = memoryview("<p>Spam</p><p>Ham</p>")[:11]
+		chunks = temp(fragment, view)
+		self.assertTrue(chunks.chunks[1] is fragment)
+		self.assertTrue(chunks.chunks[2] is view)
+		self.assertTrue(chunks.getvalue() == "<div><p>Eggs</p><p>Spam</p></div>")
+		
+		# Make sure bytes-like objects are written by the other buffers.
+		expected = "<div><p>Eggs</p><p>Spam</p></div>"
+		self.assertTrue(pdt.template(temp)(fragment, view) == expected)
+		self.assertTrue(pdt.template(io_factory=pdt.ByteArrayIO)(temp)(fragment, view) == expected)
+		self.assertTrue(zlib.decompress(pdt.template(io_factory=pdt.GzipIO)(temp)(fragment, view), pdt.GZIP_WBITS) == expected)
+		self.assertTrue(pdt.template(io_factory=pdt.SpooledListIO, io_kw={'max_size': 8})(temp)(fragment, view).read() == expected)
+		self.assertTrue(pdt.template(io_factory=pdt.SpooledListIO)(temp)(fragment, view) == expected)
+		self.assertTrue(pdt.template(io_factory=pdt.ETagIO)(temp)(fragment, view) == (expected, hashlib.sha1(expected).hexdigest()))
+		
+		# Make sure the bytes-like chunks of a ChunksIO output are written.
+		self.assertTrue(pdt.template(io_factory=pdt.ByteArrayIO)(temp)(chunks, "") == "<div>" + expected + "</div>")
+		
+		# Make sure bytes-like objects are joined into a single copy.
+		joined = pdt.join_bytes(["<div>", fragment, view])
+		self.assertTrue(isinstance(joined, bytearray) and joined == "<div><p>Eggs</p><p>Spam</p>")
+
+	def test_13_none_calls(self):
+		# Create template.
+		@pdt.template(none_calls=pdt.NONE_CALLS | set(['push']))
+		def temp(items, stack):
+			items.append("eggs")
+			stack.push("spam")
+			side_effect_func(items)
+			len(items)
+		
+		# Make sure calls returning None are not written.
+		self.assertTrue(temp.__pdt_template__.optimizations['none_calls'] == 3)
+		self.assertTrue(temp([], Stack()) == "1")
+		
+		# Make sure calls are written by default.
+		class Messages(object):
+			def error(self, msg):
+				return "<div class=error>%s</div>" % msg
+		
+		@pdt.template
+		def temp(messages, msg):
+			"<p>"
+			messages.error(msg)
+			"</p>"
+		
+		self.assertTrue('none_calls' not in temp.__pdt_template__.optimizations)
+		self.assertTrue(temp(Messages(), "spam") == "<p><div class=error>spam</div></p>")
+
+	def test_14_formats(self):
+		# Create template.
+		def temp(item, count, attrs):
+			"<li id='{0[item_id]}'>{0[title]!r} {1:>3}</li>".format(item, count)
+			"<span>%s %r %03d %%</span>" % (item['brand'], item['title'], count)
+			"<span class='%(class)s'></span>" % attrs
+			u"{}".format(None)
+		
+		# Make sure precompiled formats output the same as formatting.
+		item = html_data['items'][0]
+		attrs = {'class': "brand"}
+		expected = "".join([
+			"<li id='{0[item_id]}'>{0[title]!r} {1:>3}</li>".format(item, 2),
+			"<span>%s %r %03d %%</span>" % (item['brand'], item['title'], 2),
+			"<span class='%(class)s'></span>" % attrs,
+			"None"
+		])
+		compiled = pdt.template(temp)
+		self.assertTrue(compiled.__pdt_template__.optimizations['formats'] == 4)
+		self.assertTrue(compiled(item, 2, attrs) == expected)
+		
+		# Make sure formats are precompiled for buffers without write_pieces().
+		compiled = pdt.template(io_factory=pdt.GzipIO)(temp)
+		self.assertTrue(zlib.decompress(compiled(item, 2, attrs), pdt.GZIP_WBITS) == expected)
+		
+		# Make sure the writelines() of other buffers is not used.
+		@pdt.template(io_factory=io.BytesIO)
+		def temp(count):
+			"<b>{}</b>".format(count)
+		
+		self.assertTrue(temp(5) == "<b>5</b>")
+		
+		# Make sure unicode format strings output unicode values.
+		def temp(count, name):
+			u"{}".format(count)
+			u"%s" % (count,)
+			u"{!r}".format(count)
+			name
+		
+		self.assertTrue(pdt.template(temp)(5, u"\xe9") == u"555\xe9")
+		self.assertTrue(pdt.template(io_factory=io.StringIO)(temp)(5, u"\xe9") == u"555\xe9")
+		self.assertTrue(pdt.template(io_factory=pdt.ByteArrayIO)(temp)(5, u"\xe9") == u"555\xe9".encode('utf8'))
+
+	def test_15_compact(self):
+		# Create template.
+		@pdt.template(compact='html')
+		def temp(title):
+			"""
+			<div>
+				<h1>{}</h1>
+				<pre>
+	spam  and
+		eggs</pre>
+				<script>
+			""".format(title)
+			"""
+					var  x;
+				</script>
+			</div>
+			"""
+			"  <span>  %s  </span>  " % title
+		
+		# Make sure whitespace is collapsed outside of preformatted elements.
+		self.assertTrue(temp.__pdt_template__.optimizations['compact'] == 3)
+		self.assertTrue(temp("Spam  Ham") == "\n<div>\n<h1>Spam  Ham</h1>\n<pre>\n\tspam  and\n\t\teggs</pre>\n<script>\n\t\t\t\n\t\t\t\t\tvar  x;\n\t\t\t\t</script>\n</div>\n <span> Spam  Ham </span> ")
+		
+		# Make sure quoted attribute values and comments are left as is.
+		@pdt.template(compact='html')
+		def temp(value):
+			"""
+			<input  type="text"  value="a  b"  title='c  {}'>
+			<!--  keep  this  -->
+			<p  class="x">  d  </p>
+			""".format(value)
+		
+		self.assertTrue(temp("e  f") == """\n<input type="text" value="a  b" title='c  e  f'>\n<!--  keep  this  -->\n<p class="x"> d </p>\n""")
+		
+		# Make sure unsupported markup is rejected.
+		self.assertRaises(ValueError, pdt.template, compact='xml')
+
+	def test_16_inline(self):
+		global inline_item
+		
+		# Create template.
+		@pdt.template(inline=True)
+		def temp(titles):
+			"<ul>"
+			for title in titles:
+				inline_item(title)
+				inline_item(title, cls="last")
+			"</ul>"
+		
+		# Make sure sub-template calls are inlined.
+		expected = "<ul><li class='item'>SPAM</li><li class='last'>SPAM</li></ul>"
+		self.assertTrue(temp.__pdt_template__.optimizations['inline'] == 2)
+		self.assertTrue(temp(["spam"]) == expected)
+		self.assertTrue(pdt.template(inline=False)(temp)(["spam"]) == expected)
+		
+		# Make sure inlining is opt-in for the caller and the sub-template.
+		@pdt.template
+		def temp_default(title):
+			inline_item(title)
+		
+		@pdt.template(inline=True)
+		def temp_plain(title):
+			plain_item(title)
+		
+		self.assertTrue('inline' not in temp_default.__pdt_template__.optimizations)
+		self.assertTrue('inline' not in temp_plain.__pdt_template__.optimizations)
+		self.assertTrue(plain_item.__pdt_template__.inline_def is None)
+		self.assertTrue(temp_plain("spam") == "<i>spam</i>")
+		
+		# Make sure calls inside try statements are not inlined so that the
+		# writes of a failed sub-template are discarded.
+		@pdt.template(inline=True)
+		def temp_try(title):
+			"start "
+			try:
+				inline_bold(title)
+			except AttributeError:
+				"fallback"
+			" end"
+		
+		self.assertTrue('inline' not in temp_try.__pdt_template__.optimizations)
+		self.assertTrue(temp_try(None) == "start fallback end")
+		self.assertTrue(temp_try("a") == "start <b>A end")
+		
+		# Make sure inlined renders are counted.
+		counters = inline_item.__pdt_template__.counters
+		renders = counters.renders
+		temp(["spam", "eggs"])
+		self.assertTrue(counters.renders == renders + 4)
+		
+		# Make sure the globals of the sub-template are not shadowed by the
+		# locals of the caller.
+		@pdt.template(inline=True)
+		def temp_local(title):
+			escape_title = lambda s: "LOCAL"
+			inline_escape(title)
+		
+		self.assertTrue('inline' not in temp_local.__pdt_template__.optimizations)
+		self.assertTrue(temp_local("a") == "ESC(a)")
+		
+		# Make sure sub-templates with budgets are not inlined.
+		@pdt.template(inline=True)
+		def temp_budget(title):
+			inline_limited(title)
+		
+		self.assertTrue('inline' not in temp_budget.__pdt_template__.optimizations)
+		self.assertRaises(pdt.BudgetExceeded, temp_budget, "toolong")
+		
+		# Make sure the sub-template is called when its name is rebound.
+		orig_item = inline_item
+		try:
+			inline_item = lambda title, cls=None: title
+			self.assertTrue(temp(["spam"]) == "<ul>spamspam</ul>")
+		finally:
+			inline_item = orig_item
+
+	def test_17_static_prefix(self):
+		# Create template.
+		def temp(title):
+			"<html><head>"
+			css = "/style.css"
+			"<link rel='stylesheet' href='%s'/>" % css
+			"</head>"
+			"<body>"
+			title
+			"</body></html>"
+		
+		# Make sure the static prefix spans non-output statements.
+		compiled = pdt.template(temp)
+		self.assertTrue(pdt.static_prefix(compiled) == "<html><head>")
+		self.assertTrue(compiled("Spam") == "<html><head><link rel='stylesheet' href='/style.css'/></head><body>Spam</body></html>")
+		
+		# Make sure the static prefix can be left out of the output.
+		compiled = pdt.template(lazy=True, split_prefix=True, etag=True)(temp)
+		prefix = pdt.static_prefix(compiled)
+		output, etag = compiled("Spam")
+		self.assertTrue(prefix == "<html><head>")
+		self.assertTrue(output == "<link rel='stylesheet' href='/style.css'/></head><body>Spam</body></html>")
+		self.assertTrue(etag == hashlib.new(pdt.ETAG_ALGORITHM, prefix + output).hexdigest())
+
+	def test_18_slots(self):
+		# Create template.
+		def temp(items):
+			"<title>"
+			pdt.slot('title')
+			"</title><ul>"
+			for item in items:
+				"<li>%s</li>" % item['title']
+			"</ul>"
+			pdt.fill('title', "%d Items" % len(items))
+			pdt.slot('empty')
+		
+		# Make sure slots are filled when the output is returned.
+		compiled = pdt.template(temp)
+		self.assertTrue(compiled.__pdt_template__.optimizations['slots'] == 3)
+		items = html_data['items'][:2]
+		expected = "<title>2 Items</title><ul><li>Scorpion Vision Vest</li><li>Z1R Nomad Ghost Flames Half Helmet</li></ul>"
+		self.assertTrue(compiled(items) == expected)
+		self.assertTrue(pdt.template(io_factory=pdt.ChunksIO)(temp)(items).getvalue() == expected)
+		
+		# Make sure slots are rejected by buffers which cannot support them.
+		self.assertRaises(TypeError, pdt.template(etag=True), temp)
+		self.assertRaises(RuntimeError, pdt.slot, 'title')
+
+	def test_19_defer(self):
+		# Create template.
+		@pdt.template
+		def temp(futures):
+			"<div>"
+			for future in futures:
+				pdt.defer(future)
+			"</div>"
+		
+		# Make sure deferred results run concurrently and are written in
+		# order.
+		started = time.time()
+		output = temp([ThreadFuture(lambda: "<p>Spam</p>", 0.2), ThreadFuture(lambda: "<p>Eggs</p>", 0.1)])
+		self.assertTrue(output == "<div><p>Spam</p><p>Eggs</p></div>")
+		self.assertTrue(time.time() - started < 0.3)
+
+	def test_20_budget(self):
+		# Create template.
+		def temp(rows):
+			"<table>"
+			for row in rows:
+				"<tr><td>%s</td></tr>" % row
+			"</table>"
+		
+		# Make sure output within the budget is returned.
+		compiled = pdt.template(max_bytes=100, max_seconds=10)(temp)
+		self.assertTrue(compiled([1]) == "<table><tr><td>1</td></tr></table>")
+		
+		# Make sure the size of the output is limited.
+		try:
+			compiled(xrange(100))
+		except pdt.BudgetExceeded as e:
+			self.assertTrue(e.limit == 'max_bytes')
+		else:
+			self.fail("BudgetExceeded not raised.")
+		
+		# Make sure written data is converted once.
+		class Value(object):
+			calls = 0
+			def __str__(self):
+				Value.calls += 1
+				return "value"
+		
+		@pdt.template(max_bytes=100)
+		def temp_value(value):
+			value
+			"<b>{}</b>".format(value)
+		
+		self.assertTrue(temp_value(Value()) == "value<b>value</b>")
+		self.assertTrue(Value.calls == 2)
+		
+		# Make sure the converted data is sized by the buffer.
+		for io_factory in [pdt.ListIO, pdt.ByteArrayIO, pdt.SpooledListIO, pdt.GzipIO]:
+			self.assertRaises(pdt.BudgetExceeded, pdt.template(max_bytes=16, io_factory=io_factory)(temp_value.__pdt_template__.func), Value())
+		
+		# Make sure the data is passed to other buffers as is.
+		class SumIO(object):
+			def __init__(self):
+				self.total = 0
+			def write(self, data):
+				self.total += data
+			def getvalue(self):
+				return self.total
+		
+		@pdt.template(io_factory=SumIO, max_seconds=10.0)
+		def temp_sum(values):
+			for value in values:
+				value
+		
+		self.assertTrue(temp_sum([1, 2]) == 3)
+		
+		# Make sure the time spent rendering is limited at loop back-edges.
+		def slow_rows():
+			while True:
+				time.sleep(0.01)
+				yield None
+		
+		@pdt.template(max_seconds=0.05)
+		def temp(rows):
+			for row in rows:
+				pass
+		
+		try:
+			temp(slow_rows())
+		except pdt.BudgetExceeded as e:
+			self.assertTrue(e.limit == 'max_seconds')
+		else:
+			self.fail("BudgetExceeded not raised.")
+
+	def test_21_registry(self):
+		# Make sure module level templates are registered by name.
+		temp = pdt.lookup(__name__ + '.inline_item')
+		self.assertTrue(temp is inline_item.__pdt_template__)
+		self.assertTrue(temp in pdt.list_templates())
+		self.assertRaises(KeyError, pdt.lookup, __name__ + '.missing')
+		
+		# Make sure templates are registered by qualified name.
+		class A(object):
+			@pdt.template
+			def render(self):
+				"A"
+		
+		class B(object):
+			@pdt.template
+			def render(self):
+				"B"
+		
+		prefix = __name__ + '.TemplateTest.test_21_registry.<locals>.'
+		self.assertTrue(pdt.lookup(prefix + 'A.render') is A.__dict__['render'].__pdt_template__)
+		self.assertTrue(pdt.lookup(prefix + 'B.render') is B.__dict__['render'].__pdt_template__)
+		self.assertTrue(A().render() == "A" and B().render() == "B")
+		
+		# Make sure renders are counted.
+		pdt.reset_counters([temp])
+		inline_item("spam")
+		inline_item("eggs")
+		info = temp.info()
+		self.assertTrue(info.renders == 2)
+		self.assertTrue(info.compile_time >= 0 and info.code_size > 0)
+		self.assertTrue(info.source_file == inspect.getsourcefile(TemplateTest))
+		self.assertTrue(info.source_lines[1] - info.source_lines[0] == 3)
+		
+		# Make sure recompiling keeps the function.
+		func = temp.compiled_func
+		self.assertTrue(pdt.recompile([temp]) == [temp])
+		self.assertTrue(temp.compiled_func is func)
+		self.assertTrue(inline_item("spam") == "<li class='item'>SPAM</li>")
+		self.assertTrue(temp.counters.renders == 3)
+		
+		# Make sure recompiling keeps a function whose closure holds the
+		# budget, and rebinds the class attribute when the closure changes.
+		page = BudgetPage.__dict__['render'].__pdt_template__
+		func = page.compiled_func
+		self.assertTrue(pdt.recompile([page]) == [page])
+		self.assertTrue(BudgetPage.__dict__['render'] is func)
+		try:
+			page.max_bytes = 1
+			pdt.recompile([page])
+			self.assertTrue(BudgetPage.__dict__['render'] is page.compiled_func is not func)
+			self.assertRaises(pdt.BudgetExceeded, BudgetPage().render)
+		finally:
+			page.max_bytes = 100
+			pdt.recompile([page])
+		self.assertTrue(BudgetPage().render() == "<p>")
+		
+		# Make sure renders are counted per thread without losing counts.
+		def render():
+			for _ in xrange(1000):
+				inline_item("spam")
+		threads = [threading.Thread(target=render) for _ in xrange(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertTrue(temp.counters.renders == 4003)
+		
+		# Make sure the counters of exited threads are merged. The cell of a
+		# thread can be merged just after it is joined.
+		threads = [threading.Thread(target=inline_item, args=("spam",)) for _ in xrange(50)]
+		for thread in threads:
+			thread.start()
+			thread.join()
+		for _ in xrange(100):
+			if len(temp.counters.cells) <= 1:
+				break
+			time.sleep(0.01)
+		self.assertTrue(len(temp.counters.cells) <= 1)
+		self.assertTrue(temp.counters.renders == 4053)
+
+	def test_22_threaded_compile(self):
+		# Create template.
+		def temp(title):
+			"<h1>%s</h1>" % title
+		
+		# Make sure templates compile concurrently without modifying the
+		# module globals.
+		names = set(globals())
+		results = []
+		def compile_temp():
+			for _ in xrange(20):
+				results.append(pdt.template(temp)("Spam"))
+		threads = [threading.Thread(target=compile_temp) for _ in xrange(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertTrue(results == ["<h1>Spam</h1>"] * 80)
+		self.assertTrue(set(globals()) == names)
+
+	def test_23_line_numbers(self):
+		# Create template.
+		@pdt.template(inline=True)
+		def temp(items, error):
+			"<ul>"
+			for item in items:
+				"<li>{0}{0}</li>".format(item)
+				inline_item(item)
+			"</ul>"
+			if error:
+				raise ValueError(inspect.currentframe().f_lineno)
+			stacks.append(pdt.sample_stacks()[thread.get_ident()])
+		
+		# Make sure the line numbers of the compiled code match the source.
+		lines = [line for _, line in temp.__pdt_template__.line_map]
+		self.assertTrue(lines == sorted(lines))
+		try:
+			temp(["spam"], True)
+		except ValueError as e:
+			tb = sys.exc_info()[2]
+			while tb.tb_next:
+				tb = tb.tb_next
+			self.assertTrue(tb.tb_lineno == e.args[0])
+		else:
+			self.fail("ValueError not raised.")
+		
+		# Make sure sampled stacks resolve templates to their source lines.
+		stacks = []
+		temp.__globals__['stacks'] = stacks
+		try:
+			temp(["spam"], False)
+		finally:
+			del temp.__globals__['stacks']
+		filename, lineno, name = stacks[0][-2]
+		self.assertTrue(name == temp.__pdt_template__.key)
+		self.assertTrue(lineno == temp.__pdt_template__.source_lines[1])
+		
+		# Make sure profile statistics are named by template.
+		profiler = cProfile.Profile()
+		profiler.runcall(inline_item, "spam")
+		stats = pdt.rewrite_stats(pstats.Stats(profiler))
+		self.assertTrue(inline_item.__pdt_template__.key in [func[2] for func in stats.stats])
+
+	def test_24_tracing(self):
+		# Create templates.
+		@pdt.template(inline=True)
+		def temp(items, fail=False):
+			"<ul>"
+			for item in items:
+				inline_item(item)
+			"</ul>"
+			if fail:
+				raise ValueError(fail)
+		
+		# Make sure spans are nested for sub-templates, even when their calls
+		# are inlined.
+		self.assertTrue(temp.__pdt_template__.optimizations['inline'] == 1)
+		tracer = pdt.Tracer()
+		prev = pdt.set_tracer(tracer)
+		try:
+			self.assertTrue(temp(["spam", "eggs"]) == "<ul><li class='item'>SPAM</li><li class='item'>EGGS</li></ul>")
+			self.assertRaises(ValueError, temp, [], "fail")
+		finally:
+			self.assertTrue(pdt.set_tracer(prev) is tracer)
+		first, second, parent, failed = tracer.exporter.spans
+		self.assertTrue(parent.name == temp.__pdt_template__.key and parent.depth == 0)
+		self.assertTrue(parent.args == {'items': 'list[2]', 'fail': 'bool'})
+		self.assertTrue(parent.output_size == len(temp(["spam", "eggs"])))
+		self.assertTrue(first.name == inline_item.__pdt_template__.key)
+		self.assertTrue(first.parent_id == second.parent_id == parent.span_id)
+		self.assertTrue(first.trace_id == parent.trace_id and first.depth == 1)
+		self.assertTrue(0 <= first.duration <= parent.duration)
+		self.assertTrue(failed.error == "ValueError: fail" and failed.output_size is None)
+		
+		# Make sure non-ASCII error messages are recorded.
+		tracer = pdt.Tracer()
+		prev = pdt.set_tracer(tracer)
+		try:
+			self.assertRaises(ValueError, temp, [], u"\xe9")
+		finally:
+			pdt.set_tracer(prev)
+		self.assertTrue(tracer.exporter.spans[0].error == "ValueError: (u'\\xe9',)")
+		
+		# Make sure spans are finished when returning explicitly.
+		@pdt.template
+		def temp_return(title):
+			"<h1>"
+			return title
+		
+		tracer = pdt.Tracer()
+		prev = pdt.set_tracer(tracer)
+		try:
+			self.assertTrue(temp_return("spam") == "spam")
+			temp(["spam"])
+		finally:
+			pdt.set_tracer(prev)
+		self.assertTrue(tracer.local.stack == [])
+		first, second, parent = tracer.exporter.spans
+		self.assertTrue(first.name == temp_return.__pdt_template__.key and first.depth == 0)
+		self.assertTrue(first.duration >= 0 and first.output_size == 4)
+		self.assertTrue(parent.depth == 0 and parent.trace_id != first.trace_id)
+		
+		# Make sure unsampled calls are not exported.
+		tracer = pdt.Tracer(sample_rate=0.0)
+		prev = pdt.set_tracer(tracer)
+		try:
+			temp(["spam"])
+		finally:
+			pdt.set_tracer(prev)
+		self.assertTrue(len(tracer.exporter.spans) == 0)
+		self.assertTrue(tracer.local.stack == [])
+		
+		# Make sure spans are exported as JSON lines.
+		file = StringIO.StringIO()
+		prev = pdt.set_tracer(pdt.Tracer(pdt.JSONLinesExporter(file)))
+		try:
+			temp(["spam"])
+		finally:
+			pdt.set_tracer(prev)
+		spans = [json.loads(line) for line in file.getvalue().splitlines()]
+		self.assertTrue([span['name'] for span in spans] == [inline_item.__pdt_template__.key, temp.__pdt_template__.key])
+		self.assertTrue(spans[0]['parent_id'] == spans[1]['span_id'])
+
+	def test_25_alloc_profile(self):
+		# Create template.
+		@pdt.template(inline=False)
+		def temp(items):
+			"<ul>"
+			for item in items:
+				inline_item(item)
+			"</ul>"
+		
+		try:
+			import tracemalloc
+		except ImportError:
+			# Make sure profiling requires tracemalloc.
+			self.assertRaises(RuntimeError, pdt.alloc_profile().__enter__)
+			self.assertTrue(pdt.set_tracer(None) is None)
+			return
+		
+		# Make sure allocations are attributed to the template lines.
+		with pdt.alloc_profile() as profile:
+			temp(["spam" * 100, "eggs" * 100])
+		self.assertTrue(profile.renders[temp.__pdt_template__.key] == 1)
+		self.assertTrue(profile.renders[inline_item.__pdt_template__.key] == 2)
+		report = profile.report(5)
+		self.assertTrue(0 < len(report) <= 5)
+		self.assertTrue(set(usage.name for usage in report) <= set([temp.__pdt_template__.key, inline_item.__pdt_template__.key]))
+		self.assertTrue([usage.size for usage in report] == sorted((usage.size for usage in report), reverse=True))
+
+	def test_26_explain(self):
+		# Create template.
+		@pdt.template(inline=False)
+		def temp(items, title):
+			"<h1>{0}</h1>".format(title)
+			for item in items:
+				inline_item(item)
+			"</ul>"
+		
+		# Make sure the emitted code is explained.
+		info = pdt.explain(temp)
+		self.assertTrue(info.key == temp.__pdt_template__.key)
+		self.assertTrue(info.optimizations == temp.__pdt_template__.optimizations)
+		self.assertTrue(info.writes == 3 and info.constant_writes == 1)
+		self.assertTrue(info.global_loads == {'inline_item': 1})
+		self.assertTrue("FunctionDef(name='temp'" in info.ast)
+		self.assertTrue("'</ul>'" in info.bytecode)
+		self.assertTrue("Str(s=%r" % info.key in info.ast)
+		self.assertTrue(str(info).startswith("Template: %s\n" % info.key))
+		
+		# Make sure explaining does not modify the template.
+		self.assertTrue(pdt.lookup(info.key) is temp.__pdt_template__)
+		self.assertTrue(temp(["spam"], "Eggs") == "<h1>Eggs</h1><li class='item'>SPAM</li></ul>")
+		self.assertTrue(pdt.explain(info.key).bytecode == info.bytecode)
+
+
+class Stack(list):
+	def push(self, item):
+		self.append(item)
+		return self
+
+@pdt.template(inline=True)
+def inline_item(title, cls="item"):
+	upper = title.upper()
+	"<li class='%s'>%s</li>" % (cls, upper)
+
+@pdt.template(lazy=True)
+def lazy_item(title):
+	"<i>%s</i>" % title
+
+class LazyPage(object):
+	@pdt.template(lazy=True)
+	def render(self):
+		"<p>"
+
+class BudgetPage(object):
+	@pdt.template(max_bytes=100)
+	def render(self):
+		"<p>"
+
+def escape_title(title):
+	return "ESC(%s)" % title
+
+@pdt.template(inline=True)
+def inline_escape(title):
+	escape_title(title)
+
+@pdt.template(inline=True, max_bytes=3)
+def inline_limited(title):
+	title
+
+@pdt.template(inline=True)
+def inline_bold(title):
+	"<b>"
+	title.upper()
+
+@pdt.template
+def plain_item(title):
+	"<i>%s</i>" % title
+
+class ThreadFuture(object):
+	def __init__(self, func, delay):
+		self.value = None
+		self.thread = threading.Thread(target=self.run, args=(func, delay))
+		self.thread.start()
+	
+	def run(self, func, delay):
+		time.sleep(delay)
+		self.value = func()
+	
+	def result(self):
+		self.thread.join()
+		return self.value
+
+@pdt.side_effect
+def side_effect_func(items):
+	del items[:-1]
+	return items
 
 html_data = {
 	'doctype': """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">""",